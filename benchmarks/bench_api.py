@@ -0,0 +1,43 @@
+"""
+Job round trips through the API
+
+Runs against a deployed API (see ``api/docker-compose.yml``), whose URL is
+read from ``OHDSI_API_URL``, e.g. ``http://localhost:5000``.
+"""
+import json
+import os
+import time
+import urllib.request
+
+import pytest
+
+API_URL = os.environ.get("OHDSI_API_URL")
+
+pytestmark = pytest.mark.skipif(not API_URL, reason="OHDSI_API_URL not set")
+
+
+def _request(method: str, path: str) -> dict:
+    request = urllib.request.Request(f"{API_URL}{path}", method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def _round_trip(timeout: float = 300, poll_interval: float = 0.1) -> dict:
+    job = _request("POST", "/feature-extraction")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = _request("GET", f"/feature-extraction/{job['id']}")
+        if result["state"] in ("SUCCESS", "FAILURE"):
+            assert result["state"] == "SUCCESS"
+            return result
+        time.sleep(poll_interval)
+    raise TimeoutError(f"Job {job['id']} did not finish in {timeout}s")
+
+
+def test_submit_job(benchmark):
+    benchmark.pedantic(_request, args=("POST", "/feature-extraction"),
+                       rounds=20)
+
+
+def test_job_round_trip(benchmark):
+    benchmark.pedantic(_round_trip, rounds=3)
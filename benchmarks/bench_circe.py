@@ -0,0 +1,130 @@
+"""
+Building cohort SQL from a Circe cohort expression
+
+The cohorts of the parity corpus (``ohdsi/circe/data/parity``) are generated
+on Eunomia with the SQL of both engines, which must give the same cohorts.
+"""
+import json
+
+from importlib.resources import files
+
+import pytest
+
+from conftest import CDM_SCHEMA
+
+from ohdsi import circe
+
+PARITY_CORPUS = sorted(
+    f.name for f in files("ohdsi.circe.data").joinpath("parity").iterdir()
+    if f.name.endswith(".json")
+)
+
+
+def test_cohort_expression_from_json(benchmark, cohort_json):
+    benchmark(circe.cohort_expression_from_json, cohort_json)
+
+
+def test_build_cohort_query(benchmark, cohort_json):
+    expression = circe.cohort_expression_from_json(cohort_json)
+    options = circe.create_generate_options(generate_stats=True)
+    benchmark(circe.build_cohort_query, expression, options)
+
+
+def test_build_cohort_query_python(benchmark, cohort_json):
+    benchmark(circe.build_cohort_query, cohort_json,
+              {"generate_stats": True}, engine="python")
+
+
+@pytest.fixture(scope="module")
+def vocabulary_index(tmp_path_factory, eunomia_connection):
+    return circe.VocabularyIndex.snapshot(
+        tmp_path_factory.mktemp("vocabulary") / "vocabulary.sqlite",
+        eunomia_connection, CDM_SCHEMA
+    )
+
+
+def test_resolve_concept_sets(benchmark, vocabulary_index):
+    concept_sets = [
+        json.loads(files("ohdsi.circe.data").joinpath("parity", cohort)
+                   .read_text())["ConceptSets"]
+        for cohort in PARITY_CORPUS
+    ]
+
+    def resolve():
+        # a fresh index, so that only the cache in the snapshot is used
+        index = circe.VocabularyIndex(vocabulary_index.path)
+        for cohort_concept_sets in concept_sets:
+            index.resolve_concept_sets(cohort_concept_sets)
+        index.close()
+
+    benchmark(resolve)
+
+
+def test_resolve_concept_sets_database(benchmark, eunomia_connection):
+    concept_sets = [
+        concept_set
+        for cohort in PARITY_CORPUS
+        for concept_set in json.loads(
+            files("ohdsi.circe.data").joinpath("parity", cohort).read_text()
+        )["ConceptSets"]
+    ]
+    # the ids must be unique over the cohorts
+    concept_sets = [dict(c, id=i) for i, c in enumerate(concept_sets)]
+    benchmark(circe.resolve_concept_sets, eunomia_connection, concept_sets,
+              CDM_SCHEMA)
+
+
+@pytest.mark.parametrize("cohort", PARITY_CORPUS)
+def test_build_cohort_query_parity(eunomia_connection_details, cohort):
+    from rpy2 import robjects
+    from rpy2.robjects.packages import importr
+
+    from ohdsi import cohort_generator, database_connector
+    from ohdsi.common import convert_from_r
+
+    cohort_json = files("ohdsi.circe.data").joinpath("parity", cohort) \
+        .read_text()
+    sql = {
+        "r": circe.build_cohort_query(
+            circe.cohort_expression_from_json(cohort_json),
+            circe.create_generate_options(generate_stats=True))[0],
+        "python": circe.build_cohort_query(
+            json.loads(cohort_json), {"generate_stats": True},
+            engine="python")
+    }
+    cohort_table_names = cohort_generator.get_cohort_table_names("parity")
+    cohort_generator.create_cohort_tables(
+        CDM_SCHEMA, connection_details=eunomia_connection_details,
+        cohort_table_names=cohort_table_names
+    )
+    cohort_generator.generate_cohort_set(
+        CDM_SCHEMA,
+        importr("base").rbind(
+            cohort_generator.create_empty_cohort_definition_set(),
+            robjects.r("data.frame")(
+                cohortId=robjects.IntVector([1, 2]),
+                cohortName=robjects.StrVector(["r", "python"]),
+                sql=robjects.StrVector([sql["r"], sql["python"]]),
+                json=robjects.StrVector([cohort_json, cohort_json]),
+                stringsAsFactors=False
+            )
+        ),
+        connection_details=eunomia_connection_details,
+        cohort_database_schema=CDM_SCHEMA,
+        cohort_table_names=cohort_table_names
+    )
+
+    connection = database_connector.connect(eunomia_connection_details)
+    try:
+        rows = convert_from_r(database_connector.query_sql(
+            connection, "SELECT * FROM main.parity"))
+    finally:
+        database_connector.disconnect(connection)
+    rows.columns = [c.lower() for c in rows.columns]
+    by_engine = [
+        rows[rows["cohort_definition_id"] == cohort_id]
+        .drop(columns="cohort_definition_id")
+        .sort_values(["subject_id", "cohort_start_date"], ignore_index=True)
+        for cohort_id in (1, 2)
+    ]
+    assert by_engine[0].equals(by_engine[1])
@@ -0,0 +1,98 @@
+"""
+Generating cohorts on the Eunomia CDM, and saving cohort definition sets
+"""
+import pandas as pd
+import pytest
+
+from conftest import CDM_SCHEMA
+
+from ohdsi import cohort_generator
+from ohdsi.common import convert_from_r
+
+LIBRARY_SIZE = 1_000
+
+
+def test_generate_cohort_set(benchmark, eunomia_connection_details,
+                             cohort_definition_set):
+    cohort_table_names = cohort_generator.get_cohort_table_names(
+        "benchmark_cohort"
+    )
+    cohort_generator.create_cohort_tables(
+        CDM_SCHEMA, connection_details=eunomia_connection_details,
+        cohort_table_names=cohort_table_names
+    )
+    benchmark.pedantic(
+        cohort_generator.generate_cohort_set,
+        kwargs={
+            "cdm_database_schema": CDM_SCHEMA,
+            "cohort_definition_set": cohort_definition_set,
+            "connection_details": eunomia_connection_details,
+            "cohort_database_schema": CDM_SCHEMA,
+            "cohort_table_names": cohort_table_names
+        },
+        rounds=5
+    )
+
+
+def test_get_cohort_counts(benchmark, eunomia_connection):
+    benchmark(cohort_generator.get_cohort_counts, CDM_SCHEMA,
+              connection=eunomia_connection)
+
+
+def test_get_cached_cohort_counts(benchmark, eunomia_connection):
+    service = cohort_generator.CohortCountService(
+        CDM_SCHEMA, connection=eunomia_connection, ttl=0
+    )
+    benchmark(service.get_counts_batch, ["cohort"])
+
+
+@pytest.fixture(scope="module")
+def cohort_library(cohort_definition_set) -> pd.DataFrame:
+    """ A library of copies of the simple cohort """
+    cohort = convert_from_r(cohort_definition_set).iloc[0]
+    return pd.DataFrame({
+        "cohortId": range(1, LIBRARY_SIZE + 1),
+        "cohortName": [f"Cohort {i}" for i in range(LIBRARY_SIZE)],
+        "json": cohort["json"],
+        "sql": cohort["sql"],
+    })
+
+
+@pytest.mark.parametrize("engine", ["r", "python"])
+def test_save_cohort_definition_set(benchmark, tmp_path, cohort_library,
+                                    engine):
+    benchmark.pedantic(
+        cohort_generator.save_cohort_definition_set,
+        args=(cohort_library, str(tmp_path / "cohorts.csv"),
+              str(tmp_path / "json"), str(tmp_path / "sql")),
+        kwargs={"engine": engine},
+        rounds=3
+    )
+
+
+@pytest.mark.parametrize("engine", ["r", "python"])
+def test_get_cohort_definition_set(benchmark, tmp_path, cohort_library,
+                                   engine):
+    folders = (str(tmp_path / "cohorts.csv"), str(tmp_path / "json"),
+               str(tmp_path / "sql"))
+    cohort_generator.save_cohort_definition_set(cohort_library, *folders)
+    benchmark.pedantic(
+        cohort_generator.get_cohort_definition_set, args=folders,
+        kwargs={"engine": engine}, rounds=3
+    )
+
+
+def test_cohort_definition_set_round_trip(tmp_path, cohort_definition_set):
+    """ The IDs of a set created in R are doubles, written as integers """
+    folders = (str(tmp_path / "cohorts.csv"), str(tmp_path / "json"),
+               str(tmp_path / "sql"))
+    cohort_generator.save_cohort_definition_set(cohort_definition_set,
+                                                *folders, engine="python")
+    saved = cohort_generator.get_cohort_definition_set(*folders,
+                                                       engine="python")
+
+    expected = convert_from_r(cohort_definition_set)
+    assert [p.name for p in (tmp_path / "sql").iterdir()] == ["100.sql"]
+    assert saved["cohortId"].tolist() == [100]
+    assert saved["sql"].tolist() == expected["sql"].tolist()
+    assert saved["json"].tolist() == expected["json"].tolist()
@@ -0,0 +1,153 @@
+"""
+Conversion of data between Python and R at synthetic scales
+
+Scales above 100k rows are only run when ``OHDSI_BENCHMARK_LARGE`` is set.
+"""
+import tracemalloc
+
+import pytest
+
+from rpy2 import robjects
+from rpy2.robjects import pandas2ri
+from rpy2.robjects.conversion import localconverter
+from rpy2.robjects.packages import importr, isinstalled
+
+from conftest import SCALES, synthetic_frame
+
+from ohdsi.common import andromeda_to_df, convert_from_r, convert_to_r
+
+
+@pytest.mark.parametrize("n_rows", SCALES)
+def test_convert_to_r(benchmark, n_rows):
+    df = synthetic_frame(n_rows)
+    benchmark(convert_to_r, df)
+
+
+def _pandas2ri(df):
+    with localconverter(robjects.default_converter + pandas2ri.converter):
+        return robjects.conversion.py2rpy(df)
+
+
+@pytest.mark.parametrize("n_rows", SCALES)
+def test_convert_to_r_pandas2ri(benchmark, n_rows):
+    # the conversion convert_to_r used before dataframe_to_r, as reference
+    df = synthetic_frame(n_rows)
+    benchmark(_pandas2ri, df)
+
+
+@pytest.mark.parametrize("converter", [convert_to_r, _pandas2ri],
+                         ids=["convert_to_r", "pandas2ri"])
+@pytest.mark.parametrize("n_rows", SCALES)
+def test_convert_to_r_memory(benchmark, n_rows, converter):
+    """ Peak of the Python allocations made during the conversion """
+    df = synthetic_frame(n_rows)
+
+    def convert():
+        tracemalloc.start()
+        try:
+            converter(df)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    peak = benchmark.pedantic(convert, rounds=3)
+    benchmark.extra_info["python_peak_bytes"] = peak
+    benchmark.extra_info["input_bytes"] = int(
+        df.memory_usage(deep=True).sum()
+    )
+
+
+@pytest.mark.parametrize("n_rows", SCALES)
+def test_convert_from_r(benchmark, n_rows):
+    r_df = convert_to_r(synthetic_frame(n_rows))
+    benchmark(convert_from_r, r_df, date_cols=["observationDate"])
+
+
+def _convert_from_r_recursive(item, date_cols=None, name='',
+                              reserve_plots=True):
+    """ The recursive convert_from_r that preceded the iterative one, kept
+    as reference for the micro-benchmarks """
+    result = item
+    remove_list = True
+    if item == robjects.vectors.NULL:
+        return None
+    elif ('plot' in name
+          and isinstance(item, robjects.vectors.ListVector)
+          and reserve_plots):
+        return item
+    elif isinstance(item, (robjects.environments.Environment,
+                           robjects.Formula)):
+        return None
+    elif isinstance(item, robjects.vectors.DataFrame):
+        return convert_from_r(item, date_cols)
+    elif isinstance(item, (robjects.vectors.StrVector,
+                           robjects.vectors.FloatVector,
+                           robjects.vectors.BoolVector,
+                           robjects.vectors.IntVector)):
+        result = tuple(item)
+    elif isinstance(item, robjects.vectors.ListVector):
+        result = {}
+        remove_list = False
+
+        if item.names == robjects.vectors.NULL:
+            if len(item) > 0:
+                result = [_convert_from_r_recursive(i, date_cols)
+                          for i in item]
+            else:
+                result = []
+
+        elif len(item) > 0:
+            result = dict(zip(item.names, list(item)))
+            for k, v in result.items():
+                result[k] = _convert_from_r_recursive(v, date_cols, name=k)
+
+    if '__len__' in result.__dir__() and len(result) == 1 and remove_list:
+        result = result[0]
+
+    return result
+
+
+def _nested_list(n_items: int):
+    # settings objects are nested lists of small vectors
+    return robjects.r(f"""
+        lapply(seq_len({n_items}), function(i) list(
+            id = i, name = paste0("analysis", i),
+            flags = list(a = TRUE, b = FALSE), concepts = 1:10
+        ))
+    """)
+
+
+@pytest.mark.parametrize("converter",
+                         [convert_from_r, _convert_from_r_recursive],
+                         ids=["iterative", "recursive"])
+@pytest.mark.parametrize("n_items", [10, 1_000, 100_000])
+def test_convert_from_r_nested(benchmark, n_items, converter):
+    nested = _nested_list(n_items)
+    assert converter(nested) == _convert_from_r_recursive(nested)
+    benchmark(converter, nested)
+
+
+@pytest.mark.parametrize("converter",
+                         [convert_from_r, _convert_from_r_recursive],
+                         ids=["iterative", "recursive"])
+def test_convert_from_r_deep(benchmark, converter):
+    # the recursive implementation fails on this depth
+    deep = robjects.r("""
+        Reduce(function(inner, i) list(level = i, inner = inner),
+               seq_len(5000), list())
+    """)
+    try:
+        benchmark(converter, deep)
+    except RecursionError:
+        pytest.xfail("recursion limit reached")
+
+
+@pytest.mark.parametrize("n_rows", SCALES)
+def test_andromeda_to_df(benchmark, n_rows):
+    if not isinstalled("Andromeda"):
+        pytest.skip("The Andromeda R package is not installed")
+
+    andromeda = importr("Andromeda").andromeda(
+        covariates=convert_to_r(synthetic_frame(n_rows))
+    )
+    benchmark(andromeda_to_df, andromeda.rx2("covariates"))
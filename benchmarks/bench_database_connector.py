@@ -0,0 +1,81 @@
+"""
+Executing the SQL of a cohort and transferring query results on the Eunomia
+CDM, and on Postgres when ``OHDSI_BENCHMARK_POSTGRES`` is set
+"""
+import pytest
+
+from conftest import CDM_SCHEMA, COHORT_TABLE, POSTGRES_CDM_SCHEMA
+
+from ohdsi import circe, database_connector
+from ohdsi.database_connector import query_log
+
+
+@pytest.fixture(scope="module")
+def cohort_sql(cohort_json) -> str:
+    return circe.build_cohort_query(cohort_json, {
+        "cohort_id": 100,
+        "cdm_schema": CDM_SCHEMA,
+        "target_table": f"{CDM_SCHEMA}.{COHORT_TABLE}",
+    }, engine="python")
+
+
+def test_render_translate_execute_sql(benchmark, eunomia_connection,
+                                      cohort_sql):
+    benchmark(database_connector.render_translate_execute_sql,
+              eunomia_connection, cohort_sql)
+
+
+def test_execute_sql_script(benchmark, eunomia_connection, cohort_sql):
+    benchmark(database_connector.execute_sql_script, eunomia_connection,
+              cohort_sql)
+
+
+@pytest.fixture(scope="module")
+def query_cache(tmp_path_factory) -> database_connector.QueryCache:
+    return database_connector.QueryCache(tmp_path_factory.mktemp("cache"))
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_query_sql(benchmark, eunomia_connection, query_cache, cached):
+    sql = f"SELECT * FROM {CDM_SCHEMA}.condition_occurrence"
+    benchmark(database_connector.query_sql, eunomia_connection, sql,
+              cache=query_cache if cached else None, tags=["eunomia"])
+
+
+@pytest.mark.parametrize("explain", [False, True])
+def test_execute_sql_script_query_log(benchmark, tmp_path, eunomia_connection,
+                                      cohort_sql, explain):
+    query_log.enable_query_log(tmp_path / "slow_queries.jsonl",
+                               threshold=0.1, explain=explain)
+    try:
+        benchmark(database_connector.execute_sql_script, eunomia_connection,
+                  cohort_sql)
+    finally:
+        query_log.disable_query_log()
+        query_log.reset_query_log()
+
+
+def _query_sql_to_pandas(benchmark, connection, sql, transfer):
+    from ohdsi.common import convert_from_r
+
+    if transfer == "r":
+        benchmark(lambda: convert_from_r(
+            database_connector.query_sql(connection, sql)))
+    else:
+        benchmark(lambda: database_connector.query_sql_to_arrow(
+            connection, sql).to_pandas())
+
+
+@pytest.mark.parametrize("transfer", ["r", "arrow"])
+def test_query_sql_to_pandas(benchmark, eunomia_connection, transfer):
+    _query_sql_to_pandas(benchmark, eunomia_connection,
+                         f"SELECT * FROM {CDM_SCHEMA}.measurement", transfer)
+
+
+@pytest.mark.parametrize("transfer", ["r", "arrow"])
+def test_query_sql_to_pandas_postgres(benchmark, postgres_connection,
+                                      transfer):
+    _query_sql_to_pandas(
+        benchmark, postgres_connection,
+        f"SELECT * FROM {POSTGRES_CDM_SCHEMA}.measurement", transfer
+    )
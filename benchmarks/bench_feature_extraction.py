@@ -0,0 +1,91 @@
+"""
+Extracting covariates for the Eunomia cohorts
+"""
+import pytest
+
+from conftest import CDM_SCHEMA, COHORT_TABLE
+
+from ohdsi import feature_extraction
+
+
+@pytest.fixture(scope="module")
+def covariate_settings():
+    return feature_extraction.create_covariate_settings(
+        use_demographics_gender=True,
+        use_demographics_age_group=True,
+        use_condition_occurrence_any_time_prior=True,
+        use_drug_exposure_any_time_prior=True,
+        use_charlson_index=True
+    )
+
+
+def test_create_default_covariate_settings(benchmark):
+    benchmark.pedantic(
+        feature_extraction.create_default_covariate_settings,
+        setup=feature_extraction.clear_settings_cache, rounds=20
+    )
+
+
+def test_create_default_covariate_settings_cached(benchmark):
+    benchmark(feature_extraction.create_default_covariate_settings)
+
+
+@pytest.mark.parametrize("aggregated", [False, True])
+def test_get_db_covariate_data(benchmark, eunomia_connection_details,
+                               covariate_settings, aggregated):
+    benchmark.pedantic(
+        feature_extraction.get_db_covariate_data,
+        kwargs={
+            "connection_details": eunomia_connection_details,
+            "cdm_database_schema": CDM_SCHEMA,
+            "cohort_database_schema": CDM_SCHEMA,
+            "cohort_table": COHORT_TABLE,
+            "cohort_id": 1,
+            "covariate_settings": covariate_settings,
+            "aggregated": aggregated
+        },
+        rounds=3
+    )
+
+
+def test_settings_attribute_access(benchmark):
+    # reading every field of a settings object, as the API does
+    settings = feature_extraction.create_covariate_settings(
+        use_demographics_gender=True,
+        use_condition_occurrence_any_time_prior=True
+    )
+
+    def read_all():
+        return [getattr(settings, key) for key in settings.keys]
+
+    benchmark(read_all)
+
+
+def test_settings_as_dict(benchmark):
+    settings = feature_extraction.create_covariate_settings(
+        use_demographics_gender=True,
+        use_condition_occurrence_any_time_prior=True
+    )
+    benchmark(settings.as_dict)
+
+
+def _r_memory_mb() -> float:
+    from rpy2 import robjects
+    return robjects.r("sum(gc()[, 2])")[0]
+
+
+def test_settings_copies(benchmark):
+    """ Wrapping settings objects should not duplicate them in R """
+    from ohdsi.common import ListVectorExtended
+
+    settings = feature_extraction.create_default_covariate_settings()
+    list_vector = settings.as_list_vector()
+
+    def wrap():
+        return [ListVectorExtended.from_list_vector(list_vector)
+                for _ in range(100)]
+
+    before = _r_memory_mb()
+    copies = benchmark(wrap)
+    benchmark.extra_info["r_memory_mb"] = _r_memory_mb() - before
+    assert len(copies) == 100
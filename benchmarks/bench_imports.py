@@ -0,0 +1,33 @@
+"""
+Import time of the wrapper packages, including loading the R packages
+
+Every round imports the package in a fresh interpreter, as the embedded R
+session and the loaded R packages are cached within a process.
+"""
+import subprocess
+import sys
+
+import pytest
+
+PACKAGES = [
+    "ohdsi.common",
+    "ohdsi.sqlrender",
+    "ohdsi.circe",
+    "ohdsi.database_connector",
+    "ohdsi.cohort_generator",
+    "ohdsi.feature_extraction",
+    "ohdsi.cohort_diagnostics",
+]
+
+
+def _import(package: str) -> None:
+    subprocess.run([sys.executable, "-c", f"import {package}"], check=True)
+
+
+def test_import_rpy2(benchmark):
+    benchmark.pedantic(_import, args=("rpy2.robjects",), rounds=5)
+
+
+@pytest.mark.parametrize("package", PACKAGES)
+def test_import_package(benchmark, package):
+    benchmark.pedantic(_import, args=(package,), rounds=5)
@@ -0,0 +1,147 @@
+"""
+Scaling of the heavy wrappers on synthetic CDMs
+
+Generate the CDMs with ``synthetic_cdm.py`` and list them, comma separated,
+in ``OHDSI_BENCHMARK_CDM``, e.g.
+``OHDSI_BENCHMARK_CDM=cdm_10k.duckdb,cdm_100k.duckdb,cdm_1m.duckdb``. The
+number of persons is stored with each result, so the curves can be plotted
+from the JSON results.
+"""
+import tempfile
+
+import pytest
+
+from conftest import CDM_SCHEMA, COHORT_TABLE
+
+from ohdsi import (
+    cohort_diagnostics,
+    cohort_generator,
+    database_connector,
+    feature_extraction,
+)
+from ohdsi.common import convert_from_r
+from ohdsi.cohort_diagnostics.temporal import (
+    temporal_cohort_characterization
+)
+
+SCALING_COHORT_TABLE = "benchmark_scaling_cohort"
+
+
+@pytest.fixture(scope="module")
+def persons(synthetic_cdm) -> int:
+    connection = database_connector.connect(synthetic_cdm)
+    try:
+        count = database_connector.query_sql(
+            connection, "SELECT COUNT(*) AS n FROM person"
+        )
+    finally:
+        database_connector.disconnect(connection)
+    return int(convert_from_r(count).iloc[0, 0])
+
+
+@pytest.fixture(scope="module")
+def cohort_table_names(synthetic_cdm):
+    cohort_table_names = cohort_generator.get_cohort_table_names(
+        SCALING_COHORT_TABLE
+    )
+    cohort_generator.create_cohort_tables(
+        CDM_SCHEMA, connection_details=synthetic_cdm,
+        cohort_table_names=cohort_table_names
+    )
+    return cohort_table_names
+
+
+def test_generate_cohort_set(benchmark, synthetic_cdm, persons,
+                             cohort_definition_set, cohort_table_names):
+    benchmark.extra_info["persons"] = persons
+    benchmark.pedantic(
+        cohort_generator.generate_cohort_set,
+        kwargs={
+            "cdm_database_schema": CDM_SCHEMA,
+            "cohort_definition_set": cohort_definition_set,
+            "connection_details": synthetic_cdm,
+            "cohort_database_schema": CDM_SCHEMA,
+            "cohort_table_names": cohort_table_names
+        },
+        rounds=1
+    )
+
+
+@pytest.mark.parametrize("aggregated", [False, True])
+def test_get_db_covariate_data(benchmark, synthetic_cdm, persons,
+                               aggregated):
+    benchmark.extra_info["persons"] = persons
+    benchmark.pedantic(
+        feature_extraction.get_db_covariate_data,
+        kwargs={
+            "connection_details": synthetic_cdm,
+            "cdm_database_schema": CDM_SCHEMA,
+            "cohort_database_schema": CDM_SCHEMA,
+            "cohort_table": COHORT_TABLE,
+            "cohort_id": 1,
+            "covariate_settings":
+                feature_extraction.create_default_covariate_settings(),
+            "aggregated": aggregated
+        },
+        rounds=1
+    )
+
+
+def test_execute_diagnostics(benchmark, synthetic_cdm, persons,
+                             cohort_definition_set, cohort_table_names):
+    benchmark.extra_info["persons"] = persons
+    cohort_generator.generate_cohort_set(
+        CDM_SCHEMA, cohort_definition_set,
+        connection_details=synthetic_cdm,
+        cohort_database_schema=CDM_SCHEMA,
+        cohort_table_names=cohort_table_names,
+        incremental=False
+    )
+    with tempfile.TemporaryDirectory() as export_folder:
+        benchmark.pedantic(
+            cohort_diagnostics.execute_diagnostics,
+            kwargs={
+                "cohort_definition_set": cohort_definition_set,
+                "database_id": "synthetic",
+                "cohort_database_schema": CDM_SCHEMA,
+                "cdm_database_schema": CDM_SCHEMA,
+                "export_folder": export_folder,
+                "connection_details": synthetic_cdm,
+                "cohort_table": SCALING_COHORT_TABLE,
+                "cohort_table_names": cohort_table_names
+            },
+            rounds=1
+        )
+
+
+@pytest.mark.parametrize("engine", ["r", "python"])
+def test_temporal_characterization(benchmark, synthetic_cdm, persons,
+                                   engine):
+    benchmark.extra_info["persons"] = persons
+    if engine == "r":
+        benchmark.pedantic(
+            feature_extraction.get_db_covariate_data,
+            kwargs={
+                "connection_details": synthetic_cdm,
+                "cdm_database_schema": CDM_SCHEMA,
+                "cohort_database_schema": CDM_SCHEMA,
+                "cohort_table": COHORT_TABLE,
+                "cohort_id": 1,
+                "covariate_settings":
+                    cohort_diagnostics.get_default_covariate_settings(),
+                "aggregated": True
+            },
+            rounds=1
+        )
+        return
+
+    connection = database_connector.connect(synthetic_cdm)
+    try:
+        benchmark.pedantic(
+            temporal_cohort_characterization,
+            args=(connection, CDM_SCHEMA, CDM_SCHEMA, [1], "synthetic"),
+            kwargs={"cohort_table": COHORT_TABLE},
+            rounds=1
+        )
+    finally:
+        database_connector.disconnect(connection)
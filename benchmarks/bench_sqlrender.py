@@ -0,0 +1,32 @@
+"""
+Throughput of rendering and translating SQL
+"""
+import pytest
+
+from ohdsi import sqlrender
+
+SQL = """
+SELECT person_id, COUNT(*) AS n
+FROM @cdm_database_schema.condition_occurrence
+WHERE condition_concept_id IN (@concept_ids)
+{@start_date != ''} ? {AND condition_start_date >= '@start_date'}
+GROUP BY person_id;
+"""
+
+
+def test_render(benchmark):
+    benchmark(sqlrender.render, SQL, cdm_database_schema="main",
+              concept_ids=[192671, 4112343], start_date="2020-01-01")
+
+
+@pytest.mark.parametrize("dialect", ["sqlite", "postgresql", "spark"])
+def test_translate(benchmark, dialect):
+    sql = sqlrender.render(SQL, cdm_database_schema="main",
+                           concept_ids=[192671], start_date="")[0]
+    benchmark(sqlrender.translate, sql, dialect)
+
+
+def test_translate_cohort_sql(benchmark, cohort_definition_set):
+    # cohort SQL is much larger than typical hand written SQL
+    sql = cohort_definition_set.rx2("sql")[0]
+    benchmark(sqlrender.translate, sql, "postgresql")
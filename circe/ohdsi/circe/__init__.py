@@ -1,39 +1,44 @@
+from __future__ import annotations
+
 import json
 import os
 
 from pathlib import Path
 
-from rpy2 import robjects
-from rpy2.robjects.methods import RS4
-from rpy2.robjects.vectors import StrVector
-
-from rpy2.robjects.packages import importr
-
-
-#
-# Converters
-#
-@robjects.default_converter.py2rpy.register(type(None))
-def _py_none_to_null(py_obj):
-    return robjects.NULL
-
-
-@robjects.default_converter.py2rpy.register(Path)
-def _py_path_to_str(py_obj):
-    return robjects.StrVector(str(py_obj))
-
+from ohdsi.circe.builder import build_cohort_sql, concept_set_expression_sql
+from ohdsi.circe.vocabulary import VocabularyIndex, resolve_concept_sets
 
 #
 # R interface
 #
 # When building documentation for the project, the following import will fail
 # as the package is not installed. In this case, we set the variable to None
-# so that the documentation can be built.
+# so that the documentation can be built. This also allows using the Python
+# cohort SQL builder (``engine="python"``) where R is not installed.
 if os.environ.get('IGNORE_R_IMPORTS', False):
     circe_r = None
 else:
+    from rpy2 import robjects
+    from rpy2.robjects.methods import RS4
+    from rpy2.robjects.vectors import StrVector
+
+    from rpy2.robjects.packages import importr
+
+    #
+    # Converters
+    #
+    @robjects.default_converter.py2rpy.register(type(None))
+    def _py_none_to_null(py_obj):
+        return robjects.NULL
+
+    @robjects.default_converter.py2rpy.register(Path)
+    def _py_path_to_str(py_obj):
+        return robjects.StrVector(str(py_obj))
+
     circe_r = importr('CirceR')
 
+BUILD_ENGINES = ("r", "python")
+
 
 # -----------------------------------------------------------------------------
 # wrapper: CirceR/R/CohortExpression.R
@@ -141,29 +146,51 @@ def create_generate_options(
     return circe_r.createGenerateOptions(**kwargs)
 
 
-def build_cohort_query(cohort_expression: RS4, options: RS4 = None) \
-        -> StrVector:
+def build_cohort_query(cohort_expression: RS4 | str | dict,
+                       options: RS4 | dict = None, engine: str = "r") \
+        -> StrVector | str:
     """
     Build Cohort SQL
 
     Generates the OMOP CDM Sql to generate the cohort expression.
 
     Wraps the R ``CirceR::buildCohortQuery`` function defined in
-    ``CirceR/R/CohortSqlBuilder.R``.
+    ``CirceR/R/CohortSqlBuilder.R``. With ``engine="python"`` the SQL is
+    built by ``ohdsi.circe.builder`` instead, which does not need R or Java
+    and supports the commonly used criteria.
 
     Parameters
     ----------
-    cohort_expression : RS4 | str
-        An R object or a JSON string containing the cohort expression
-    options : RS4, optional
+    cohort_expression : RS4 | str | dict
+        An R object or a JSON string containing the cohort expression. The
+        Python engine takes a JSON string or a dict.
+    options : RS4 | dict, optional
         The options object from ``create_generate_options``, by default
-        None
+        None. The Python engine takes a dict with the arguments of
+        ``create_generate_options`` instead.
+    engine : str, optional
+        Either "r" (CirceR) or "python", by default "r"
 
     Returns
     -------
-    StrVector
-        contains the SQL statements
+    StrVector | str
+        contains the SQL statements, a ``str`` for the Python engine
+
+    Raises
+    ------
+    NotImplementedError
+        When the Python engine does not support the cohort expression
+
+    Examples
+    --------
+    >>> sql = build_cohort_query(cohort_json, {"generate_stats": True},
+    ...                          engine="python")
     """
+    if engine == "python":
+        return build_cohort_sql(cohort_expression, **(options or {}))
+    if engine != "r":
+        raise ValueError(f"Unknown engine {engine}, choose from "
+                         f"{BUILD_ENGINES}")
     return circe_r.buildCohortQuery(cohort_expression, options)
 
 
@@ -0,0 +1,881 @@
+"""
+Cohort SQL from a Circe cohort expression, without R or Java
+
+Builds the OHDSI SQL of ``CirceR::buildCohortQuery`` for the commonly used
+parts of a cohort expression: concept sets, condition, drug, procedure,
+measurement, observation, visit, device and death criteria, observation
+windows, inclusion rules, additional and censoring criteria, end strategies,
+era collapsing and censor windows. The SQL follows the steps of Circe (primary
+events, qualified events, inclusion events, cohort ends and eras) and uses
+the same temp tables and parameters, so it can be rendered and translated by
+SqlRender and executed by CohortGenerator like the SQL of CirceR.
+
+Parts of an expression that are not supported raise a
+``NotImplementedError``; build those cohorts with CirceR. The cohorts in
+``ohdsi/circe/data/parity`` are the corpus that the results of both builders
+are compared on (see ``benchmarks/bench_circe.py``).
+"""
+from __future__ import annotations
+
+import json
+
+from datetime import date
+
+# table, event id, concept, start date, end date, visit and source concept
+# columns of each criteria type. The end date is an expression on alias C.
+_DOMAINS = {
+    "ConditionOccurrence": (
+        "CONDITION_OCCURRENCE", "condition_occurrence_id",
+        "condition_concept_id", "condition_start_date",
+        "COALESCE(C.condition_end_date, "
+        "DATEADD(day,1,C.condition_start_date))",
+        "visit_occurrence_id", "condition_source_concept_id"),
+    "DrugExposure": (
+        "DRUG_EXPOSURE", "drug_exposure_id", "drug_concept_id",
+        "drug_exposure_start_date",
+        "COALESCE(C.drug_exposure_end_date, DATEADD(day,C.days_supply,"
+        "C.drug_exposure_start_date), "
+        "DATEADD(day,1,C.drug_exposure_start_date))",
+        "visit_occurrence_id", "drug_source_concept_id"),
+    "ProcedureOccurrence": (
+        "PROCEDURE_OCCURRENCE", "procedure_occurrence_id",
+        "procedure_concept_id", "procedure_date",
+        "DATEADD(day,1,C.procedure_date)",
+        "visit_occurrence_id", "procedure_source_concept_id"),
+    "Measurement": (
+        "MEASUREMENT", "measurement_id", "measurement_concept_id",
+        "measurement_date", "DATEADD(day,1,C.measurement_date)",
+        "visit_occurrence_id", "measurement_source_concept_id"),
+    "Observation": (
+        "OBSERVATION", "observation_id", "observation_concept_id",
+        "observation_date", "DATEADD(day,1,C.observation_date)",
+        "visit_occurrence_id", "observation_source_concept_id"),
+    "VisitOccurrence": (
+        "VISIT_OCCURRENCE", "visit_occurrence_id", "visit_concept_id",
+        "visit_start_date", "C.visit_end_date",
+        "visit_occurrence_id", "visit_source_concept_id"),
+    "DeviceExposure": (
+        "DEVICE_EXPOSURE", "device_exposure_id", "device_concept_id",
+        "device_exposure_start_date",
+        "COALESCE(C.device_exposure_end_date, "
+        "DATEADD(day,1,C.device_exposure_start_date))",
+        "visit_occurrence_id", "device_source_concept_id"),
+    "Death": (
+        "DEATH", "person_id", "cause_concept_id", "death_date",
+        "DATEADD(day,1,C.death_date)", None, "cause_source_concept_id"),
+}
+
+# the attributes of a criteria that are supported, next to the source concept
+_CRITERIA_ATTRIBUTES = {"CodesetId", "First", "OccurrenceStartDate",
+                        "OccurrenceEndDate", "Age", "Gender"}
+
+_OPERATORS = {"lt": "<", "lte": "<=", "eq": "=", "!eq": "<>", "gt": ">",
+              "gte": ">="}
+
+# Occurrence.Type of a correlated criteria: exactly, at most, at least
+_OCCURRENCE = {0: "=", 1: "<=", 2: ">="}
+
+_COUNT_COLUMNS = {"DOMAIN_CONCEPT": "domain_concept_id",
+                  "START_DATE": "start_date",
+                  "VISIT_ID": "visit_occurrence_id"}
+
+_TEMP_TABLES = ["#inclusion_events", "#qualified_events", "#included_events",
+                "#Codesets", "#cohort_rows", "#final_cohort",
+                "#inclusion_rules"]
+
+
+def _unsupported(element: str) -> NotImplementedError:
+    return NotImplementedError(
+        f"{element} is not supported by the Python cohort SQL builder, "
+        "build this cohort with CirceR (engine='r')")
+
+
+def _indent(sql: str, spaces: int = 2) -> str:
+    return "\n".join(" " * spaces + line if line else line
+                     for line in sql.splitlines())
+
+
+def _sort(limit: dict | None) -> str:
+    return "DESC" if (limit or {}).get("Type") == "Last" else "ASC"
+
+
+def _limit_filter(limit: dict | None, alias: str) -> str:
+    if (limit or {}).get("Type", "First") == "All":
+        return ""
+    return f"WHERE {alias}.ordinal = 1"
+
+
+def _date_literal(value: str) -> str:
+    day = date.fromisoformat(value[:10])
+    return f"DATEFROMPARTS({day.year}, {day.month}, {day.day})"
+
+
+def _range(expression: str, value_range: dict, literal=str) -> str:
+    op = value_range.get("Op")
+    value = literal(value_range["Value"])
+    if op in _OPERATORS:
+        return f"{expression} {_OPERATORS[op]} {value}"
+    if op in ("bt", "!bt"):
+        extent = literal(value_range["Extent"])
+        clause = f"({expression} >= {value} and {expression} <= {extent})"
+        return f"not {clause}" if op == "!bt" else clause
+    raise _unsupported(f"The range operator {op!r}")
+
+
+def _concepts(concepts: list[dict]) -> str:
+    return ",".join(str(c["CONCEPT_ID"]) for c in concepts)
+
+
+# -----------------------------------------------------------------------------
+# concept sets
+# -----------------------------------------------------------------------------
+def _items_sql(items: list[dict]) -> str:
+    """ The concepts of the items and their descendants, when included """
+    sql = ("select concept_id from @vocabulary_database_schema.CONCEPT "
+           f"where concept_id in ({_concepts(i['concept'] for i in items)})")
+    descendants = [i["concept"] for i in items if i.get("includeDescendants")]
+    if descendants:
+        sql += f"""
+UNION  select c.concept_id
+  from @vocabulary_database_schema.CONCEPT c
+  join @vocabulary_database_schema.CONCEPT_ANCESTOR ca on c.concept_id = ca.descendant_concept_id
+  and ca.ancestor_concept_id in ({_concepts(descendants)})
+  and c.invalid_reason is null"""
+    return sql
+
+
+def _mapped_sql(items: list[dict]) -> str:
+    return f"""select distinct cr.concept_id_1 as concept_id
+FROM
+(
+{_indent(_items_sql(items))}
+) C
+join @vocabulary_database_schema.concept_relationship cr on C.concept_id = cr.concept_id_2 and cr.relationship_id = 'Maps to' and cr.invalid_reason IS NULL"""
+
+
+def _excluding(included: str, excluded: str | None) -> str:
+    sql = f"""select distinct I.concept_id FROM
+(
+{_indent(included)}
+) I"""
+    if excluded:
+        sql += f"""
+LEFT JOIN
+(
+{_indent(excluded)}
+) E ON I.concept_id = E.concept_id
+WHERE E.concept_id is null"""
+    return sql
+
+
+def concept_set_expression_sql(expression: dict | str) -> str:
+    """
+    The OHDSI SQL that selects the concept ids of a concept set expression
+
+    Parameters
+    ----------
+    expression : dict | str
+        The concept set expression (with the ``items``), as dict or JSON
+
+    Returns
+    -------
+    str
+        A query with a single ``concept_id`` column, which refers to the
+        vocabulary tables by ``@vocabulary_database_schema``
+    """
+    if isinstance(expression, str):
+        expression = json.loads(expression)
+    items = expression.get("items", [])
+    included = [i for i in items if not i.get("isExcluded")]
+    excluded = [i for i in items if i.get("isExcluded")]
+    if not included:
+        return ("select concept_id from @vocabulary_database_schema.CONCEPT "
+                "where 0=1")
+
+    sql = _excluding(_items_sql(included),
+                     _items_sql(excluded) if excluded else None)
+    mapped = [i for i in included if i.get("includeMapped")]
+    if mapped:
+        excluded_mapped = [i for i in excluded if i.get("includeMapped")]
+        sql += "\nUNION\n" + _excluding(
+            _mapped_sql(mapped),
+            _mapped_sql(excluded_mapped) if excluded_mapped else None)
+    return sql
+
+
+def _resolved_codesets_sql(codesets: dict[int, list[int]]) -> str:
+    """ Insert resolved codesets, in statements of at most 1000 rows """
+    rows = [f"({codeset_id}, {concept_id})"
+            for codeset_id, concept_ids in codesets.items()
+            for concept_id in concept_ids]
+    return "".join(
+        "\nINSERT INTO #Codesets (codeset_id, concept_id) VALUES "
+        + ",".join(rows[start:start + 1000]) + ";\n"
+        for start in range(0, len(rows), 1000))
+
+
+def _codesets_sql(concept_sets: list[dict],
+                  codesets: dict[int, list[int]] | None = None) -> str:
+    if codesets is not None:
+        missing = {c["id"] for c in concept_sets} - set(codesets)
+        if missing:
+            raise ValueError(f"No resolved codesets for concept set(s) "
+                             f"{sorted(missing)}")
+    selects = [
+        f"SELECT {concept_set['id']} as codeset_id, c.concept_id FROM (\n"
+        f"{_indent(concept_set_expression_sql(concept_set['expression']))}"
+        "\n) C"
+        for concept_set in concept_sets
+        if codesets is None and any(
+            not i.get("isExcluded")
+            for i in concept_set["expression"].get("items", []))
+    ]
+    sql = """CREATE TABLE #Codesets (
+  codeset_id int NOT NULL,
+  concept_id bigint NOT NULL
+)
+;
+"""
+    if selects:
+        sql += ("\nINSERT INTO #Codesets (codeset_id, concept_id)\n"
+                + "\nUNION ALL\n".join(selects) + ";\n")
+    if codesets is not None:
+        sql += _resolved_codesets_sql(codesets)
+    return sql + "\nUPDATE STATISTICS #Codesets;\n"
+
+
+# -----------------------------------------------------------------------------
+# criteria
+# -----------------------------------------------------------------------------
+def _criteria_sql(criteria: dict) -> str:
+    """ The events of a criteria, with the columns of Circe's criteria """
+    if len(criteria) != 1:
+        raise ValueError(f"A criteria has a single type, got {list(criteria)}")
+    ((name, attributes),) = criteria.items()
+    if name not in _DOMAINS:
+        raise _unsupported(f"The {name} criteria")
+    table, event_id, concept, start, end, visit, source = _DOMAINS[name]
+    source_attribute = name.removesuffix("Occurrence").removesuffix(
+        "Exposure") + "SourceConcept"
+    for attribute, value in attributes.items():
+        if attribute not in _CRITERIA_ATTRIBUTES | {source_attribute} \
+                and value not in (None, [], {}, False):
+            raise _unsupported(f"The {attribute} attribute of {name}")
+
+    joins = []
+    if attributes.get("CodesetId") is not None:
+        joins.append(f"JOIN #Codesets cs on (d.{concept} = cs.concept_id "
+                     f"and cs.codeset_id = {attributes['CodesetId']})")
+    if attributes.get(source_attribute) is not None:
+        joins.append(f"JOIN #Codesets scs on (d.{source} = scs.concept_id "
+                     f"and scs.codeset_id = {attributes[source_attribute]})")
+    ordinal = ""
+    if attributes.get("First"):
+        ordinal = (f", row_number() over (PARTITION BY d.person_id ORDER BY "
+                   f"d.{start}, d.{event_id}) as ordinal")
+
+    where = []
+    if attributes.get("First"):
+        where.append("C.ordinal = 1")
+    if attributes.get("OccurrenceStartDate"):
+        where.append(_range(f"C.{start}", attributes["OccurrenceStartDate"],
+                            _date_literal))
+    if attributes.get("OccurrenceEndDate"):
+        where.append(_range(end, attributes["OccurrenceEndDate"],
+                            _date_literal))
+    person = ""
+    if attributes.get("Age") or attributes.get("Gender"):
+        person = ("JOIN @cdm_database_schema.PERSON P on C.person_id = "
+                  "P.person_id\n")
+        if attributes.get("Age"):
+            where.append(_range(f"YEAR(C.{start}) - P.year_of_birth",
+                                attributes["Age"]))
+        if attributes.get("Gender"):
+            where.append(f"P.gender_concept_id in "
+                         f"({_concepts(attributes['Gender'])})")
+
+    visit = f"C.{visit}" if visit else "CAST(NULL as bigint)"
+    where = f"WHERE {' AND '.join(where)}\n" if where else ""
+    inner = "\n".join([f"SELECT d.*{ordinal}",
+                       f"FROM @cdm_database_schema.{table} d", *joins])
+    return f"""-- Begin {name} Criteria
+select C.person_id, C.{event_id} as event_id, C.{start} as start_date, {end} as end_date,
+  {visit} as visit_occurrence_id, C.{start} as sort_date, C.{concept} as domain_concept_id
+FROM
+(
+{_indent(inner)}
+) C
+{person}{where}-- End {name} Criteria
+"""
+
+
+def _window_clauses(window: dict | None, event_date: str, index: str,
+                    check_observation_period: bool) -> list[str]:
+    if not window:
+        return []
+    clauses = []
+    for bound, op in (("Start", ">="), ("End", "<=")):
+        endpoint = window.get(bound) or {}
+        coeff = endpoint.get("Coeff", -1)
+        if endpoint.get("Days") is not None:
+            expression = f"DATEADD(day,{endpoint['Days'] * coeff},{index})"
+        elif check_observation_period:
+            expression = "P.OP_START_DATE" if coeff == -1 else "P.OP_END_DATE"
+        else:
+            continue
+        clauses.append(f"{event_date} {op} {expression}")
+    return clauses
+
+
+def _correlated_sql(correlated: dict, event_table: str, index_id: int) -> str:
+    """ The events with the required occurrences of a correlated criteria """
+    check_observation_period = not correlated.get("IgnoreObservationPeriod")
+    clauses = []
+    if check_observation_period:
+        clauses += ["A.START_DATE >= P.OP_START_DATE",
+                    "A.START_DATE <= P.OP_END_DATE"]
+    # like Circe, an end window without UseEventEnd uses the event end date
+    for key, event_end in (("StartWindow", False), ("EndWindow", True)):
+        window = correlated.get(key)
+        index = "P.END_DATE" if (window or {}).get("UseIndexEnd") \
+            else "P.START_DATE"
+        if (window or {}).get("UseEventEnd") is not None:
+            event_end = window["UseEventEnd"]
+        event_date = "A.END_DATE" if event_end else "A.START_DATE"
+        clauses += _window_clauses(window, event_date, index,
+                                   check_observation_period)
+    if correlated.get("RestrictVisit"):
+        clauses.append("A.visit_occurrence_id = P.visit_occurrence_id")
+
+    occurrence = correlated.get("Occurrence") or {"Type": 2, "Count": 1}
+    count = "cc.event_id"
+    if occurrence.get("IsDistinct"):
+        column = occurrence.get("CountColumn") or "DOMAIN_CONCEPT"
+        if column not in _COUNT_COLUMNS:
+            raise _unsupported(f"Counting distinct {column}")
+        count = f"DISTINCT cc.{_COUNT_COLUMNS[column]}"
+
+    conditions = " AND ".join(["A.person_id = P.person_id", *clauses])
+    return f"""-- Begin Correlated Criteria
+select {index_id} as index_id, p.person_id, p.event_id
+from {event_table} p
+LEFT JOIN (
+SELECT p.person_id, p.event_id, A.domain_concept_id, A.start_date, A.visit_occurrence_id
+FROM {event_table} P
+JOIN (
+{_criteria_sql(correlated['Criteria'])}
+) A on {conditions}
+) cc on p.person_id = cc.person_id and p.event_id = cc.event_id
+GROUP BY p.person_id, p.event_id
+HAVING COUNT({count}) {_OCCURRENCE[occurrence.get('Type', 2)]} {occurrence.get('Count', 1)}
+-- End Correlated Criteria
+"""
+
+
+def _group_sql(group: dict, event_table: str, index_id: int = 0) -> str:
+    """ The events that satisfy a criteria group """
+    if group.get("DemographicCriteriaList"):
+        raise _unsupported("DemographicCriteriaList")
+    queries = [_correlated_sql(c, event_table, i)
+               for i, c in enumerate(group.get("CriteriaList") or [])]
+    offset = len(queries)
+    queries += [_group_sql(g, event_table, offset + i)
+                for i, g in enumerate(group.get("Groups") or [])]
+    if not queries:
+        return f"select {index_id} as index_id, person_id, event_id " \
+               f"FROM {event_table}"
+
+    group_type = group.get("Type", "ALL")
+    having = {"ALL": f"= {len(queries)}", "ANY": "> 0",
+              "AT_LEAST": f">= {group.get('Count')}",
+              "AT_MOST": f"<= {group.get('Count')}"}.get(group_type)
+    if having is None:
+        raise _unsupported(f"The criteria group type {group_type}")
+    criteria = "\n\nUNION ALL\n\n".join(queries)
+    return f"""-- Begin Criteria Group
+select {index_id} as index_id, person_id, event_id
+FROM
+(
+  select E.person_id, E.event_id
+  FROM {event_table} E
+  {"LEFT " if group_type == "AT_MOST" else ""}JOIN
+  (
+{_indent(criteria, 4)}
+  ) CQ on E.person_id = CQ.person_id and E.event_id = CQ.event_id
+  GROUP BY E.person_id, E.event_id
+  HAVING COUNT(index_id) {having}
+) G
+-- End Criteria Group
+"""
+
+
+# -----------------------------------------------------------------------------
+# cohort
+# -----------------------------------------------------------------------------
+def _primary_events_sql(primary: dict) -> str:
+    window = primary.get("ObservationWindow") or {}
+    criteria = "\nUNION ALL\n".join(
+        _criteria_sql(c) for c in primary["CriteriaList"])
+    limit = primary.get("PrimaryCriteriaLimit")
+    return f"""-- Begin Primary Events
+select P.ordinal as event_id, P.person_id, P.start_date, P.end_date, op_start_date, op_end_date, cast(P.visit_occurrence_id as bigint) as visit_occurrence_id
+FROM
+(
+  select E.person_id, E.start_date, E.end_date,
+         row_number() OVER (PARTITION BY E.person_id ORDER BY E.sort_date {_sort(limit)}, E.event_id) ordinal,
+         OP.observation_period_start_date as op_start_date, OP.observation_period_end_date as op_end_date, cast(E.visit_occurrence_id as bigint) as visit_occurrence_id
+  FROM
+  (
+{_indent(criteria, 2)}
+  ) E
+	JOIN @cdm_database_schema.observation_period OP on E.person_id = OP.person_id and E.start_date >=  OP.observation_period_start_date and E.start_date <= op.observation_period_end_date
+  WHERE DATEADD(day,{window.get('PriorDays', 0)},OP.OBSERVATION_PERIOD_START_DATE) <= E.START_DATE AND DATEADD(day,{window.get('PostDays', 0)},E.START_DATE) <= OP.OBSERVATION_PERIOD_END_DATE
+) P
+{_limit_filter(limit, "P")}
+-- End Primary Events
+"""
+
+
+def _qualified_events_sql(expression: dict) -> str:
+    additional = ""
+    if expression.get("AdditionalCriteria"):
+        additional = f"""JOIN (
+{_group_sql(expression["AdditionalCriteria"], "primary_events")}
+) AC on AC.person_id = pe.person_id and AC.event_id = pe.event_id
+"""
+    limit = expression.get("QualifiedLimit")
+    return f"""with primary_events (event_id, person_id, start_date, end_date, op_start_date, op_end_date, visit_occurrence_id) as
+(
+{_primary_events_sql(expression["PrimaryCriteria"])}
+)
+SELECT event_id, person_id, start_date, end_date, op_start_date, op_end_date, visit_occurrence_id
+INTO #qualified_events
+FROM
+(
+  select pe.event_id, pe.person_id, pe.start_date, pe.end_date, pe.op_start_date, pe.op_end_date, row_number() over (partition by pe.person_id order by pe.start_date {_sort(limit)}) as ordinal, cast(pe.visit_occurrence_id as bigint) as visit_occurrence_id
+  FROM primary_events pe
+{additional}) QE
+{_limit_filter(limit, "QE")}
+;
+"""
+
+
+def _inclusion_sql(rules: list[dict]) -> str:
+    if not rules:
+        return ("create table #inclusion_events (inclusion_rule_id bigint,\n"
+                "\tperson_id bigint,\n\tevent_id bigint\n);\n")
+    sql = ""
+    for i, rule in enumerate(rules):
+        sql += f"""
+-- Create inclusion rule temp table: {rule.get("name", "")}
+select {i} as inclusion_rule_id, person_id, event_id
+INTO #Inclusion_{i}
+FROM
+(
+  select pe.person_id, pe.event_id
+  FROM #qualified_events pe
+  JOIN (
+{_group_sql(rule["expression"], "#qualified_events")}
+  ) AC on AC.person_id = pe.person_id AND AC.event_id = pe.event_id
+) Results
+;
+"""
+    unions = "\nUNION ALL\n".join(
+        f"select inclusion_rule_id, person_id, event_id from #Inclusion_{i}"
+        for i in range(len(rules)))
+    sql += f"""
+SELECT inclusion_rule_id, person_id, event_id
+INTO #inclusion_events
+FROM ({unions}) I;
+"""
+    for i in range(len(rules)):
+        sql += f"TRUNCATE TABLE #Inclusion_{i};\nDROP TABLE #Inclusion_{i};\n"
+    return sql
+
+
+def _included_events_sql(expression: dict) -> str:
+    rules = len(expression.get("InclusionRules") or [])
+    limit = expression.get("ExpressionLimit")
+    mask = ""
+    if rules:
+        mask = ("  -- the matching group with all bits set\n"
+                f"  WHERE (MG.inclusion_rule_mask = "
+                f"POWER(cast(2 as bigint),{rules})-1)\n")
+    return f"""with cteIncludedEvents(event_id, person_id, start_date, end_date, op_start_date, op_end_date, ordinal) as
+(
+  SELECT event_id, person_id, start_date, end_date, op_start_date, op_end_date, row_number() over (partition by person_id order by start_date {_sort(limit)}) as ordinal
+  from
+  (
+    select Q.event_id, Q.person_id, Q.start_date, Q.end_date, Q.op_start_date, Q.op_end_date, SUM(coalesce(POWER(cast(2 as bigint), I.inclusion_rule_id), 0)) as inclusion_rule_mask
+    from #qualified_events Q
+    LEFT JOIN #inclusion_events I on I.person_id = Q.person_id and I.event_id = Q.event_id
+    GROUP BY Q.event_id, Q.person_id, Q.start_date, Q.end_date, Q.op_start_date, Q.op_end_date
+  ) MG -- matching groups
+{mask})
+select event_id, person_id, start_date, end_date, op_start_date, op_end_date
+into #included_events
+FROM cteIncludedEvents Results
+{_limit_filter(limit, "Results")}
+;
+"""
+
+
+def _date_offset_sql(strategy: dict) -> str:
+    field = {"StartDate": "start_date", "EndDate": "end_date"}.get(
+        strategy.get("DateField", "StartDate"))
+    if field is None:
+        raise _unsupported(f"The date field {strategy.get('DateField')}")
+    end = f"DATEADD(day,{strategy.get('Offset', 0)},{field})"
+    return f"""-- date offset strategy
+
+select event_id, person_id,
+  case when {end} > op_end_date then op_end_date else {end} end as end_date
+INTO #strategy_ends
+from #included_events;
+"""
+
+
+def _custom_era_sql(strategy: dict) -> str:
+    if strategy.get("DaysSupplyOverride") is not None:
+        raise _unsupported("The DaysSupplyOverride of a custom era")
+    codeset = strategy["DrugCodesetId"]
+    gap = strategy.get("GapDays", 0)
+    drugs = "\n\tUNION ALL\n".join(f"""\
+	select de.PERSON_ID, DRUG_EXPOSURE_START_DATE, COALESCE(DRUG_EXPOSURE_END_DATE, DATEADD(day,DAYS_SUPPLY,DRUG_EXPOSURE_START_DATE), DATEADD(day,1,DRUG_EXPOSURE_START_DATE)) as DRUG_EXPOSURE_END_DATE
+	FROM @cdm_database_schema.DRUG_EXPOSURE de
+	JOIN ctePersons p on de.person_id = p.person_id
+	JOIN #Codesets cs on cs.codeset_id = {codeset} AND de.{column} = cs.concept_id
+""" for column in ("drug_concept_id", "drug_source_concept_id"))
+    return f"""-- custom era strategy
+
+with ctePersons(person_id) as (
+	select distinct person_id from #included_events
+)
+
+select person_id, drug_exposure_start_date, drug_exposure_end_date
+INTO #drugTarget
+FROM (
+{drugs}) E
+;
+
+select et.event_id, et.person_id, ERAS.era_end_date as end_date
+INTO #strategy_ends
+from #included_events et
+JOIN
+(
+  select ENDS.person_id, min(drug_exposure_start_date) as era_start_date, DATEADD(day,{strategy.get('Offset', 0)}, ENDS.era_end_date) as era_end_date
+  from
+  (
+    select de.person_id, de.drug_exposure_start_date, MIN(e.END_DATE) as era_end_date
+    FROM #drugTarget DE
+    JOIN
+    (
+      --cteEndDates
+      select PERSON_ID, DATEADD(day,-1 * {gap},EVENT_DATE) as END_DATE -- unpad the end date by {gap}
+      FROM
+      (
+        select PERSON_ID, EVENT_DATE, EVENT_TYPE,
+        MAX(START_ORDINAL) OVER (PARTITION BY PERSON_ID ORDER BY event_date, event_type ROWS UNBOUNDED PRECEDING) AS start_ordinal,
+        ROW_NUMBER() OVER (PARTITION BY PERSON_ID ORDER BY EVENT_DATE, EVENT_TYPE) AS OVERALL_ORD -- this re-numbers the inner UNION so all rows are numbered ordered by the event date
+        from
+        (
+          -- select the start dates, assigning a row number to each
+          Select PERSON_ID, DRUG_EXPOSURE_START_DATE AS EVENT_DATE, 0 as EVENT_TYPE, ROW_NUMBER() OVER (PARTITION BY PERSON_ID ORDER BY DRUG_EXPOSURE_START_DATE) as START_ORDINAL
+          from #drugTarget D
+
+          UNION ALL
+
+          -- add the end dates with NULL as the row number, padding the end dates by {gap} to allow a grace period for overlapping ranges.
+          select PERSON_ID, DATEADD(day,{gap},DRUG_EXPOSURE_END_DATE), 1 as EVENT_TYPE, NULL
+          FROM #drugTarget D
+        ) RAWDATA
+      ) E
+      WHERE 2 * E.START_ORDINAL - E.OVERALL_ORD = 0
+    ) E on DE.PERSON_ID = E.PERSON_ID and E.END_DATE >= DE.DRUG_EXPOSURE_START_DATE
+    GROUP BY de.person_id, de.drug_exposure_start_date
+  ) ENDS
+  GROUP BY ENDS.person_id, ENDS.era_end_date
+) ERAS on ERAS.person_id = et.person_id
+WHERE et.start_date between ERAS.era_start_date and ERAS.era_end_date;
+
+TRUNCATE TABLE #drugTarget;
+DROP TABLE #drugTarget;
+"""
+
+
+def _end_strategy_sql(strategy: dict | None) -> tuple[str, str]:
+    """ The SQL of the end strategy, and the #strategy_ends cleanup """
+    if not strategy:
+        return "", ""
+    if "DateOffset" in strategy:
+        sql = _date_offset_sql(strategy["DateOffset"])
+    elif "CustomEra" in strategy:
+        sql = _custom_era_sql(strategy["CustomEra"])
+    else:
+        raise _unsupported(f"The end strategy {list(strategy)}")
+    return sql, "TRUNCATE TABLE #strategy_ends;\nDROP TABLE #strategy_ends;\n"
+
+
+def _cohort_ends_sql(expression: dict) -> str:
+    if expression.get("EndStrategy"):
+        ends = ["-- End Date Strategy\n"
+                "SELECT event_id, person_id, end_date from #strategy_ends"]
+    else:
+        ends = ["-- By default, cohort exit at the event's op end date\n"
+                "select event_id, person_id, op_end_date as end_date "
+                "from #included_events"]
+    for criteria in expression.get("CensoringCriteria") or []:
+        ends.append(f"""-- Censor Events
+select i.event_id, i.person_id, MIN(c.start_date) as end_date
+FROM #included_events i
+JOIN
+(
+{_criteria_sql(criteria)}
+) C on C.person_id = I.person_id and C.start_date >= I.start_date and C.START_DATE <= I.op_end_date
+GROUP BY i.event_id, i.person_id
+""")
+    return "\nUNION ALL\n".join(ends)
+
+
+def _final_cohort_sql(censor_window: dict | None) -> tuple[str, str]:
+    """ The select of the cohort rows, and its censor window filter """
+    start, end, where = "CO.start_date", "CO.end_date", []
+    window = censor_window or {}
+    if window.get("StartDate"):
+        literal = _date_literal(window["StartDate"])
+        start = (f"CASE WHEN CO.start_date > {literal} THEN CO.start_date "
+                 f"ELSE {literal} END")
+        where.append(f"CO.end_date >= {literal}")
+    if window.get("EndDate"):
+        literal = _date_literal(window["EndDate"])
+        end = (f"CASE WHEN CO.end_date < {literal} THEN CO.end_date "
+               f"ELSE {literal} END")
+        where.append(f"CO.start_date <= {literal}")
+    where = f"WHERE {' AND '.join(where)}\n" if where else ""
+    return (f"select @target_cohort_id as @cohort_id_field_name, person_id, "
+            f"{start}, {end}\nFROM #final_cohort CO\n{where}")
+
+
+def _inclusion_stats_sql(mode_id: int, events: str) -> str:
+    return f"""-- calculate matching group counts
+delete from @results_database_schema.cohort_inclusion_result where @cohort_id_field_name = @target_cohort_id and mode_id = {mode_id};
+insert into @results_database_schema.cohort_inclusion_result (@cohort_id_field_name, inclusion_rule_mask, person_count, mode_id)
+select @target_cohort_id as @cohort_id_field_name, inclusion_rule_mask, COUNT_BIG(*) as person_count, {mode_id} as mode_id
+from
+(
+  select Q.person_id, Q.event_id, CAST(SUM(coalesce(POWER(cast(2 as bigint), I.inclusion_rule_id), 0)) AS bigint) as inclusion_rule_mask
+  from {events} Q
+  LEFT JOIN #inclusion_events I on q.person_id = i.person_id and q.event_id = i.event_id
+  GROUP BY Q.person_id, Q.event_id
+) MG -- matching groups
+group by inclusion_rule_mask
+;
+
+-- calculate gain counts
+delete from @results_database_schema.cohort_inclusion_stats where @cohort_id_field_name = @target_cohort_id and mode_id = {mode_id};
+insert into @results_database_schema.cohort_inclusion_stats (@cohort_id_field_name, rule_sequence, person_count, gain_count, person_total, mode_id)
+select @target_cohort_id as @cohort_id_field_name, ir.rule_sequence, coalesce(T.person_count, 0) as person_count, coalesce(SR.person_count, 0) gain_count, EventTotal.total, {mode_id} as mode_id
+from #inclusion_rules ir
+left join
+(
+  select i.inclusion_rule_id, COUNT_BIG(i.event_id) as person_count
+  from {events} Q
+  JOIN #inclusion_events i on Q.person_id = I.person_id and Q.event_id = i.event_id
+  group by i.inclusion_rule_id
+) T on ir.rule_sequence = T.inclusion_rule_id
+CROSS JOIN (select count(*) as total_rules from #inclusion_rules) RuleTotal
+CROSS JOIN (select COUNT_BIG(event_id) as total from {events}) EventTotal
+LEFT JOIN @results_database_schema.cohort_inclusion_result SR on SR.mode_id = {mode_id} AND SR.@cohort_id_field_name = @target_cohort_id AND (POWER(cast(2 as bigint),RuleTotal.total_rules) - POWER(cast(2 as bigint),ir.rule_sequence) - 1) = SR.inclusion_rule_mask -- POWER(2,rule count) - 1 = mask for all rules
+;
+
+-- calculate totals
+delete from @results_database_schema.cohort_summary_stats where @cohort_id_field_name = @target_cohort_id and mode_id = {mode_id};
+insert into @results_database_schema.cohort_summary_stats (@cohort_id_field_name, base_count, final_count, mode_id)
+select @target_cohort_id as @cohort_id_field_name, PC.total as person_count, coalesce(FC.total, 0) as final_count, {mode_id} as mode_id
+FROM
+(select COUNT_BIG(event_id) as total from {events}) PC,
+(select sum(sr.person_count) as total
+  from @results_database_schema.cohort_inclusion_result sr
+  CROSS JOIN (select count(*) as total_rules from #inclusion_rules) RuleTotal
+  where sr.mode_id = {mode_id} and sr.@cohort_id_field_name = @target_cohort_id and sr.inclusion_rule_mask = POWER(cast(2 as bigint),RuleTotal.total_rules)-1
+) FC
+;
+"""
+
+
+def _stats_sql(rules: int) -> str:
+    sequences = "\nUNION ALL ".join(
+        f"SELECT CAST({i} AS INT) as rule_sequence" for i in range(rules))
+    inclusion_rules = "CREATE TABLE #inclusion_rules (rule_sequence INT);\n"
+    if rules:
+        inclusion_rules += (f"INSERT INTO #inclusion_rules (rule_sequence)\n"
+                            f"{sequences};\n")
+    return f"""{inclusion_rules}
+-- Find the event that is the 'best match' per person.
+-- the 'best match' is defined as the event that satisfies the most inclusion rules.
+-- ties are solved by choosing the event that matches the earliest inclusion rule, and then earliest.
+
+select q.person_id, q.event_id
+into #best_events
+from #qualified_events Q
+join (
+	SELECT R.person_id, R.event_id, ROW_NUMBER() OVER (PARTITION BY R.person_id ORDER BY R.rule_count DESC,R.min_rule_id ASC, R.start_date ASC) AS rank_value
+	FROM (
+		SELECT Q.person_id, Q.event_id, COALESCE(COUNT(DISTINCT I.inclusion_rule_id), 0) AS rule_count, COALESCE(MIN(I.inclusion_rule_id), 0) AS min_rule_id, Q.start_date
+		FROM #qualified_events Q
+		LEFT JOIN #inclusion_events I ON q.person_id = i.person_id AND q.event_id = i.event_id
+		GROUP BY Q.person_id, Q.event_id, Q.start_date
+	) R
+) ranked on Q.person_id = ranked.person_id and Q.event_id = ranked.event_id
+WHERE ranked.rank_value = 1
+;
+
+-- modes of generation: (the same tables store the results for the different modes, identified by the mode_id column)
+-- 0: all events
+-- 1: best event
+
+-- BEGIN: Inclusion Impact Analysis - event
+{_inclusion_stats_sql(0, "#qualified_events")}
+-- END: Inclusion Impact Analysis - event
+
+-- BEGIN: Inclusion Impact Analysis - person
+{_inclusion_stats_sql(1, "#best_events")}
+-- END: Inclusion Impact Analysis - person
+
+TRUNCATE TABLE #best_events;
+DROP TABLE #best_events;
+"""
+
+
+def _censor_stats_sql() -> str:
+    return """delete from @results_database_schema.cohort_censor_stats where @cohort_id_field_name = @target_cohort_id;
+insert into @results_database_schema.cohort_censor_stats (@cohort_id_field_name, lost_count)
+select @target_cohort_id as @cohort_id_field_name, coalesce(FCC.total_records - CC.total_records, 0) as lost_count
+FROM
+(select COUNT_BIG(*) as total_records from #final_cohort) FCC,
+(select COUNT_BIG(*) as total_records from @target_database_schema.@target_cohort_table where @cohort_id_field_name = @target_cohort_id) CC
+;
+"""
+
+
+def build_cohort_sql(
+    expression: dict | str,
+    cohort_id_field_name: str | None = None,
+    cohort_id: int | None = None,
+    cdm_schema: str | None = None,
+    target_table: str | None = None,
+    result_schema: str | None = None,
+    vocabulary_schema: str | None = None,
+    generate_stats: bool = False,
+    codesets: dict[int, list[int]] | None = None
+) -> str:
+    """
+    Build the OHDSI SQL that generates a cohort
+
+    The options are those of ``create_generate_options``; the parameters of
+    options that are not given are left in the SQL, to be rendered later.
+
+    Parameters
+    ----------
+    expression : dict | str
+        The cohort expression, as dict or JSON
+    cohort_id_field_name : str, optional
+        The field that contains the cohortId in the cohort table, by default
+        "cohort_definition_id"
+    cohort_id : int, optional
+        The generated cohort ID
+    cdm_schema : str, optional
+        The CDM schema
+    target_table : str, optional
+        The cohort table, including its schema
+    result_schema : str, optional
+        The schema of the inclusion rule statistics tables
+    vocabulary_schema : str, optional
+        The schema of the vocabulary tables, by default the CDM schema
+    generate_stats : bool, optional
+        Whether the SQL computes the inclusion rule statistics, by default
+        False
+    codesets : dict[int, list[int]], optional
+        The concept ids of each concept set, e.g. resolved on a
+        ``VocabularyIndex``. These are inserted into ``#Codesets`` instead
+        of being expanded on the database.
+
+    Returns
+    -------
+    str
+        The OHDSI SQL of the cohort
+
+    Raises
+    ------
+    NotImplementedError
+        When the expression uses criteria that are not supported
+    """
+    if isinstance(expression, str):
+        expression = json.loads(expression)
+    rules = expression.get("InclusionRules") or []
+    strategy_sql, strategy_cleanup = _end_strategy_sql(
+        expression.get("EndStrategy"))
+    era_pad = (expression.get("CollapseSettings") or {}).get("EraPad", 0)
+
+    sql = f"""{_codesets_sql(expression.get("ConceptSets") or [], codesets)}
+{_qualified_events_sql(expression)}
+--- Inclusion Rule Inserts
+{_inclusion_sql(rules)}
+{_included_events_sql(expression)}
+{strategy_sql}
+-- generate cohort periods into #final_cohort
+select person_id, start_date, end_date
+INTO #cohort_rows
+from ( -- first_ends
+	select F.person_id, F.start_date, F.end_date
+	FROM (
+	  select I.event_id, I.person_id, I.start_date, CE.end_date, row_number() over (partition by I.person_id, I.event_id order by CE.end_date) as ordinal
+	  from #included_events I
+	  join ( -- cohort_ends
+{_indent(_cohort_ends_sql(expression))}
+	  ) CE on I.event_id = CE.event_id and I.person_id = CE.person_id and CE.end_date >= I.start_date
+	) F
+	WHERE F.ordinal = 1
+) FE;
+
+select person_id, min(start_date) as start_date, DATEADD(day,-1 * {era_pad}, max(end_date)) as end_date
+into #final_cohort
+from (
+  select person_id, start_date, end_date, sum(is_start) over (partition by person_id order by start_date, is_start desc rows unbounded preceding) group_idx
+  from (
+    select person_id, start_date, end_date,
+      case when max(end_date) over (partition by person_id order by start_date rows between unbounded preceding and 1 preceding) >= start_date then 0 else 1 end is_start
+    from (
+      select person_id, start_date, DATEADD(day,{era_pad},end_date) as end_date
+      from #cohort_rows
+    ) CR
+  ) ST
+) GR
+group by person_id, group_idx;
+
+DELETE FROM @target_database_schema.@target_cohort_table where @cohort_id_field_name = @target_cohort_id;
+INSERT INTO @target_database_schema.@target_cohort_table (@cohort_id_field_name, subject_id, cohort_start_date, cohort_end_date)
+{_final_cohort_sql(expression.get("CensorWindow"))};
+"""
+    if generate_stats:
+        sql += f"\n{_stats_sql(len(rules))}\n{_censor_stats_sql()}"
+    sql += f"\n{strategy_cleanup}"
+    for table in _TEMP_TABLES:
+        if table != "#inclusion_rules" or generate_stats:
+            sql += f"\nTRUNCATE TABLE {table};\nDROP TABLE {table};\n"
+
+    # the options are substituted like Circe does
+    replacements = [
+        ("@cdm_database_schema", cdm_schema),
+        ("@target_database_schema.@target_cohort_table", target_table),
+        ("@results_database_schema", result_schema),
+        ("@vocabulary_database_schema", vocabulary_schema or cdm_schema),
+        ("@target_cohort_id",
+         str(cohort_id) if cohort_id is not None else None),
+        ("@cohort_id_field_name",
+         cohort_id_field_name or "cohort_definition_id"),
+    ]
+    for parameter, value in replacements:
+        if value is not None:
+            sql = sql.replace(parameter, value)
+    return sql
@@ -0,0 +1,387 @@
+"""
+Concept set expansion on a local vocabulary index
+
+The SQL of ``build_concept_set_query`` and of the ``#Codesets`` of a cohort
+expands concept sets on the database, scanning ``concept_ancestor`` and
+``concept_relationship`` again for every cohort. A ``VocabularyIndex`` is a
+SQLite snapshot of the parts of these tables that the expansion needs, with
+indexes on the ancestors and mapped concepts. Concept set expressions are
+resolved to concept ids on this snapshot and the results are cached by the
+hash of the expression and the vocabulary version, so resolving a concept
+set that is used by many cohorts is a lookup. The resolved codesets can be
+passed to ``build_cohort_sql``, which then inserts them into ``#Codesets``
+instead of expanding them on the database.
+
+Without a snapshot, ``resolve_concept_sets`` resolves many concept sets on
+the database at once, expanding each distinct expression only once.
+"""
+from __future__ import annotations
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+from pathlib import Path
+
+import pandas as pd
+
+from ohdsi.circe.builder import concept_set_expression_sql
+
+_SCHEMA = """
+CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE concept (concept_id INTEGER PRIMARY KEY, valid INTEGER);
+CREATE TABLE concept_ancestor (ancestor_concept_id INTEGER,
+                               descendant_concept_id INTEGER);
+CREATE TABLE maps_to (concept_id_1 INTEGER, concept_id_2 INTEGER);
+CREATE TABLE resolved (expression_hash TEXT, vocabulary_version TEXT,
+                       concept_ids TEXT,
+                       PRIMARY KEY (expression_hash, vocabulary_version));
+"""
+
+_INDEXES = """
+CREATE INDEX idx_concept_ancestor ON concept_ancestor (ancestor_concept_id);
+CREATE INDEX idx_maps_to ON maps_to (concept_id_2);
+"""
+
+# the snapshot queries, each table is fetched in pages of concept ids
+_SNAPSHOT_SQL = {
+    "concept": """
+SELECT concept_id, CASE WHEN invalid_reason IS NULL THEN 1 ELSE 0 END AS valid
+FROM @vocabulary_database_schema.concept
+WHERE concept_id % @pages = @page;""",
+    "concept_ancestor": """
+SELECT ancestor_concept_id, descendant_concept_id
+FROM @vocabulary_database_schema.concept_ancestor
+WHERE ancestor_concept_id % @pages = @page;""",
+    "maps_to": """
+SELECT concept_id_1, concept_id_2
+FROM @vocabulary_database_schema.concept_relationship
+WHERE relationship_id = 'Maps to' AND invalid_reason IS NULL
+  AND concept_id_2 % @pages = @page;""",
+}
+
+_VERSION_SQL = """
+SELECT vocabulary_version
+FROM @vocabulary_database_schema.vocabulary
+WHERE vocabulary_id = 'None';"""
+
+_RESOLVE_SQL = """
+{drop}CREATE TABLE {table} (
+  codeset_id int NOT NULL,
+  concept_id bigint NOT NULL
+);
+
+INSERT INTO {table} (codeset_id, concept_id)
+{selects};
+"""
+
+# the flags of an item that change the concepts a concept set resolves to
+_ITEM_FLAGS = ("isExcluded", "includeDescendants", "includeMapped")
+
+
+def expression_hash(expression: dict | str) -> str:
+    """
+    The hash of the parts of a concept set expression that determine its
+    concepts, so that names or concept details do not affect it
+    """
+    if isinstance(expression, str):
+        expression = json.loads(expression)
+    items = sorted(
+        (item["concept"]["CONCEPT_ID"],
+         *(bool(item.get(flag)) for flag in _ITEM_FLAGS))
+        for item in expression.get("items", [])
+    )
+    return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()
+
+
+class VocabularyIndex:
+    """
+    A local, indexed snapshot of the vocabulary for concept set expansion
+
+    Create the snapshot once with ``VocabularyIndex.snapshot`` and open it
+    afterwards with ``VocabularyIndex(path)``. The index can be shared
+    between threads.
+
+    Args:
+        path (str | Path): The SQLite file of the snapshot
+
+    Examples:
+        >>> index = VocabularyIndex.snapshot("vocabulary.sqlite", connection,
+        ...                                  "cdm")
+        >>> index.resolve(concept_set["expression"])
+        >>> codesets = index.resolve_concept_sets(cohort["ConceptSets"])
+        >>> sql = build_cohort_sql(cohort, codesets=codesets)
+    """
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"No vocabulary snapshot at {self.path}")
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cache: dict[str, list[int]] = {}
+        self.version = self._db.execute(
+            "SELECT value FROM metadata WHERE key = 'vocabulary_version'"
+        ).fetchone()[0]
+
+    @classmethod
+    def snapshot(cls, path: str | Path, connection,
+                 vocabulary_database_schema: str,
+                 pages: int = 16) -> VocabularyIndex:
+        """
+        Snapshot the vocabulary of a database into a local index
+
+        Parameters
+        ----------
+        path : str | Path
+            The SQLite file to create, an existing file is replaced once the
+            snapshot is complete
+        connection : RS4
+            The database connection
+        vocabulary_database_schema : str
+            The schema of the vocabulary tables
+        pages : int, optional
+            The number of queries each table is fetched in, which bounds the
+            size of the results that pass through R, by default 16
+
+        Returns
+        -------
+        VocabularyIndex
+            The index on the snapshot
+        """
+        from ohdsi import database_connector
+        from ohdsi.common import convert_from_r
+
+        def query(sql: str, **kwargs):
+            return convert_from_r(
+                database_connector.render_translate_query_sql(
+                    connection, sql,
+                    vocabulary_database_schema=vocabulary_database_schema,
+                    **kwargs))
+
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.unlink(missing_ok=True)
+        db = sqlite3.connect(tmp_path)
+        try:
+            db.executescript(_SCHEMA)
+            version = query(_VERSION_SQL)
+            db.execute("INSERT INTO metadata VALUES ('vocabulary_version', ?)",
+                       (str(version.iloc[0, 0]) if len(version) else "",))
+            for table, sql in _SNAPSHOT_SQL.items():
+                for page in range(pages):
+                    rows = query(sql, pages=pages, page=page)
+                    placeholders = ", ".join("?" * rows.shape[1])
+                    db.executemany(
+                        f"INSERT INTO {table} VALUES ({placeholders})",
+                        rows.astype("int64").itertuples(index=False))
+            db.executescript(_INDEXES)
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def _concepts(self, sql: str, concept_ids: set[int]) -> set[int]:
+        if not concept_ids:
+            return set()
+        self._db.execute("DELETE FROM temp.ids")
+        self._db.executemany("INSERT INTO temp.ids VALUES (?)",
+                             ((c,) for c in concept_ids))
+        return {row[0] for row in self._db.execute(sql)}
+
+    def _items(self, items: list[dict]) -> set[int]:
+        """ The concepts of the items, and their descendants when included """
+        concepts = self._concepts(
+            "SELECT c.concept_id FROM concept c "
+            "JOIN temp.ids i ON c.concept_id = i.concept_id",
+            {item["concept"]["CONCEPT_ID"] for item in items})
+        return concepts | self._concepts(
+            "SELECT ca.descendant_concept_id FROM temp.ids i "
+            "JOIN concept_ancestor ca ON ca.ancestor_concept_id = i.concept_id "
+            "JOIN concept c ON c.concept_id = ca.descendant_concept_id "
+            "AND c.valid = 1",
+            {item["concept"]["CONCEPT_ID"] for item in items
+             if item.get("includeDescendants")})
+
+    def _mapped(self, items: list[dict]) -> set[int]:
+        return self._concepts(
+            "SELECT m.concept_id_1 FROM temp.ids i "
+            "JOIN maps_to m ON m.concept_id_2 = i.concept_id",
+            self._items(items))
+
+    def _resolve(self, items: list[dict]) -> list[int]:
+        included = [i for i in items if not i.get("isExcluded")]
+        excluded = [i for i in items if i.get("isExcluded")]
+        concepts = self._items(included) - self._items(excluded)
+        mapped = [i for i in included if i.get("includeMapped")]
+        if mapped:
+            concepts |= self._mapped(mapped) - self._mapped(
+                [i for i in excluded if i.get("includeMapped")])
+        return sorted(concepts)
+
+    def resolve(self, expression: dict | str) -> list[int]:
+        """
+        Resolve a concept set expression to its concept ids
+
+        Resolves like the SQL of ``concept_set_expression_sql``, on the
+        snapshot. Results are cached in memory and in the snapshot.
+
+        Parameters
+        ----------
+        expression : dict | str
+            The concept set expression (with the ``items``), as dict or JSON
+
+        Returns
+        -------
+        list[int]
+            The sorted concept ids
+        """
+        if isinstance(expression, str):
+            expression = json.loads(expression)
+        key = expression_hash(expression)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            row = self._db.execute(
+                "SELECT concept_ids FROM resolved WHERE expression_hash = ? "
+                "AND vocabulary_version = ?", (key, self.version)).fetchone()
+            if row is not None:
+                concept_ids = json.loads(row[0])
+            else:
+                self._db.execute("CREATE TEMP TABLE IF NOT EXISTS ids "
+                                 "(concept_id INTEGER PRIMARY KEY)")
+                concept_ids = self._resolve(expression.get("items", []))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO resolved VALUES (?, ?, ?)",
+                    (key, self.version, json.dumps(concept_ids)))
+                self._db.commit()
+            self._cache[key] = concept_ids
+            return concept_ids
+
+    def resolve_concept_sets(self, concept_sets: list[dict]) \
+            -> dict[int, list[int]]:
+        """
+        Resolve the concept sets of a cohort expression
+
+        Parameters
+        ----------
+        concept_sets : list[dict]
+            The ``ConceptSets`` of a cohort expression
+
+        Returns
+        -------
+        dict[int, list[int]]
+            The concept ids by concept set id, the ``codesets`` of
+            ``build_cohort_sql``
+        """
+        return {concept_set["id"]: self.resolve(concept_set["expression"])
+                for concept_set in concept_sets}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def _resolve_sql(table: str, selects: str) -> str:
+    return _RESOLVE_SQL.format(
+        drop=f"IF OBJECT_ID('tempdb..{table}', 'U') IS NOT NULL "
+             f"DROP TABLE {table};\n",
+        table=table, selects=selects)
+
+
+def resolve_concept_sets(connection, expressions: dict | list[dict],
+                         vocabulary_schema: str,
+                         temp_emulation_schema: str | None = None,
+                         codeset_table: str | None = None) -> pd.Series:
+    """
+    Resolve many concept set expressions on the database at once
+
+    Identical expressions are expanded once. All expansions are materialized
+    into a single temp table by one batch of SQL, and read back with one
+    query.
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection
+    expressions : dict | list[dict]
+        The concept set expressions by concept set id, or a list of concept
+        sets with an ``id`` and ``expression`` (like the ``ConceptSets`` of
+        a cohort expression)
+    vocabulary_schema : str
+        The schema of the vocabulary tables
+    temp_emulation_schema : str, optional
+        A schema where temp tables can be emulated
+    codeset_table : str, optional
+        A temp table (e.g. "#Codesets") to keep the resolved concepts in, by
+        concept set id (``codeset_id``) like the codesets of cohort SQL, for
+        later SQL on this connection. By default no table is kept.
+
+    Returns
+    -------
+    pd.Series
+        The sorted concept ids (a list) by concept set id
+
+    Examples
+    --------
+    >>> resolve_concept_sets(connection, cohort["ConceptSets"], "cdm")
+    """
+    from ohdsi import database_connector
+    from ohdsi.common import convert_from_r
+
+    if isinstance(expressions, list):
+        expressions = {c["id"]: c["expression"] for c in expressions}
+    expressions = {concept_set_id: json.loads(expression)
+                   if isinstance(expression, str) else expression
+                   for concept_set_id, expression in expressions.items()}
+    # the codeset of each distinct expression
+    codesets = {}
+    for expression in expressions.values():
+        codesets.setdefault(expression_hash(expression),
+                            (len(codesets), expression))
+    ids = pd.Series(
+        {concept_set_id: codesets[expression_hash(expression)][0]
+         for concept_set_id, expression in expressions.items()},
+        dtype="int64")
+    if not codesets:
+        return pd.Series(dtype=object, name="concept_ids")
+
+    # the expansions, by distinct expression
+    table = "#resolved_concept_sets"
+    selects = "\nUNION ALL\n".join(
+        f"SELECT {codeset_id} as codeset_id, c.concept_id FROM (\n"
+        f"{concept_set_expression_sql(expression)}\n) C"
+        for codeset_id, expression in codesets.values())
+    database_connector.render_translate_execute_sql(
+        connection, _resolve_sql(table, selects),
+        temp_emulation_schema=temp_emulation_schema,
+        vocabulary_database_schema=vocabulary_schema
+    )
+    try:
+        rows = convert_from_r(database_connector.render_translate_query_sql(
+            connection,
+            f"SELECT codeset_id, concept_id FROM {table} "
+            "ORDER BY codeset_id, concept_id;",
+            temp_emulation_schema=temp_emulation_schema
+        ))
+        if codeset_table is not None:
+            # the concept sets with the same expression share its expansion
+            database_connector.render_translate_execute_sql(
+                connection, _resolve_sql(codeset_table, "\nUNION ALL\n".join(
+                    f"SELECT {int(concept_set_id)} as codeset_id, concept_id "
+                    f"FROM {table} WHERE codeset_id = {codeset_id}"
+                    for concept_set_id, codeset_id in ids.items())),
+                temp_emulation_schema=temp_emulation_schema
+            )
+    finally:
+        database_connector.render_translate_execute_sql(
+            connection, f"TRUNCATE TABLE {table};\nDROP TABLE {table};",
+            temp_emulation_schema=temp_emulation_schema
+        )
+    rows.columns = [c.lower() for c in rows.columns]
+    concepts = rows.groupby("codeset_id")["concept_id"].agg(
+        lambda c: c.astype("int64").tolist())
+    return ids.map(lambda codeset_id: concepts.get(codeset_id, [])) \
+        .rename("concept_ids")
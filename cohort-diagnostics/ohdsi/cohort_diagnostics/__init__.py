@@ -1,13 +1,35 @@
 import os
+import time
+import shutil
+import zipfile
 
 from pathlib import Path
 
+import pandas as pd
+
 from rpy2.robjects.methods import RS4
-from rpy2.robjects.vectors import ListVector
+from rpy2.robjects.vectors import IntVector, ListVector
 from rpy2.robjects.packages import importr
 
-from ohdsi.common import ListVectorExtended, to_lower_camel_case
-from ohdsi import cohort_generator
+from ohdsi.common import (
+    Checkpoint,
+    ListVectorExtended,
+    convert_from_r,
+    fingerprint,
+    run_tasks,
+    to_lower_camel_case
+)
+from ohdsi import cohort_generator, database_connector
+from ohdsi.cohort_diagnostics.results import (
+    _read_specification,
+    export_results,
+    merge_result_zips,
+    merge_results
+)
+from ohdsi.cohort_diagnostics.temporal import (
+    covariate_settings_analyses,
+    temporal_cohort_characterization
+)
 
 
 # When building documentation for the project, the following import will fail
@@ -72,7 +94,13 @@ def execute_diagnostics(
         min_characterization_mean: int = 0.01,
         ir_washout_period: int = 0,
         incremental: bool = False,
-        incremental_folder: str | None = None) -> RS4:
+        incremental_folder: str | None = None,
+        checkpoint_folder: str | None = None,
+        results_store: str | None = None,
+        results_format: str = "parquet",
+        split_diagnostics: bool = False,
+        max_workers: int = 1,
+        temporal_characterization: str = "r") -> RS4 | pd.DataFrame | None:
     """
     Execute cohort diagnostics
 
@@ -157,6 +185,51 @@ def execute_diagnostics(
     incremental_folder : str, optional
         Specify a folder where records are kept of which cohort diagnostics has 
         been executed.
+    checkpoint_folder : str, optional
+        When provided, the diagnostics are executed cohort by cohort (in 
+        incremental mode) and every completed cohort is recorded in a manifest 
+        in this folder. Running the diagnostics again with the same folder 
+        skips the cohorts that completed before, e.g. after a dropped 
+        connection. The cohort relationships, which compare cohorts, are 
+        computed by a final incremental run over all cohorts, which also 
+        provides the return value. Note that the database level diagnostics 
+        (e.g. the database and vocabulary metadata) are repeated for every 
+        cohort.
+    results_store : str, optional
+        When provided, the results are streamed from the export folder into
+        this columnar store after the diagnostics completed, see
+        ``export_results``. Use ``merge_results`` to combine the results of
+        several databases.
+    results_format : str, optional
+        The format of the results store: "parquet" (a folder) or "duckdb"
+        (a file), by default "parquet".
+    split_diagnostics : bool, optional
+        Run every diagnostic of every cohort (e.g. the incidence rate of
+        cohort 1) as a separate task, in its own folder of the export folder.
+        The results of the tasks are combined into the export folder and its
+        results zip file afterwards. Tasks are scheduled by their cost, which
+        is estimated from the cohort entries (and the timings of earlier
+        runs). The timing of the tasks is written to
+        ``diagnostics_timing.csv`` in the export folder and returned. Combine
+        with ``checkpoint_folder`` to skip the tasks that completed before.
+    max_workers : int, optional
+        The number of tasks that run concurrently, each in its own R process
+        with its own connection (which requires ``connection_details``), by
+        default 1. Only used with ``split_diagnostics``.
+    temporal_characterization : str, optional
+        Compute the temporal cohort characterization in "r", using
+        ``temporal_covariate_settings``, or in "python", which extracts the
+        events once and aggregates all time windows in Python, see
+        ``temporal_cohort_characterization``. By default "r". Python only
+        supports settings with the binary concept based analyses (see
+        ``temporal.ANALYSES``), and raises a ValueError for others, such as
+        the demographics of the default settings.
+
+    Returns
+    -------
+    RS4 | pd.DataFrame | None
+        The value returned by CohortDiagnostics, or the timing report when
+        ``split_diagnostics`` is set
     """
 
     if not temp_emulation_schema:
@@ -177,13 +250,338 @@ def execute_diagnostics(
         incremental_folder = os.path.join(export_folder, "incremental")
 
     all_arguments = locals()
+    for arg in ("checkpoint_folder", "results_store", "results_format",
+                "split_diagnostics", "max_workers",
+                "temporal_characterization"):
+        all_arguments.pop(arg)
     all_arguments_camel = {to_lower_camel_case(arg): all_arguments[arg] for arg in all_arguments.keys()}
     
     # remove None values
     args = {k: v for k, v in all_arguments_camel.items() if v is not None}
-    return cohort_diagnostics.executeDiagnostics(**args)
+
+    if temporal_characterization not in ("r", "python"):
+        raise ValueError(f"Unknown temporal characterization "
+                         f"{temporal_characterization}, choose 'r' or "
+                         "'python'")
+    run_python_characterization = temporal_characterization == "python" \
+        and run_temporal_cohort_characterization
+    if run_python_characterization:
+        # fails before running anything when the settings are not supported
+        analyses, time_windows = covariate_settings_analyses(
+            temporal_covariate_settings)
+        args["runTemporalCohortCharacterization"] = False
+
+    if split_diagnostics:
+        result = _execute_diagnostics_tasks(args, checkpoint_folder,
+                                            max_workers)
+    elif checkpoint_folder is not None:
+        result = _execute_diagnostics_per_cohort(args, checkpoint_folder)
+    else:
+        result = cohort_diagnostics.executeDiagnostics(**args)
+
+    if run_python_characterization:
+        _temporal_characterization(args, analyses, time_windows)
+
+    if results_store is not None:
+        export_results(export_folder, results_store, database_id,
+                       results_format)
+    return result
+
+
+def _temporal_characterization(args: dict, analyses: tuple[str, ...],
+                               time_windows: list[tuple[int, int]]) -> None:
+    """ Add the temporal characterization computed in Python to the export """
+    connection = args["connection"] if "connection" in args \
+        else database_connector.connect(args["connectionDetails"])
+    try:
+        tables = temporal_cohort_characterization(
+            connection,
+            args["cohortDatabaseSchema"],
+            args["cdmDatabaseSchema"],
+            list(args["cohortIds"]) or _cohort_ids(
+                args["cohortDefinitionSet"]),
+            args["databaseId"],
+            cohort_table=args["cohortTable"],
+            vocabulary_database_schema=args["vocabularyDatabaseSchema"],
+            time_windows=time_windows,
+            analyses=analyses,
+            min_cell_count=args["minCellCount"],
+            min_characterization_mean=args["minCharacterizationMean"],
+            temp_emulation_schema=args.get("tempEmulationSchema")
+        )
+    finally:
+        if "connection" not in args:
+            database_connector.disconnect(connection)
+
+    export_folder = Path(args["exportFolder"])
+    csv_files = {f"{name}.csv": export_folder / f"{name}.csv"
+                 for name in tables}
+    for (name, table), csv_file in zip(tables.items(), csv_files.values()):
+        table.to_csv(csv_file, index=False)
+    _add_to_zip(export_folder / f"Results_{args['databaseId']}.zip",
+                csv_files)
+
+
+def _add_to_zip(zip_file: Path, files: dict[str, Path]) -> None:
+    """ Add files to a zip file, replacing the members of the same name """
+    tmp_file = zip_file.with_suffix(".zip.tmp")
+    with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED) as archive:
+        if zip_file.exists():
+            with zipfile.ZipFile(zip_file) as existing:
+                for member in existing.infolist():
+                    if member.filename not in files:
+                        archive.writestr(member, existing.read(member))
+        for name, file in files.items():
+            archive.write(file, name)
+    os.replace(tmp_file, zip_file)
+
+
+def _cohort_ids(cohort_definition_set: RS4 | pd.DataFrame) -> list[int]:
+    if isinstance(cohort_definition_set, pd.DataFrame):
+        return [int(i) for i in cohort_definition_set["cohortId"]]
+    return [int(i) for i in cohort_definition_set.rx2("cohortId")]
+
+
+def _execute_diagnostics_task(args: dict) -> None:
+    cohort_diagnostics.executeDiagnostics(**args)
+
+
+def _execute_diagnostics_per_cohort(args: dict, checkpoint_folder: str) \
+        -> RS4:
+    cohort_ids = list(args["cohortIds"]) \
+        or _cohort_ids(args["cohortDefinitionSet"])
+
+    # the cohort IDs and locations do not change the results of a cohort
+    run_id = fingerprint({
+        k: v for k, v in args.items()
+        if k not in ("connection", "connectionDetails", "cohortIds",
+                     "exportFolder", "incrementalFolder")
+    })
+    checkpoint = Checkpoint(checkpoint_folder, run_id)
+
+    # incremental mode appends the results of each cohort to the export.
+    # Diagnostics that compare cohorts are left to the final run.
+    tasks = {
+        f"cohort_{cohort_id}": (
+            _execute_diagnostics_task,
+            ({**args, "cohortIds": IntVector([cohort_id]),
+              "incremental": True,
+              **{DIAGNOSTICS[d][0]: False for d in _ALL_COHORT_DIAGNOSTICS}},)
+        )
+        for cohort_id in cohort_ids
+    }
+    run_tasks(tasks, checkpoint)
+
+    # the final run over all cohorts skips what the tasks (or an earlier
+    # incremental run) completed, computes the cohort relationships and
+    # writes the results zip file
+    return cohort_diagnostics.executeDiagnostics(
+        **{**args, "incremental": True})
+
+
+
+# The run flag of each diagnostic, and its cost relative to the other
+# diagnostics for the same number of cohort entries
+DIAGNOSTICS = {
+    "inclusion_statistics": ("runInclusionStatistics", 0.5),
+    "included_source_concepts": ("runIncludedSourceConcepts", 2.0),
+    "orphan_concepts": ("runOrphanConcepts", 3.0),
+    "time_series": ("runTimeSeries", 2.0),
+    "visit_context": ("runVisitContext", 1.0),
+    "breakdown_index_events": ("runBreakdownIndexEvents", 4.0),
+    "incidence_rate": ("runIncidenceRate", 2.0),
+    "cohort_relationship": ("runCohortRelationship", 3.0),
+    "temporal_cohort_characterization": (
+        "runTemporalCohortCharacterization", 10.0),
+}
+
+# diagnostics that compare cohorts, which run once for all cohorts
+_ALL_COHORT_DIAGNOSTICS = ("cohort_relationship",)
+
+TIMING_FILE = "diagnostics_timing.csv"
 
 
+def _run_diagnostics_task(args: dict) -> float:
+    # a task that is run again starts from an empty folder
+    shutil.rmtree(args["exportFolder"], ignore_errors=True)
+    started = time.perf_counter()
+    cohort_diagnostics.executeDiagnostics(**args)
+    return time.perf_counter() - started
+
+
+def _cohort_entries(args: dict, cohort_ids: list[int]) -> dict[int, int]:
+    counts = convert_from_r(cohort_generator.get_cohort_counts(
+        args["cohortDatabaseSchema"],
+        connection_details=args.get("connectionDetails"),
+        connection=args.get("connection"),
+        cohort_table=args["cohortTable"],
+        cohort_ids=cohort_ids
+    ))
+    entries = dict.fromkeys(cohort_ids, 0)
+    for cohort_id, count in zip(counts["cohortId"], counts["cohortEntries"]):
+        entries[int(cohort_id)] = int(count)
+    return entries
+
+
+def _estimate_costs(tasks: pd.DataFrame, timing: pd.DataFrame | None) \
+        -> pd.Series:
+    """ Estimate the seconds a task takes, or its relative cost
+
+    The cost of a diagnostic grows with the cohort entries. When earlier
+    runs were timed, the seconds per unit of cost of each diagnostic are
+    taken from these.
+    """
+    weights = tasks["diagnostic"].map(lambda d: DIAGNOSTICS[d][1])
+    costs = weights * (1 + tasks["cohort_entries"] / 1000)
+    if timing is None or timing.empty:
+        return costs
+
+    timed = timing.dropna(subset=["seconds"])
+    timed_costs = timed["diagnostic"].map(lambda d: DIAGNOSTICS[d][1]) \
+        * (1 + timed["cohort_entries"] / 1000)
+    rates = (timed["seconds"].groupby(timed["diagnostic"]).sum()
+             / timed_costs.groupby(timed["diagnostic"]).sum())
+    # diagnostics that were not timed before use the average rate
+    rate = tasks["diagnostic"].map(rates).fillna(
+        timed["seconds"].sum() / timed_costs.sum())
+    return costs * rate
+
+
+# the results data model specification, which executeDiagnostics exports
+_SPECIFICATION_FILE = "resultsDataModelSpecification.csv"
+
+# tables that describe a run of executeDiagnostics, with timestamps of their
+# own, rather than results
+_RUN_TABLES = ("database", "metadata")
+
+
+def _combine_task_exports(task_folders: list[Path], export_folder: str,
+                          database_id: str) -> None:
+    """ Combine the CSV files of the tasks into the export folder """
+    tables = {}
+    for folder in task_folders:
+        for csv_file in folder.glob("*.csv"):
+            tables.setdefault(csv_file.name, []).append(csv_file)
+
+    # each task is a run of executeDiagnostics, which exports the tables of
+    # the run and shared tables like cohort and concept. The tables of the
+    # run are taken from the first task, the others are deduplicated on
+    # their primary key.
+    spec = _read_specification(tables[_SPECIFICATION_FILE][0]) \
+        if _SPECIFICATION_FILE in tables else {}
+    export_folder = Path(export_folder)
+    for name, csv_files in tables.items():
+        table_name = Path(name).stem
+        if table_name in _RUN_TABLES:
+            csv_files = csv_files[:1]
+        table = pd.concat(
+            [pd.read_csv(f, dtype=str, keep_default_na=False)
+             for f in csv_files],
+            ignore_index=True
+        )
+        primary_key = [c for c in spec.get(table_name, ({}, []))[1]
+                       if c in table.columns]
+        table = table.drop_duplicates(primary_key or None)
+        table.to_csv(export_folder / name, index=False)
+
+    zip_file = export_folder / f"Results_{database_id}.zip"
+    with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(tables):
+            archive.write(export_folder / name, name)
+
+
+def _execute_diagnostics_tasks(args: dict, checkpoint_folder: str | None,
+                               max_workers: int) -> pd.DataFrame:
+    if max_workers > 1 and "connectionDetails" not in args:
+        raise ValueError("Running diagnostics concurrently requires "
+                         "connection_details, as every task needs its own "
+                         "connection")
+
+    cohort_ids = list(args["cohortIds"]) \
+        or _cohort_ids(args["cohortDefinitionSet"])
+    entries = _cohort_entries(args, cohort_ids)
+    export_folder = Path(args["exportFolder"])
+    task_root = export_folder / "tasks"
+
+    rows = []
+    for diagnostic, (flag, _) in DIAGNOSTICS.items():
+        if not args[flag]:
+            continue
+        if diagnostic in _ALL_COHORT_DIAGNOSTICS:
+            rows.append((diagnostic, None, sum(entries.values())))
+        else:
+            rows.extend((diagnostic, c, entries[c]) for c in cohort_ids)
+    tasks = pd.DataFrame(rows, columns=["diagnostic", "cohort_id",
+                                        "cohort_entries"])
+    tasks["cohort_id"] = tasks["cohort_id"].astype("Int64")
+    tasks.insert(0, "task", [
+        diagnostic if pd.isna(cohort_id) else f"{diagnostic}_{cohort_id}"
+        for diagnostic, cohort_id in zip(tasks["diagnostic"],
+                                         tasks["cohort_id"])
+    ])
+
+    timing_file = export_folder / TIMING_FILE
+    timing = pd.read_csv(timing_file) if timing_file.exists() else None
+    tasks["estimated_cost"] = _estimate_costs(tasks, timing)
+    # the most expensive tasks are started first, so that the cheap ones
+    # fill up the workers at the end
+    tasks = tasks.sort_values("estimated_cost", ascending=False,
+                              ignore_index=True)
+
+    base_args = {
+        **args,
+        **{flag: False for flag, _ in DIAGNOSTICS.values()},
+        "incremental": False,
+    }
+    if max_workers > 1:
+        # the connection cannot be shared with other processes
+        base_args.pop("connection", None)
+        settings = base_args["temporalCovariateSettings"]
+        if isinstance(settings, ListVectorExtended):
+            base_args["temporalCovariateSettings"] = settings.as_list_vector()
+
+    task_args, files = {}, {}
+    for task in tasks.itertuples():
+        folder = task_root / task.task
+        flag = DIAGNOSTICS[task.diagnostic][0]
+        cohort_ids_task = cohort_ids if pd.isna(task.cohort_id) \
+            else [int(task.cohort_id)]
+        task_args[task.task] = (_run_diagnostics_task, ({
+            **base_args,
+            flag: True,
+            "cohortIds": IntVector(cohort_ids_task),
+            "exportFolder": str(folder),
+            "incrementalFolder": str(folder / "incremental"),
+        },))
+        files[task.task] = str(folder)
+
+    checkpoint = None
+    if checkpoint_folder is not None:
+        run_id = fingerprint({
+            k: v for k, v in base_args.items()
+            if k not in ("connection", "connectionDetails", "cohortIds",
+                         "exportFolder", "incrementalFolder")
+        })
+        checkpoint = Checkpoint(checkpoint_folder, run_id)
+
+    # tasks that completed before (see checkpoint_folder) are not timed
+    seconds = run_tasks(task_args, checkpoint, max_workers, files)
+    tasks["seconds"] = tasks["task"].map(seconds)
+    _combine_task_exports([task_root / t for t in tasks["task"]
+                           if (task_root / t).exists()],
+                          export_folder, args["databaseId"])
+
+    # keep the timings of tasks that did not run this time
+    if timing is not None:
+        timing = timing[~timing["task"].isin(tasks["task"][
+            tasks["seconds"].notna()])]
+        report = pd.concat([tasks[tasks["seconds"].notna()], timing],
+                           ignore_index=True)
+    else:
+        report = tasks
+    report.to_csv(timing_file, index=False)
+    return tasks
+
 
 # -----------------------------------------------------------------------------
 # wrapper: CohortDiagnostics/R/Shiny.R
@@ -195,7 +593,10 @@ def create_merged_results_file(
         data_folder: str,
         sqlite_db_path: str = "MergedCohortDiagnosticsData.sqlite",
         overwrite: bool = False,
-        table_prefix: str = ""
+        table_prefix: str = "",
+        engine: str = "r",
+        backend: str = "sqlite",
+        max_workers: int | None = None
     ):
     """
     Merge Shiny diagnostics files into sqlite database
@@ -204,8 +605,12 @@ def create_merged_results_file(
     a single file. The result is an sqlite database that can be used as input 
     for the Diagnostics Explorer Shiny app.
     
-    It also checks whether the results conform to the results data model 
-    specifications.
+    The Python engine parses the zip files in parallel and bulk loads them,
+    see ``merge_result_zips``. Zip files that were merged before are skipped,
+    so new results can be added by running the merge again. The column types
+    and primary keys are taken from the results data model specification of
+    CohortDiagnostics. The R engine also checks whether the results conform to
+    the results data model specifications.
 
     Parameters
     ----------
@@ -221,9 +626,28 @@ def create_merged_results_file(
     table_prefix : str, optional
         String to insert before table names (e.g. "cd_") for database table 
         names.
+    engine : str, optional
+        Merge with CohortDiagnostics in "r" or with "python", which requires
+        ``pyarrow`` (the ``parquet`` extra), by default "r"
+    backend : str, optional
+        The type of database the Python engine creates, "sqlite" or
+        "duckdb", by default "sqlite"
+    max_workers : int, optional
+        The number of processes the Python engine uses to parse zip files,
+        by default the number of CPUs
     """
-    return cohort_diagnostics.createMergedResultsFile(
-        data_folder, sqlite_db_path, overwrite, table_prefix)
+    if engine == "r":
+        return cohort_diagnostics.createMergedResultsFile(
+            data_folder, sqlite_db_path, overwrite, table_prefix)
+    elif engine != "python":
+        raise ValueError(f"Unknown engine {engine}, choose 'r' or 'python'")
+
+    specification = base_r.system_file(
+        "settings", "resultsDataModelSpecification.csv",
+        package="CohortDiagnostics")[0]
+    return merge_result_zips(data_folder, sqlite_db_path, table_prefix,
+                             backend, overwrite, max_workers,
+                             specification or None)
 
 
 def launch_diagnostics_explorer(
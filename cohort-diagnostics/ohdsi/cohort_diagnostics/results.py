@@ -0,0 +1,640 @@
+"""
+Columnar storage of cohort diagnostics results
+
+``executeDiagnostics`` writes its results as CSV files (and a zip of them)
+to the export folder. The functions in this module stream these tables,
+batch by batch, into a local columnar store so that results of many
+databases can be combined without re-parsing CSVs:
+
+- ``parquet``: a folder with one Parquet file per table and database, i.e.
+  ``<store>/<table>/<database_id>.parquet``. Merging is metadata only: a
+  DuckDB file with views over the Parquet files.
+- ``duckdb``: a single DuckDB file, to which the rows are appended.
+
+Exporting the results of a database again replaces its earlier results.
+
+``merge_result_zips`` is the Python counterpart of R's
+``createMergedResultsFile``: it merges the results zip files of many
+databases into a SQLite (or DuckDB) database, in parallel and incrementally.
+
+Requires ``pyarrow``, and ``duckdb`` for the DuckDB store and merging,
+install with ``pip install ohdsi-cohort-diagnostics[parquet]``.
+"""
+from __future__ import annotations
+
+import os
+import re
+import shutil
+import sqlite3
+import zipfile
+import itertools
+import multiprocessing
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Callable, Iterator
+
+RESULT_FORMATS = ("parquet", "duckdb")
+
+MERGE_BACKENDS = ("sqlite", "duckdb")
+
+# CSV files are read in blocks of this size, which bounds the memory use
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Exporting results requires the `pyarrow` package, "
+                          "install it with `pip install pyarrow`") from e
+    return pyarrow
+
+
+def _import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("This requires the `duckdb` package, install it "
+                          "with `pip install duckdb`") from e
+    return duckdb
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^0-9A-Za-z_\-]', '_', str(name))
+
+
+def result_tables(source: str | Path) \
+        -> dict[str, Callable[[], IO[bytes]]]:
+    """
+    Find the result tables in an export folder or results zip file
+
+    Parameters
+    ----------
+    source : str | Path
+        An export folder of ``execute_diagnostics``, or a zip file of
+        results. When the folder contains no CSV files, the results zip file
+        in it is used.
+
+    Returns
+    -------
+    dict[str, Callable[[], IO[bytes]]]
+        The table names mapped to functions that open the CSV file
+    """
+    source = Path(source)
+    if source.is_dir():
+        csv_files = sorted(source.glob("*.csv"))
+        if csv_files:
+            return {f.stem: (lambda f=f: open(f, "rb")) for f in csv_files}
+        zip_files = sorted(source.glob("*.zip"))
+        if not zip_files:
+            raise FileNotFoundError(f"No results found in {source}")
+        source = zip_files[-1]
+
+    with zipfile.ZipFile(source) as archive:
+        members = [m for m in archive.namelist() if m.endswith(".csv")]
+
+    @contextmanager
+    def open_member(member: str) -> Iterator[IO[bytes]]:
+        with zipfile.ZipFile(source) as archive, archive.open(member) as f:
+            yield f
+
+    return {Path(m).stem: (lambda m=m: open_member(m)) for m in members}
+
+
+def _arrow_type(data_type: str):
+    """ The Arrow type of a results data model data type, if known """
+    pa = _import_pyarrow()
+    data_type = data_type.split("(")[0].strip().lower()
+    if data_type in ("bigint", "int", "integer", "smallint"):
+        return pa.int64()
+    elif data_type in ("float", "real", "double", "numeric", "decimal"):
+        return pa.float64()
+    elif data_type in ("varchar", "char", "text", "string"):
+        return pa.string()
+    elif data_type == "date":
+        return pa.date32()
+    return None
+
+
+def _column_types(open_table: Callable[[], IO[bytes]], read_options,
+                  data_types: dict[str, str]) -> dict:
+    """ Column types that hold every value of a CSV file """
+    pa = _import_pyarrow()
+    import pyarrow.compute as pc
+
+    # the types inferred from the first block (or taken from the data model)
+    # are checked against all blocks, and widened where a value does not fit
+    with open_table() as f:
+        schema = pa.csv.open_csv(f, read_options=read_options).schema
+    column_types = {}
+    for field in schema:
+        column_type = _arrow_type(data_types.get(field.name, "")) \
+            or field.type
+        column_types[field.name] = pa.string() \
+            if pa.types.is_null(column_type) else column_type
+
+    unchecked = {name for name, column_type in column_types.items()
+                 if not pa.types.is_string(column_type)}
+    if not unchecked:
+        return column_types
+    convert_options = pa.csv.ConvertOptions(
+        column_types={name: pa.string() for name in column_types},
+        strings_can_be_null=True)
+    with open_table() as f:
+        for batch in pa.csv.open_csv(f, read_options=read_options,
+                                     convert_options=convert_options):
+            for name in list(unchecked):
+                while True:
+                    try:
+                        pc.cast(batch.column(name), column_types[name])
+                        break
+                    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                        column_types[name] = pa.float64() \
+                            if pa.types.is_integer(column_types[name]) \
+                            else pa.string()
+                if pa.types.is_string(column_types[name]):
+                    unchecked.discard(name)
+            if not unchecked:
+                break
+    return column_types
+
+
+def _csv_batches(open_table: Callable[[], IO[bytes]],
+                 data_types: dict[str, str] | None = None):
+    """
+    Stream a CSV file as record batches with a stable schema
+
+    The schema holds every value of the file, which takes an extra pass over
+    the file: a column can look like integers in the first rows and contain
+    text later on (e.g. ``concept_code``). ``data_types`` are the data types
+    of the columns in the results data model, which are used where known.
+    """
+    pa = _import_pyarrow()
+    read_options = pa.csv.ReadOptions(block_size=BLOCK_SIZE)
+    convert_options = pa.csv.ConvertOptions(
+        column_types=_column_types(open_table, read_options,
+                                   data_types or {}),
+        strings_can_be_null=True)
+    with open_table() as f:
+        reader = pa.csv.open_csv(f, read_options=read_options,
+                                 convert_options=convert_options)
+        yield reader.schema
+        yield from reader
+
+
+def _database_id(tables: dict[str, Callable[[], IO[bytes]]]) -> str:
+    if "database" not in tables:
+        raise ValueError("The results contain no database table, provide "
+                         "the database_id")
+    pa = _import_pyarrow()
+    with tables["database"]() as f:
+        ids = pa.csv.read_csv(f).column("database_id").unique().to_pylist()
+    if len(ids) != 1:
+        raise ValueError(f"Expected results of one database, found {ids}")
+    return str(ids[0])
+
+
+def export_results(source: str | Path, store: str | Path,
+                   database_id: str | None = None,
+                   results_format: str = "parquet",
+                   specification: str | Path | None = None
+                   ) -> dict[str, int]:
+    """
+    Stream diagnostics results into a columnar store
+
+    Parameters
+    ----------
+    source : str | Path
+        The export folder of ``execute_diagnostics`` or a results zip file
+    store : str | Path
+        A folder for the ``parquet`` format, a (new or existing) DuckDB file
+        for the ``duckdb`` format
+    database_id : str, optional
+        The database the results belong to, by default read from the
+        ``database`` table of the results
+    results_format : str, optional
+        Either "parquet" or "duckdb", by default "parquet"
+    specification : str | Path, optional
+        A results data model specification CSV (see ``merge_result_zips``),
+        which sets the column types. Without it, the types are inferred from
+        the values.
+
+    Returns
+    -------
+    dict[str, int]
+        The number of rows exported per table
+    """
+    if results_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown results format {results_format}, choose "
+                         f"from {RESULT_FORMATS}")
+
+    tables = result_tables(source)
+    if database_id is None:
+        database_id = _database_id(tables)
+    data_types = {table: columns for table, (columns, _) in
+                  _read_specification(specification).items()}
+
+    if results_format == "parquet":
+        return {table: _export_parquet(open_table, Path(store) / table,
+                                       database_id, data_types.get(table))
+                for table, open_table in tables.items()}
+
+    duckdb = _import_duckdb()
+    connection = duckdb.connect(str(store))
+    try:
+        connection.begin()
+        rows = {table: _export_duckdb(
+                    _csv_batches(open_table, data_types.get(table)),
+                    connection, table, [database_id])
+                for table, open_table in tables.items()}
+        connection.commit()
+    finally:
+        connection.close()
+    return rows
+
+
+def _export_parquet(open_table: Callable[[], IO[bytes]], folder: Path,
+                    database_id: str,
+                    data_types: dict[str, str] | None = None) -> int:
+    pa = _import_pyarrow()
+    folder.mkdir(parents=True, exist_ok=True)
+    file = folder / f"{_safe_name(database_id)}.parquet"
+    tmp_file = file.with_suffix(".parquet.tmp")
+
+    batches = _csv_batches(open_table, data_types)
+    rows = 0
+    with pa.parquet.ParquetWriter(tmp_file, next(batches)) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    # replaces the results of an earlier export of this database
+    os.replace(tmp_file, file)
+    return rows
+
+
+def _export_duckdb(batches: Iterator, connection, table: str,
+                   database_ids: list) -> int:
+    # the first item of batches is the schema
+    schema = next(batches)
+    table = f'"{table}"'
+
+    connection.register("batch", schema.empty_table())
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {table} AS "
+                       "SELECT * FROM batch")
+    columns = {row[0] for row in connection.execute(
+        f"DESCRIBE {table}").fetchall()}
+    for name in schema.names:
+        if name not in columns:
+            column_type = connection.execute(
+                f'DESCRIBE SELECT "{name}" FROM batch').fetchone()[1]
+            connection.execute(
+                f'ALTER TABLE {table} ADD COLUMN "{name}" {column_type}')
+    if "database_id" in schema.names:
+        placeholders = ", ".join("?" * len(database_ids))
+        connection.execute(f"DELETE FROM {table} WHERE database_id IN "
+                           f"({placeholders})", database_ids)
+    connection.unregister("batch")
+
+    # tables without a database_id are shared, only add the new rows
+    select = "SELECT * FROM batch"
+    if "database_id" not in schema.names:
+        column_list = ", ".join(f'"{name}"' for name in schema.names)
+        select += f" EXCEPT SELECT {column_list} FROM {table}"
+
+    rows = 0
+    for batch in batches:
+        connection.register("batch", batch)
+        connection.execute(f"INSERT INTO {table} BY NAME {select}")
+        connection.unregister("batch")
+        rows += batch.num_rows
+    return rows
+
+
+def merge_results(store: str | Path, database_path: str | Path,
+                  table_prefix: str = "") -> list[str]:
+    """
+    Combine the Parquet results of all databases into a DuckDB file
+
+    Only views on the Parquet files are created, so merging takes the same
+    time no matter how large the results are. Tables without a
+    ``database_id`` column (e.g. ``cohort``, ``concept``) are shared between
+    databases and deduplicated.
+
+    Parameters
+    ----------
+    store : str | Path
+        The folder the results were exported to by ``export_results``
+    database_path : str | Path
+        The DuckDB file to create the views in
+    table_prefix : str, optional
+        String to insert before table names (e.g. "cd_")
+
+    Returns
+    -------
+    list[str]
+        The names of the views
+    """
+    duckdb = _import_duckdb()
+    store = Path(store).resolve()
+    connection = duckdb.connect(str(database_path))
+    views = []
+    try:
+        for folder in sorted(p for p in store.iterdir() if p.is_dir()):
+            files = f"{folder}/*.parquet".replace("'", "''")
+            source = f"read_parquet('{files}', union_by_name = true)"
+            columns = {row[0] for row in connection.execute(
+                f"DESCRIBE SELECT * FROM {source}").fetchall()}
+            distinct = "" if "database_id" in columns else "DISTINCT "
+            view = f"{table_prefix}{folder.name}"
+            connection.execute(f'CREATE OR REPLACE VIEW "{view}" AS '
+                               f"SELECT {distinct}* FROM {source}")
+            views.append(view)
+    finally:
+        connection.close()
+    return views
+
+
+def _read_results(zip_file: str, spec: dict) -> dict:
+    """ Parse all result tables of a zip file, runs in a worker process """
+    pa = _import_pyarrow()
+    tables = {}
+    for table, open_table in result_tables(zip_file).items():
+        batches = _csv_batches(open_table, spec.get(table, ({},))[0])
+        tables[table] = pa.Table.from_batches(batches, next(batches))
+    return tables
+
+
+def _zip_database_ids(tables: dict) -> list:
+    if "database" in tables:
+        return tables["database"].column("database_id").unique().to_pylist()
+    ids = set()
+    for data in tables.values():
+        if "database_id" in data.column_names:
+            ids.update(data.column("database_id").unique().to_pylist())
+    return sorted(ids)
+
+
+def _read_specification(specification: str | Path | None) -> dict:
+    """ Column types and primary keys from a results data model spec """
+    if specification is None:
+        return {}
+    import pandas as pd
+
+    spec = pd.read_csv(specification, dtype=str).fillna("")
+    tables = {}
+    for row in spec.itertuples():
+        columns, primary_key = tables.setdefault(row.table_name, ({}, []))
+        columns[row.column_name] = row.data_type
+        if getattr(row, "primary_key", "").lower() == "yes":
+            primary_key.append(row.column_name)
+    return tables
+
+
+def _sqlite_type(data_type) -> str:
+    pa = _import_pyarrow()
+    if pa.types.is_integer(data_type) or pa.types.is_boolean(data_type):
+        return "INTEGER"
+    elif pa.types.is_floating(data_type) or pa.types.is_decimal(data_type):
+        return "REAL"
+    return "TEXT"
+
+
+def _sqlite_columns(connection, table: str) -> list[str]:
+    return [row[1] for row in connection.execute(
+        f'PRAGMA table_info("{table}")')]
+
+
+def _sqlite_tables(connection) -> list[str]:
+    return [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+
+def _load_sqlite(data, connection, table: str, spec: tuple) -> int:
+    pa = _import_pyarrow()
+    column_types = spec[0] if spec else {}
+    definitions = {
+        field.name: f'"{field.name}" '
+        f'{column_types.get(field.name) or _sqlite_type(field.type)}'
+        for field in data.schema
+    }
+    columns = _sqlite_columns(connection, table)
+    if not columns:
+        connection.execute(f'CREATE TABLE "{table}" '
+                           f'({", ".join(definitions.values())})')
+    for name, definition in definitions.items():
+        if columns and name not in columns:
+            connection.execute(
+                f'ALTER TABLE "{table}" ADD COLUMN {definition}')
+
+    # dates and times are stored as ISO 8601 text
+    values = []
+    for field, column in zip(data.schema, data.columns):
+        if pa.types.is_temporal(field.type):
+            column = column.cast(pa.string())
+        values.append(column.to_pylist())
+
+    column_list = ", ".join(f'"{name}"' for name in data.column_names)
+    placeholders = ", ".join("?" * data.num_columns)
+    # rows that are already present (by the unique index created after an
+    # earlier merge) are skipped
+    connection.executemany(
+        f'INSERT OR IGNORE INTO "{table}" ({column_list}) '
+        f'VALUES ({placeholders})', zip(*values)
+    )
+    return data.num_rows
+
+
+def _index_sqlite(connection, table: str, spec: tuple) -> None:
+    """ Deduplicate a table and index it, once all rows are loaded """
+    columns = _sqlite_columns(connection, table)
+    primary_key = [c for c in (spec[1] if spec else []) if c in columns]
+    if primary_key:
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+            [f"idx_{table}_pk"]).fetchone()
+        if not exists:
+            key = ", ".join(f'"{name}"' for name in primary_key)
+            _deduplicate_sqlite(connection, table, key)
+            connection.execute(f'CREATE UNIQUE INDEX "idx_{table}_pk" '
+                               f'ON "{table}" ({key})')
+    elif "database_id" not in columns:
+        # tables without a database_id are shared between databases. Their
+        # rows can contain NULLs, which a unique index does not deduplicate.
+        _deduplicate_sqlite(connection, table,
+                            ", ".join(f'"{name}"' for name in columns))
+    if "database_id" in columns:
+        connection.execute(f'CREATE INDEX IF NOT EXISTS '
+                           f'"idx_{table}_database_id" '
+                           f'ON "{table}" (database_id)')
+
+
+def _deduplicate_sqlite(connection, table: str, key: str) -> None:
+    connection.execute(f'DELETE FROM "{table}" WHERE rowid NOT IN '
+                       f'(SELECT MIN(rowid) FROM "{table}" GROUP BY {key})')
+
+
+def merge_result_zips(data_folder: str | Path, database_path: str | Path,
+                      table_prefix: str = "", backend: str = "sqlite",
+                      overwrite: bool = False,
+                      max_workers: int | None = None,
+                      specification: str | Path | None = None
+                      ) -> dict[str, int]:
+    """
+    Merge the results zip files of many databases into one database
+
+    The zip files are parsed in worker processes, while the main process
+    loads the tables in bulk, one transaction per zip file. A SQLite database
+    is written in WAL mode, and indexes are created once all zip files are
+    loaded. Merged zip files are recorded in a manifest next to the database
+    (``<database_path>.merged``), so that running the merge again only loads
+    zip files that are new or changed. The rows of a database that is merged
+    again are replaced.
+
+    Parameters
+    ----------
+    data_folder : str | Path
+        Folder with the results zip files of ``execute_diagnostics``
+    database_path : str | Path
+        The SQLite or DuckDB database file to merge into
+    table_prefix : str, optional
+        String to insert before table names (e.g. "cd_")
+    backend : str, optional
+        Either "sqlite" or "duckdb", by default "sqlite"
+    overwrite : bool, optional
+        Start from an empty database instead of adding to an existing one,
+        by default False
+    max_workers : int, optional
+        The number of processes that parse zip files, by default the number
+        of CPUs
+    specification : str | Path, optional
+        A results data model specification CSV (columns ``table_name``,
+        ``column_name``, ``data_type`` and ``primary_key``), which sets the
+        column types and primary keys of the tables
+
+    Returns
+    -------
+    dict[str, int]
+        The number of rows loaded per table in this run
+    """
+    from ohdsi.common import Checkpoint, fingerprint
+
+    if backend not in MERGE_BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, choose from "
+                         f"{MERGE_BACKENDS}")
+    _import_pyarrow()
+
+    database_path = Path(database_path)
+    manifest_folder = database_path.with_name(f"{database_path.name}.merged")
+    if overwrite:
+        for suffix in ("", "-wal", "-shm", ".wal"):
+            Path(f"{database_path}{suffix}").unlink(missing_ok=True)
+        shutil.rmtree(manifest_folder, ignore_errors=True)
+    checkpoint = Checkpoint(manifest_folder, fingerprint(
+        {"backend": backend, "table_prefix": table_prefix}))
+
+    # a zip file is identified by its name, size and modification time, so
+    # replaced zip files are merged again
+    zip_files = {}
+    for zip_file in sorted(Path(data_folder).glob("*.zip")):
+        stat = zip_file.stat()
+        task = f"{zip_file.name}-{stat.st_size}-{stat.st_mtime_ns}"
+        if not checkpoint.is_completed(task):
+            zip_files[task] = str(zip_file)
+
+    spec = _read_specification(specification)
+    rows: dict[str, int] = {}
+
+    if backend == "sqlite":
+        connection = sqlite3.connect(database_path)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+    else:
+        connection = _import_duckdb().connect(str(database_path))
+
+    def load(task: str, tables: dict) -> None:
+        database_ids = _zip_database_ids(tables)
+        if backend == "sqlite":
+            with connection:
+                _delete_sqlite(connection, table_prefix, database_ids)
+                for table, data in tables.items():
+                    name = f"{table_prefix}{table}"
+                    rows[name] = rows.get(name, 0) + _load_sqlite(
+                        data, connection, name, spec.get(table))
+        else:
+            connection.begin()
+            names = {f"{table_prefix}{table}": data
+                     for table, data in tables.items()}
+            # the tables in the zip file are replaced by _export_duckdb
+            _delete_duckdb(connection, table_prefix, database_ids, names)
+            for name, data in names.items():
+                batches = iter([data.schema, *data.to_batches()])
+                rows[name] = rows.get(name, 0) + _export_duckdb(
+                    batches, connection, name, database_ids)
+            connection.commit()
+        checkpoint.complete(task, str(database_path))
+
+    try:
+        if max_workers == 1 or len(zip_files) <= 1:
+            for task, zip_file in zip_files.items():
+                load(task, _read_results(zip_file, spec))
+        elif zip_files:
+            _merge_parallel(zip_files, spec, load,
+                            max_workers or os.cpu_count() or 1)
+
+        if backend == "sqlite":
+            with connection:
+                for name in rows:
+                    _index_sqlite(connection, name,
+                                  spec.get(name[len(table_prefix):]))
+    finally:
+        connection.close()
+    return rows
+
+
+def _merge_parallel(zip_files: dict[str, str], spec: dict, load: Callable,
+                    max_workers: int) -> None:
+    # parsed zip files are held in memory until they are loaded, so only a
+    # few more are parsed ahead of the loading
+    pending = iter(zip_files.items())
+    with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(zip_files)),
+            mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {}
+        for task, zip_file in itertools.islice(pending, 2 * max_workers):
+            futures[pool.submit(_read_results, zip_file, spec)] = task
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                load(futures.pop(future), future.result())
+                for task, zip_file in itertools.islice(pending, 1):
+                    futures[pool.submit(_read_results, zip_file, spec)] = task
+
+
+def _delete_sqlite(connection, table_prefix: str,
+                   database_ids: list) -> None:
+    if not database_ids:
+        return
+    placeholders = ", ".join("?" * len(database_ids))
+    for table in _sqlite_tables(connection):
+        if table.startswith(table_prefix) \
+                and "database_id" in _sqlite_columns(connection, table):
+            connection.execute(f'DELETE FROM "{table}" WHERE database_id '
+                               f'IN ({placeholders})', database_ids)
+
+
+def _delete_duckdb(connection, table_prefix: str, database_ids: list,
+                   skip=()) -> None:
+    if not database_ids:
+        return
+    placeholders = ", ".join("?" * len(database_ids))
+    tables = connection.execute(
+        "SELECT table_name FROM duckdb_columns() "
+        "WHERE column_name = 'database_id'").fetchall()
+    for (table,) in tables:
+        if table.startswith(table_prefix) and table not in skip:
+            connection.execute(f'DELETE FROM "{table}" WHERE database_id '
+                               f'IN ({placeholders})', database_ids)
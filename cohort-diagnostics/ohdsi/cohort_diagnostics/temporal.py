@@ -0,0 +1,443 @@
+"""
+Temporal cohort characterization in Python
+
+CohortDiagnostics characterizes the cohorts with FeatureExtraction, which
+computes every analysis for every time window in the database. This module
+extracts the events of the cohort entries once, for the span of all time
+windows, and aggregates all windows in Python. The events are sorted once by
+cohort entry and covariate, after which each window costs a single
+vectorized pass over the event days, without sorting or grouping.
+
+The binary (concept based) analyses of FeatureExtraction are supported, the
+output follows the ``temporal_*`` tables of CohortDiagnostics. Use
+``covariate_settings_analyses`` to obtain the analyses and time windows of
+temporal covariate settings, which fails for settings that cannot be
+computed in Python.
+"""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+from rpy2.robjects.methods import RS4
+from rpy2.robjects.vectors import ListVector
+
+from ohdsi import database_connector
+from ohdsi.common import convert_from_r
+
+# The time windows (start day, end day) of ``get_default_covariate_settings``
+DEFAULT_TIME_WINDOWS = [
+    (-9999, 0), (-365, 0), (-180, 0), (-30, 0), (-365, -31), (-30, -1),
+    (0, 0), (1, 30), (31, 365), (-9999, 9999)
+]
+
+# The analysis ID, domain, CDM table, concept, start and end date columns of
+# the FeatureExtraction analyses. Events without an end date column occur on
+# their start day, the others overlap a window when any of their days do.
+ANALYSES = {
+    "ConditionOccurrence": (
+        101, "Condition", "condition_occurrence", "condition_concept_id",
+        "condition_start_date", None),
+    "ConditionEraStart": (
+        201, "Condition", "condition_era", "condition_concept_id",
+        "condition_era_start_date", None),
+    "ConditionEraOverlap": (
+        202, "Condition", "condition_era", "condition_concept_id",
+        "condition_era_start_date", "condition_era_end_date"),
+    "DrugExposure": (
+        301, "Drug", "drug_exposure", "drug_concept_id",
+        "drug_exposure_start_date", None),
+    "DrugEraStart": (
+        401, "Drug", "drug_era", "drug_concept_id",
+        "drug_era_start_date", None),
+    "DrugEraOverlap": (
+        402, "Drug", "drug_era", "drug_concept_id",
+        "drug_era_start_date", "drug_era_end_date"),
+    "ProcedureOccurrence": (
+        501, "Procedure", "procedure_occurrence", "procedure_concept_id",
+        "procedure_date", None),
+    "DeviceExposure": (
+        601, "Device", "device_exposure", "device_concept_id",
+        "device_exposure_start_date", None),
+    "Measurement": (
+        701, "Measurement", "measurement", "measurement_concept_id",
+        "measurement_date", None),
+    "Observation": (
+        801, "Observation", "observation", "observation_concept_id",
+        "observation_date", None),
+}
+
+# The binary concept based analyses of ``get_default_covariate_settings``,
+# which also has analyses (e.g. demographics) that are not supported
+DEFAULT_ANALYSES = ("ConditionOccurrence", "ConditionEraStart",
+                    "ConditionEraOverlap", "DrugEraStart",
+                    "ProcedureOccurrence", "Measurement")
+
+# The elements of FeatureExtraction's covariate settings that are not
+# analyses, and the ones of those that only have their default value
+_SETTINGS = ("temporal", "temporalSequence", "temporalStartDays",
+             "temporalEndDays")
+_UNSUPPORTED_SETTINGS = ("includedCovariateConceptIds",
+                         "excludedCovariateConceptIds",
+                         "includedCovariateIds")
+
+_DROP_SQL = """
+IF OBJECT_ID('tempdb..#temporal_events', 'U') IS NOT NULL
+  DROP TABLE #temporal_events;
+"""
+
+_EVENTS_SQL = _DROP_SQL + """
+
+SELECT *
+INTO #temporal_events
+FROM (
+{events}
+) events;
+"""
+
+_ANALYSIS_SQL = """
+SELECT c.cohort_definition_id AS cohort_id,
+  c.subject_id,
+  c.cohort_start_date,
+  {analysis_id} AS analysis_id,
+  e.{concept} AS concept_id,
+  DATEDIFF(DAY, c.cohort_start_date, e.{start}) AS start_day,
+  DATEDIFF(DAY, c.cohort_start_date, e.{end}) AS end_day
+FROM @cohort_database_schema.@cohort_table c
+INNER JOIN @cdm_database_schema.{table} e
+  ON e.person_id = c.subject_id
+WHERE c.cohort_definition_id IN (@cohort_ids)
+  AND e.{concept} != 0
+  AND e.{start} <= DATEADD(DAY, @max_end_day, c.cohort_start_date)
+  AND e.{end} >= DATEADD(DAY, @min_start_day, c.cohort_start_date)
+"""
+
+_ENTRIES_SQL = """
+SELECT cohort_definition_id AS cohort_id, COUNT(*) AS entries
+FROM @cohort_database_schema.@cohort_table
+WHERE cohort_definition_id IN (@cohort_ids)
+GROUP BY cohort_definition_id;
+"""
+
+_CONCEPTS_SQL = """
+SELECT DISTINCT e.concept_id, c.concept_name
+FROM #temporal_events e
+INNER JOIN @vocabulary_database_schema.concept c
+  ON c.concept_id = e.concept_id;
+"""
+
+
+def covariate_settings_analyses(covariate_settings: ListVector) \
+        -> tuple[tuple[str, ...], list[tuple[int, int]]]:
+    """
+    The analyses and time windows of temporal covariate settings
+
+    Parameters
+    ----------
+    covariate_settings : ListVector
+        Temporal covariate settings, as created by FeatureExtraction's
+        ``create_temporal_covariate_settings``
+
+    Returns
+    -------
+    tuple[tuple[str, ...], list[tuple[int, int]]]
+        The analyses (keys of ``ANALYSES``) and the time windows
+
+    Raises
+    ------
+    ValueError
+        When the settings are not temporal, or use analyses or covariate
+        filters that are not supported in Python
+    """
+    if "covariateSettings" not in covariate_settings.rclass:
+        if len(covariate_settings) != 1:
+            raise ValueError("Only a single covariate settings object is "
+                             "supported in Python")
+        covariate_settings = covariate_settings[0]
+    settings = dict(zip(covariate_settings.names, covariate_settings))
+    if not settings.get("temporal", [False])[0]:
+        raise ValueError("The covariate settings are not temporal, use "
+                         "create_temporal_covariate_settings")
+
+    analyses, unsupported = [], []
+    for name, value in settings.items():
+        if name in _SETTINGS or name.startswith("addDescendantsTo"):
+            continue
+        elif name in _UNSUPPORTED_SETTINGS:
+            if len(value):
+                unsupported.append(name)
+        elif len(value) and (value[0] is True or value[0] == 1):
+            (analyses if name in ANALYSES else unsupported).append(name)
+    if unsupported:
+        raise ValueError(
+            f"The covariate settings use {sorted(unsupported)}, which are not "
+            f"supported in Python. Use only the analyses {list(ANALYSES)}, "
+            "or compute the temporal characterization in R")
+
+    time_windows = [(int(start), int(end)) for start, end in zip(
+        settings["temporalStartDays"], settings["temporalEndDays"])]
+    return tuple(a for a in ANALYSES if a in analyses), time_windows
+
+
+def _query(connection: RS4, sql: str, **kwargs) -> pd.DataFrame:
+    return convert_from_r(database_connector.render_translate_query_sql(
+        connection, sql, snake_case_to_camel_case=True, **kwargs))
+
+
+def extract_events(connection: RS4, cohort_database_schema: str,
+                   cdm_database_schema: str, cohort_ids: list[int],
+                   cohort_table: str = "cohort",
+                   vocabulary_database_schema: str | None = None,
+                   time_windows: list[tuple[int, int]] = DEFAULT_TIME_WINDOWS,
+                   analyses: tuple[str, ...] = DEFAULT_ANALYSES,
+                   temp_emulation_schema: str | None = None) \
+        -> tuple[pd.DataFrame, pd.Series, pd.DataFrame]:
+    """
+    Extract the events of the cohort entries in a single pass
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection
+    cohort_database_schema : str
+        The schema containing the cohort table
+    cdm_database_schema : str
+        The schema containing the OMOP CDM
+    cohort_ids : list[int]
+        The cohorts to characterize
+    cohort_table : str, optional
+        The name of the cohort table, by default "cohort"
+    vocabulary_database_schema : str, optional
+        The schema containing the vocabulary, by default the CDM schema
+    time_windows : list[tuple[int, int]], optional
+        The start and end day of the time windows, relative to the cohort
+        start, by default ``DEFAULT_TIME_WINDOWS``. Only events within the
+        span of all windows are extracted.
+    analyses : tuple[str, ...], optional
+        The analyses (keys of ``ANALYSES``), by default ``DEFAULT_ANALYSES``
+    temp_emulation_schema : str, optional
+        The schema to use for temp tables
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.Series, pd.DataFrame]
+        The events (cohort_id, subject_id, cohort_start_date, analysis_id,
+        concept_id, start_day, end_day), the number of entries per cohort
+        and the names of the concepts
+    """
+    unknown = set(analyses) - set(ANALYSES)
+    if unknown:
+        raise ValueError(f"Unknown analyses {sorted(unknown)}, choose from "
+                         f"{list(ANALYSES)}")
+
+    events_sql = "\nUNION ALL\n".join(
+        _ANALYSIS_SQL.format(analysis_id=analysis_id, table=table,
+                             concept=concept, start=start,
+                             end=end or start)
+        for analysis_id, _, table, concept, start, end
+        in (ANALYSES[a] for a in analyses)
+    )
+    parameters = {
+        "cohort_database_schema": cohort_database_schema,
+        "cohort_table": cohort_table,
+        "cdm_database_schema": cdm_database_schema,
+        "vocabulary_database_schema":
+            vocabulary_database_schema or cdm_database_schema,
+        "cohort_ids": ",".join(str(int(i)) for i in cohort_ids),
+        "min_start_day": min(start for start, _ in time_windows),
+        "max_end_day": max(end for _, end in time_windows),
+    }
+    temp = {"temp_emulation_schema": temp_emulation_schema} \
+        if temp_emulation_schema else {}
+
+    database_connector.render_translate_execute_sql(
+        connection, _EVENTS_SQL.format(events=events_sql), **temp,
+        **parameters)
+    try:
+        events = _query(connection, "SELECT * FROM #temporal_events;",
+                        **temp)
+        entries = _query(connection, _ENTRIES_SQL, **temp, **parameters)
+        concepts = _query(connection, _CONCEPTS_SQL, **temp, **parameters)
+    finally:
+        database_connector.render_translate_execute_sql(
+            connection, _DROP_SQL, **temp)
+
+    events.columns = ["cohort_id", "subject_id", "cohort_start_date",
+                      "analysis_id", "concept_id", "start_day", "end_day"]
+    entries = entries.set_index("cohortId")["entries"].astype("int64")
+    entries.index = entries.index.astype("int64")
+    concepts.columns = ["concept_id", "concept_name"]
+    return events, entries, concepts
+
+
+def aggregate_time_windows(events: pd.DataFrame, entries: pd.Series,
+                           time_windows: list[tuple[int, int]]
+                           = DEFAULT_TIME_WINDOWS) -> pd.DataFrame:
+    """
+    Compute the binary covariates of all time windows
+
+    A cohort entry has a covariate in a time window when one of its events
+    of the covariate overlaps the window.
+
+    Parameters
+    ----------
+    events : pd.DataFrame
+        The events as returned by ``extract_events``
+    entries : pd.Series
+        The number of entries per cohort ID
+    time_windows : list[tuple[int, int]], optional
+        The start and end day of the time windows, by default
+        ``DEFAULT_TIME_WINDOWS``. The ``time_id`` of a window is its
+        position in this list, starting at 1.
+
+    Returns
+    -------
+    pd.DataFrame
+        The cohort_id, time_id, covariate_id, sum_value, mean and sd of each
+        covariate that occurs in a time window
+    """
+    columns = ["cohort_id", "time_id", "covariate_id", "sum_value", "mean",
+               "sd"]
+    if events.empty:
+        return pd.DataFrame(columns=columns)
+
+    entry = events.groupby(["cohort_id", "subject_id", "cohort_start_date"],
+                           sort=False).ngroup().to_numpy("int64")
+    cohort, cohorts = pd.factorize(events["cohort_id"].to_numpy("int64"))
+    cohort_of_entry = np.empty(entry.max() + 1, dtype="int64")
+    cohort_of_entry[entry] = cohort
+    covariate_ids = events["concept_id"].to_numpy("int64") * 1000 \
+        + events["analysis_id"].to_numpy("int64")
+    covariate, covariates = pd.factorize(covariate_ids)
+    n_covariates = len(covariates)
+
+    # sort the events once by entry and covariate, so that within a window
+    # the events of the same entry and covariate are adjacent
+    key = entry * n_covariates + covariate
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    start = events["start_day"].to_numpy("int64")[order]
+    end = events["end_day"].to_numpy("int64")[order]
+    cohort_covariate = cohort_of_entry[key // n_covariates] * n_covariates \
+        + key % n_covariates
+    # count with a dense array, unless it is much larger than the events
+    n_cells = len(cohorts) * n_covariates
+    dense = n_cells <= 4 * len(key)
+
+    results = []
+    for time_id, (start_day, end_day) in enumerate(time_windows, 1):
+        in_window = (start <= end_day) & (end >= start_day)
+        window_keys = key[in_window]
+        # an entry counts once per covariate, no matter its events
+        first = np.ones(len(window_keys), dtype=bool)
+        first[1:] = window_keys[1:] != window_keys[:-1]
+        window_cells = cohort_covariate[in_window][first]
+        if dense:
+            counts = np.bincount(window_cells, minlength=n_cells)
+            values = np.flatnonzero(counts)
+            counts = counts[values]
+        else:
+            values, counts = np.unique(window_cells, return_counts=True)
+        results.append(pd.DataFrame({
+            "cohort_id": cohorts[values // n_covariates],
+            "time_id": time_id,
+            "covariate_id": covariates[values % n_covariates],
+            "sum_value": counts,
+        }))
+
+    result = pd.concat(results, ignore_index=True)
+    result["mean"] = result["sum_value"] \
+        / result["cohort_id"].map(entries).to_numpy("float64")
+    result["sd"] = np.sqrt(result["mean"] * (1 - result["mean"]))
+    return result[columns]
+
+
+def temporal_cohort_characterization(
+        connection: RS4, cohort_database_schema: str,
+        cdm_database_schema: str, cohort_ids: list[int], database_id: str,
+        cohort_table: str = "cohort",
+        vocabulary_database_schema: str | None = None,
+        time_windows: list[tuple[int, int]] = DEFAULT_TIME_WINDOWS,
+        analyses: tuple[str, ...] = DEFAULT_ANALYSES,
+        min_cell_count: int = 5, min_characterization_mean: float = 0.01,
+        temp_emulation_schema: str | None = None) -> dict[str, pd.DataFrame]:
+    """
+    Characterize cohorts in all time windows with a single extraction
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection
+    cohort_database_schema : str
+        The schema containing the cohort table
+    cdm_database_schema : str
+        The schema containing the OMOP CDM
+    cohort_ids : list[int]
+        The cohorts to characterize
+    database_id : str
+        The identifier of the database in the results
+    cohort_table : str, optional
+        The name of the cohort table, by default "cohort"
+    vocabulary_database_schema : str, optional
+        The schema containing the vocabulary, by default the CDM schema
+    time_windows : list[tuple[int, int]], optional
+        The start and end day of the time windows, by default
+        ``DEFAULT_TIME_WINDOWS``
+    analyses : tuple[str, ...], optional
+        The analyses (keys of ``ANALYSES``), by default ``DEFAULT_ANALYSES``
+    min_cell_count : int, optional
+        Counts below this are censored (as ``-min_cell_count``), by default 5
+    min_characterization_mean : float, optional
+        Covariates with a lower mean are left out, by default 0.01
+    temp_emulation_schema : str, optional
+        The schema to use for temp tables
+
+    Returns
+    -------
+    dict[str, pd.DataFrame]
+        The ``temporal_covariate_value``, ``temporal_covariate_ref``,
+        ``temporal_analysis_ref`` and ``temporal_time_ref`` tables
+    """
+    events, entries, concepts = extract_events(
+        connection, cohort_database_schema, cdm_database_schema, cohort_ids,
+        cohort_table, vocabulary_database_schema, time_windows, analyses,
+        temp_emulation_schema
+    )
+    values = aggregate_time_windows(events, entries, time_windows)
+    values = values[values["mean"] >= min_characterization_mean].copy()
+    censored = values["sum_value"] < min_cell_count
+    values.loc[censored, "sum_value"] = -min_cell_count
+    values.loc[censored, "mean"] = -min_cell_count \
+        / values.loc[censored, "cohort_id"].map(entries)
+    values.insert(0, "database_id", database_id)
+
+    analysis_names = {ANALYSES[a][0]: a for a in analyses}
+    covariate_ids = pd.Series(values["covariate_id"].unique(), dtype="int64")
+    covariate_ref = pd.DataFrame({
+        "covariate_id": covariate_ids,
+        "analysis_id": covariate_ids % 1000,
+        "concept_id": covariate_ids // 1000,
+    })
+    names = dict(zip(concepts["concept_id"], concepts["concept_name"]))
+    covariate_ref.insert(1, "covariate_name", [
+        f"{analysis_names[a]}: {names.get(c, '')}"
+        for a, c in zip(covariate_ref["analysis_id"],
+                        covariate_ref["concept_id"])
+    ])
+
+    return {
+        "temporal_covariate_value": values,
+        "temporal_covariate_ref": covariate_ref,
+        "temporal_analysis_ref": pd.DataFrame({
+            "analysis_id": [ANALYSES[a][0] for a in analyses],
+            "analysis_name": list(analyses),
+            "domain_id": [ANALYSES[a][1] for a in analyses],
+            "is_binary": "Y",
+            "missing_means_zero": "Y",
+        }),
+        "temporal_time_ref": pd.DataFrame({
+            "time_id": range(1, len(time_windows) + 1),
+            "start_day": [start for start, _ in time_windows],
+            "end_day": [end for _, end in time_windows],
+        }),
+    }
@@ -2,10 +2,28 @@ import os
 
 from pathlib import Path
 
+import pandas as pd
+
 from rpy2.robjects.methods import RS4
 from rpy2.robjects.vectors import ListVector
 from rpy2.robjects.packages import importr
 
+from ohdsi import database_connector
+from ohdsi.common import convert_from_r, convert_to_r, to_lower_camel_case
+from ohdsi.cohort_generator.counts import (
+    CohortCountService,
+    counts_table_exists,
+    refresh_cohort_counts
+)
+from ohdsi.cohort_generator.export import (
+    STATS_TABLES,
+    export_cohort_stats_incremental
+)
+from ohdsi.cohort_generator.definition_set import (
+    read_cohort_definition_set,
+    write_cohort_definition_set
+)
+
 # When building documentation for the project, the following import will fail
 # as the package is not installed. In this case, we set the variable to None
 # so that the documentation can be built.
@@ -17,11 +35,21 @@ else:
     base_r = importr('base')
 
 
+def _as_r_cohort_definition_set(
+    cohort_definition_set: RS4 | pd.DataFrame | None
+) -> RS4 | None:
+    """ Convert a pandas cohort definition set to R, copying it only once """
+    if isinstance(cohort_definition_set, pd.DataFrame):
+        return convert_to_r(cohort_definition_set)
+    return cohort_definition_set
+
+
 # -----------------------------------------------------------------------------
 # wrapper: CohortGenerator/R/CohortDefinitionSet.R
 # functions:
 #    - create_empty_cohort_definition_set (createEmptyCohortDefinitionSet)
 #    - save_cohort_definition_set (saveCohortDefinitionSet)
+#    - get_cohort_definition_set (getCohortDefinitionSet)
 # -----------------------------------------------------------------------------
 def create_empty_cohort_definition_set(verbose: bool = False) -> RS4:
     """
@@ -40,14 +68,16 @@ def create_empty_cohort_definition_set(verbose: bool = False) -> RS4:
 
 
 def save_cohort_definition_set(
-    cohort_definition_set: RS4,
+    cohort_definition_set: RS4 | pd.DataFrame,
     settings_file_name: str | Path = "inst/cohorts.csv",
     json_folder: str | Path = "inst/cohorts",
     sql_folder: str | Path = "inst/sql/sql_server",
     cohort_file_name_format: str = "%s",
     cohort_file_name_value: list[str] = ["cohort_id"],
     subset_json_folder: str | Path = "inst/cohort_subset_definitions/",
-    verbose: bool = False
+    verbose: bool = False,
+    engine: str = "r",
+    max_workers: int | None = None
 ) -> None:
     """
     Save the cohort definition set to the file system
@@ -65,8 +95,9 @@ def save_cohort_definition_set(
 
     Parameters
     ----------
-    cohort_definition_set : RS4
-        A CohortDefinitionSet object
+    cohort_definition_set : RS4 | pd.DataFrame
+        A CohortDefinitionSet object, or a pandas data frame with the same
+        columns
     settings_file_name : str, optional
         The name of the CSV file that will hold the cohort information
         including the cohortId and cohortName
@@ -87,15 +118,94 @@ def save_cohort_definition_set(
         Defines the folder to store the subset JSON
     verbose : bool, optional
         When TRUE, logging messages are emitted to indicate export
-        progress. By default False.
+        progress. Only used by the R engine. By default False.
+    engine : str, optional
+        Write the files with CohortGenerator in "r", or with "python", in
+        parallel and skipping the files whose content did not change. Sets
+        with subset definitions are always written by R. By default "r".
+    max_workers : int, optional
+        The number of threads writing files with the Python engine
     """
+    if engine not in ("python", "r"):
+        raise ValueError(f"Unknown engine {engine}, choose 'python' or 'r'")
+    # the subset definitions are an attribute of the R data frame, which
+    # does not survive the conversion to pandas
+    has_subsets = not isinstance(cohort_definition_set, pd.DataFrame) and \
+        "cohortSubsetDefinitions" in cohort_definition_set.list_attrs()
+    if engine == "python" and not has_subsets:
+        if not isinstance(cohort_definition_set, pd.DataFrame):
+            cohort_definition_set = convert_from_r(cohort_definition_set)
+        write_cohort_definition_set(
+            cohort_definition_set, settings_file_name, json_folder,
+            sql_folder, cohort_file_name_format, cohort_file_name_value,
+            max_workers
+        )
+        return
+
     return cohort_generator.saveCohortDefinitionSet(
-        cohort_definition_set, settings_file_name, json_folder, sql_folder,
-        cohort_file_name_format, cohort_file_name_value,
-        subset_json_folder, verbose
+        _as_r_cohort_definition_set(cohort_definition_set),
+        settings_file_name, json_folder, sql_folder, cohort_file_name_format,
+        cohort_file_name_value, subset_json_folder, verbose
     )
 
 
+def get_cohort_definition_set(
+    settings_file_name: str | Path = "inst/cohorts.csv",
+    json_folder: str | Path = "inst/cohorts",
+    sql_folder: str | Path = "inst/sql/sql_server",
+    cohort_file_name_format: str = "%s",
+    cohort_file_name_value: list[str] = ["cohort_id"],
+    engine: str = "r",
+    max_workers: int | None = None
+) -> RS4 | pd.DataFrame:
+    """
+    Load a cohort definition set from the file system
+
+    Reads the files written by ``save_cohort_definition_set``.
+
+    Wraps the R ``CohortGenerator::getCohortDefinitionSet`` function
+    defined in ``CohortGenerator/R/CohortDefinitionSet.R``.
+
+    Parameters
+    ----------
+    settings_file_name : str, optional
+        The name of the CSV file with the cohort information
+    json_folder : str, optional
+        The name of the folder with the JSON of the cohorts
+    sql_folder : str, optional
+        The name of the folder with the SQL of the cohorts
+    cohort_file_name_format : str, optional
+        The format string of the cohort JSON and SQL file names
+    cohort_file_name_value : list[str], optional
+        The columns used in conjunction with the cohort_file_name_format
+    engine : str, optional
+        Read the files with CohortGenerator in "r", or with "python", in
+        parallel, by default "r"
+    max_workers : int, optional
+        The number of threads reading files with the Python engine
+
+    Returns
+    -------
+    RS4 | pd.DataFrame
+        The cohort definition set, as pandas data frame with the Python
+        engine. It can be passed to ``generate_cohort_set`` as is.
+    """
+    if engine == "python":
+        return read_cohort_definition_set(
+            settings_file_name, json_folder, sql_folder,
+            cohort_file_name_format, cohort_file_name_value, max_workers
+        )
+    elif engine != "r":
+        raise ValueError(f"Unknown engine {engine}, choose 'python' or 'r'")
+    return cohort_generator.getCohortDefinitionSet(
+        settingsFileName=str(settings_file_name),
+        jsonFolder=str(json_folder),
+        sqlFolder=str(sql_folder),
+        cohortFileNameFormat=cohort_file_name_format,
+        cohortFileNameValue=[to_lower_camel_case(c)
+                             for c in cohort_file_name_value]
+    )
+
 # -----------------------------------------------------------------------------
 # wrapper: CohortGenerator/R/CohortConstruction.R
 # functions:
@@ -103,7 +213,7 @@ def save_cohort_definition_set(
 # -----------------------------------------------------------------------------
 def generate_cohort_set(
     cdm_database_schema: str,
-    cohort_definition_set: RS4,
+    cohort_definition_set: RS4 | pd.DataFrame,
     connection_details: ListVector | None = None,
     connection: RS4 | None = None,
     temp_emulation_schema: str | None = None,
@@ -111,7 +221,8 @@ def generate_cohort_set(
     cohort_table_names: ListVector | None = None,
     stop_on_error: bool = True,
     incremental: bool = False,
-    incremental_folder: str | Path = None
+    incremental_folder: str | Path = None,
+    refresh_counts: bool = True
 ) -> RS4:
     """
     Generate a cohort set
@@ -125,6 +236,8 @@ def generate_cohort_set(
     ----------
     cdm_database_schema : str
         The schema containing the CDM
+    cohort_definition_set : RS4 | pd.DataFrame
+        The cohort definition set, as R data.frame or pandas data frame
     connection_details : ListVector | None, optional
         The connection details obtained using
         ``Connect.create_connection_details(...)``, by default None
@@ -133,8 +246,13 @@ def generate_cohort_set(
         default None
     temp_emulation_schema : None, optional
         The schema to use for temp tables, by default None
-
-
+    refresh_counts : bool, optional
+        Whether the materialized counts of the cohort table (see
+        ``CohortCountService``) are refreshed once the cohorts are
+        generated, when they exist. This scans the cohort table, on a
+        connection of its own when only ``connection_details`` are given.
+        Without it, the counts table of a regenerated cohort table is
+        stale until ``refresh_cohort_counts`` is called. By default True.
     """
     args = {
         "cdmDatabaseSchema": cdm_database_schema,
@@ -143,14 +261,41 @@ def generate_cohort_set(
         "tempEmulationSchema": temp_emulation_schema,
         "cohortDatabaseSchema": cohort_database_schema,
         "cohortTableNames": cohort_table_names,
-        "cohortDefinitionSet": cohort_definition_set,
+        "cohortDefinitionSet":
+            _as_r_cohort_definition_set(cohort_definition_set),
         "stopOnError": stop_on_error,
         "incremental": incremental,
         "incrementalFolder": incremental_folder
     }
     # remove None values
     args = {k: v for k, v in args.items() if v is not None}
-    return cohort_generator.generateCohortSet(**args)
+    generated = cohort_generator.generateCohortSet(**args)
+    if refresh_counts:
+        _refresh_materialized_counts(
+            connection_details, connection,
+            cohort_database_schema or cdm_database_schema,
+            cohort_table_names.rx2("cohortTable")[0]
+            if cohort_table_names is not None else "cohort"
+        )
+    return generated
+
+
+def _refresh_materialized_counts(connection_details: ListVector | None,
+                                 connection: RS4 | None,
+                                 cohort_database_schema: str,
+                                 cohort_table: str) -> None:
+    """ Refresh the counts of a cohort table, when they are materialized """
+    own_connection = connection is None
+    if own_connection:
+        connection = database_connector.connect(connection_details)
+    try:
+        if counts_table_exists(connection, cohort_database_schema,
+                               cohort_table):
+            refresh_cohort_counts(connection, cohort_database_schema,
+                                  cohort_table)
+    finally:
+        if own_connection:
+            database_connector.disconnect(connection)
 
 
 # -----------------------------------------------------------------------------
@@ -266,13 +411,14 @@ def get_cohort_counts(
     connection: RS4 | None = None,
     cohort_table: str = "cohort",
     cohort_ids: list[int] = [],
-    cohort_definition_set: RS4 = None,
+    cohort_definition_set: RS4 | pd.DataFrame | None = None,
     database_id: int | None = None
 ) -> RS4:
     """
     Get cohort counts.
 
-    Gets the counts for the specified cohort ids.
+    Gets the counts for the specified cohort ids. This scans the cohort
+    table, use ``CohortCountService`` for cached counts of many cohort tables.
 
     Wraps the R ``CohortGenerator::getCohortCounts`` function defined in
     ``CohortGenerator/R/CohortCount.R``.
@@ -289,7 +435,7 @@ def get_cohort_counts(
         The name of the cohort table, by default "cohort"
     cohort_ids : list[int], optional
         The cohort ids to get the counts for, by default []
-    cohort_definition_set : RS4, optional
+    cohort_definition_set : RS4 | pd.DataFrame, optional
         The cohort definition set, by default None
     database_id : str, optional
         The database id, by default None
@@ -305,7 +451,8 @@ def get_cohort_counts(
         "connection": connection,
         "cohortTable": cohort_table,
         "cohortIds": cohort_ids,
-        "cohortDefinitionSet": cohort_definition_set,
+        "cohortDefinitionSet":
+            _as_r_cohort_definition_set(cohort_definition_set),
         "databaseId": database_id
     }
     # remove None values
@@ -327,7 +474,10 @@ def export_cohort_stats_tables(
     snake_case_to_camel_case: bool = True,
     file_names_in_snake_case: bool = False,
     incremental: bool = False,
-    database_id: str | None = None
+    database_id: str | None = None,
+    results_format: str = "csv",
+    max_workers: int = 1,
+    full_refresh: bool = False
 ):
     """
     Export the cohort statistics tables to the file system
@@ -355,15 +505,40 @@ def export_cohort_stats_tables(
     file_names_in_snake_case : bool, optional
         Should the exported files use snake_case? Default is FALSE
     incremental : bool, optional
-        A boolean representing if the tables should be created
-        incrementally, by default False
+        Only fetch the statistics of the cohorts that changed since the
+        previous export to the folder, see
+        ``export_cohort_stats_incremental``. By default False.
     database_id : str, optional
         When specified, the databaseId will be added to the exported results
+    results_format : str, optional
+        The format of the incremental export, "csv" or "parquet", by default
+        "csv"
+    max_workers : int, optional
+        The number of tables the incremental export fetches concurrently,
+        each on its own connection, by default 1
+    full_refresh : bool, optional
+        Let the incremental export fetch all cohorts again, as its checksums
+        do not detect all changes. By default False.
     """
     
     if cohort_table_names is None:
         cohort_table_names = get_cohort_table_names()
 
+    if incremental:
+        return export_cohort_stats_incremental(
+            cohort_database_schema, cohort_statistics_folder,
+            {name: str(cohort_table_names.rx2(name)[0])
+             for name in STATS_TABLES},
+            connection_details=connection_details,
+            connection=connection,
+            snake_case_to_camel_case=snake_case_to_camel_case,
+            file_names_in_snake_case=file_names_in_snake_case,
+            database_id=database_id,
+            results_format=results_format,
+            max_workers=max_workers,
+            full_refresh=full_refresh
+        )
+
     args = {
         "cohortDatabaseSchema": cohort_database_schema,
         "cohortStatisticsFolder": cohort_statistics_folder,
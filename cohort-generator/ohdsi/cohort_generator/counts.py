@@ -0,0 +1,229 @@
+"""
+Cohort counts from a materialized counts table
+
+Counting a cohort table scans the whole table. Instead, the counts of each
+cohort table are stored in a small table next to it
+(``<cohort_table>_materialized_counts``, a name that is unlikely to be taken
+by a table of the user, as it is dropped on every refresh). The counts are
+refreshed by ``generate_cohort_set`` once the cohorts are (re)generated, or
+with ``refresh_cohort_counts`` after the cohort table is changed otherwise. A
+``CohortCountService`` reads the counts of many cohort tables in one query
+and keeps them in memory for a while, so that dashboards polling the counts
+rarely reach the database. The cohort table is only scanned when its counts
+table does not exist yet, or when a refresh is requested.
+"""
+from __future__ import annotations
+
+import time
+import threading
+import weakref
+
+import pandas as pd
+
+from rpy2.robjects.methods import RS4
+from rpy2.robjects.vectors import ListVector
+
+from ohdsi import database_connector
+from ohdsi.common import convert_bool_from_r, convert_from_r
+
+COUNTS_TABLE_SUFFIX = "_materialized_counts"
+
+_REFRESH_SQL = """
+IF OBJECT_ID('@cohort_database_schema.@counts_table', 'U') IS NOT NULL
+  DROP TABLE @cohort_database_schema.@counts_table;
+
+SELECT cohort_definition_id AS cohort_id,
+  COUNT(*) AS cohort_entries,
+  COUNT(DISTINCT subject_id) AS cohort_subjects
+INTO @cohort_database_schema.@counts_table
+FROM @cohort_database_schema.@cohort_table
+GROUP BY cohort_definition_id;
+"""
+
+_READ_SQL = """
+SELECT '{cohort_table}' AS cohort_table, cohort_id, cohort_entries,
+  cohort_subjects
+FROM @cohort_database_schema.{counts_table}
+"""
+
+# the services whose cached counts are invalidated by a refresh
+_services = weakref.WeakSet()
+
+
+def counts_table_exists(connection: RS4, cohort_database_schema: str,
+                        cohort_table: str = "cohort") -> bool:
+    """ Whether the counts of a cohort table are materialized """
+    return convert_bool_from_r(
+        database_connector.database_connector_r.existsTable(
+            connection, cohort_database_schema,
+            f"{cohort_table}{COUNTS_TABLE_SUFFIX}"))
+
+
+def refresh_cohort_counts(connection: RS4, cohort_database_schema: str,
+                          cohort_table: str = "cohort") -> None:
+    """
+    Count a cohort table and store the counts in its counts table
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection
+    cohort_database_schema : str
+        The schema containing the cohort table
+    cohort_table : str, optional
+        The name of the cohort table, by default "cohort"
+    """
+    database_connector.render_translate_execute_sql(
+        connection, _REFRESH_SQL,
+        cohort_database_schema=cohort_database_schema,
+        cohort_table=cohort_table,
+        counts_table=f"{cohort_table}{COUNTS_TABLE_SUFFIX}"
+    )
+    invalidate_cohort_counts(cohort_database_schema, cohort_table)
+
+
+def invalidate_cohort_counts(cohort_database_schema: str,
+                             cohort_table: str | None = None) -> None:
+    """ Drop cached counts of a cohort table (or all tables of a schema) """
+    for service in list(_services):
+        if service.cohort_database_schema == cohort_database_schema:
+            service.invalidate(cohort_table)
+
+
+class CohortCountService:
+    """
+    Cached cohort counts, read from the materialized counts tables
+
+    Counts are cached for ``ttl`` seconds, after which they are read from
+    the counts table again. Cached counts are dropped when the counts table
+    is refreshed in this process (e.g. by ``refresh_cohort_counts``). The
+    service can be shared between threads, its database calls are
+    serialized.
+
+    Args:
+        cohort_database_schema (str): The schema containing the cohort
+            tables
+        connection_details (ListVector, optional): Used to open a connection
+            when it is first needed, which is kept open until ``close``
+        connection (RS4, optional): An open connection to use instead
+        ttl (float, optional): The number of seconds counts are cached.
+            Defaults to 60.
+
+    Examples:
+        >>> service = CohortCountService("main", connection=connection)
+        >>> service.get_counts("cohort")
+        >>> service.get_counts_batch(["cohort", "negative_controls"])
+    """
+    def __init__(self, cohort_database_schema: str,
+                 connection_details: ListVector | None = None,
+                 connection: RS4 | None = None, ttl: float = 60.0):
+        if connection is None and connection_details is None:
+            raise ValueError("Provide a connection or connection_details")
+        self.cohort_database_schema = cohort_database_schema
+        self.ttl = ttl
+        self._connection_details = connection_details
+        self._connection = connection
+        self._own_connection = connection is None
+        self._cache: dict[str, tuple[float, pd.DataFrame]] = {}
+        self._materialized: set[str] = set()
+        self._lock = threading.RLock()
+        _services.add(self)
+
+    @property
+    def connection(self) -> RS4:
+        if self._connection is None:
+            self._connection = database_connector.connect(
+                self._connection_details)
+        return self._connection
+
+    def close(self) -> None:
+        """ Close the connection, when it was opened by the service """
+        with self._lock:
+            if self._own_connection and self._connection is not None:
+                database_connector.disconnect(self._connection)
+                self._connection = None
+
+    def invalidate(self, cohort_table: str | None = None) -> None:
+        """ Drop the cached counts of a cohort table, or of all tables """
+        with self._lock:
+            if cohort_table is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(cohort_table, None)
+
+    def refresh(self, cohort_table: str = "cohort") -> None:
+        """ Count the cohort table again, and store the counts """
+        with self._lock:
+            refresh_cohort_counts(self.connection,
+                                  self.cohort_database_schema, cohort_table)
+            self._materialized.add(cohort_table)
+
+    def get_counts(self, cohort_table: str = "cohort",
+                   cohort_ids: list[int] | None = None) -> pd.DataFrame:
+        """
+        Get the counts of a cohort table
+
+        Args:
+            cohort_table (str, optional): The name of the cohort table.
+                Defaults to "cohort".
+            cohort_ids (list[int], optional): Restrict the counts to these
+                cohorts. Defaults to all cohorts.
+
+        Returns:
+            pd.DataFrame: The cohortId, cohortEntries and cohortSubjects of
+                each cohort
+        """
+        counts = self.get_counts_batch([cohort_table])[cohort_table]
+        if cohort_ids:
+            counts = counts[counts["cohortId"].isin(cohort_ids)]
+        return counts.reset_index(drop=True)
+
+    def get_counts_batch(self, cohort_tables: list[str]) \
+            -> dict[str, pd.DataFrame]:
+        """
+        Get the counts of many cohort tables, with a single query
+
+        Args:
+            cohort_tables (list[str]): The names of the cohort tables
+
+        Returns:
+            dict[str, pd.DataFrame]: The counts per cohort table
+        """
+        with self._lock:
+            now = time.monotonic()
+            stale = [t for t in dict.fromkeys(cohort_tables)
+                     if t not in self._cache
+                     or now - self._cache[t][0] > self.ttl]
+            if stale:
+                self._read(stale)
+            return {t: self._cache[t][1] for t in cohort_tables}
+
+    def _read(self, cohort_tables: list[str]) -> None:
+        # tables that were never counted are scanned once
+        for cohort_table in cohort_tables:
+            if cohort_table not in self._materialized:
+                if not counts_table_exists(self.connection,
+                                           self.cohort_database_schema,
+                                           cohort_table):
+                    refresh_cohort_counts(self.connection,
+                                          self.cohort_database_schema,
+                                          cohort_table)
+                self._materialized.add(cohort_table)
+
+        sql = "UNION ALL".join(
+            _READ_SQL.format(
+                cohort_table=cohort_table,
+                counts_table=f"{cohort_table}{COUNTS_TABLE_SUFFIX}")
+            for cohort_table in cohort_tables
+        )
+        counts = convert_from_r(database_connector.render_translate_query_sql(
+            self.connection, sql, snake_case_to_camel_case=True,
+            cohort_database_schema=self.cohort_database_schema
+        ))
+
+        read_at = time.monotonic()
+        for cohort_table in cohort_tables:
+            table = counts[counts["cohortTable"] == cohort_table]
+            table = table.drop(columns="cohortTable").astype("int64")
+            self._cache[cohort_table] = (
+                read_at, table.sort_values("cohortId", ignore_index=True))
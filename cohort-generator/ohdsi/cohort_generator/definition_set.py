@@ -0,0 +1,175 @@
+"""
+Cohort definition sets on the file system, without R
+
+Reads and writes the layout of CohortGenerator's ``saveCohortDefinitionSet``
+and ``getCohortDefinitionSet``: a settings CSV with one (snake_case) row per
+cohort, and a JSON and SQL file per cohort whose names are formatted from
+the columns of the set. The files are read and written by a thread pool, and
+files whose content did not change are not written again, so saving a large
+library after changing a few cohorts only touches those.
+"""
+from __future__ import annotations
+
+import io
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from ohdsi.common import to_lower_camel_case, to_snake_case
+
+# the columns that are stored in files of their own
+_FILE_COLUMNS = {"json": ".json", "sql": ".sql"}
+
+
+def _sprintf_value(value):
+    # R formats a double with an integral value without decimals, e.g. the
+    # cohortId of a set created in R is 1 rather than 1.0
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _file_names(cohort_definition_set: pd.DataFrame,
+                cohort_file_name_format: str,
+                cohort_file_name_value: list[str]) -> list[str]:
+    # the format follows R's sprintf, which agrees with Python's % for the
+    # usual conversions (%s, %d)
+    columns = [to_lower_camel_case(c) for c in cohort_file_name_value]
+    return [cohort_file_name_format % tuple(map(_sprintf_value, values))
+            for values in zip(*(cohort_definition_set[c].tolist()
+                                for c in columns))]
+
+
+def _write_if_changed(file: Path, content: str) -> bool:
+    """ Write a text file, unless it has this content already """
+    data = content.encode("utf-8")
+    if file.exists() and file.stat().st_size == len(data) and \
+            hashlib.sha256(file.read_bytes()).digest() \
+            == hashlib.sha256(data).digest():
+        return False
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(data)
+    return True
+
+
+def write_cohort_definition_set(
+    cohort_definition_set: pd.DataFrame,
+    settings_file_name: str | Path = "inst/cohorts.csv",
+    json_folder: str | Path = "inst/cohorts",
+    sql_folder: str | Path = "inst/sql/sql_server",
+    cohort_file_name_format: str = "%s",
+    cohort_file_name_value: list[str] = ["cohort_id"],
+    max_workers: int | None = None
+) -> int:
+    """
+    Write a cohort definition set to the file system
+
+    Parameters
+    ----------
+    cohort_definition_set : pd.DataFrame
+        The cohort definition set, with (at least) the columns cohortId,
+        cohortName, json and sql
+    settings_file_name : str | Path, optional
+        The CSV file with the cohorts, by default "inst/cohorts.csv"
+    json_folder : str | Path, optional
+        The folder for the JSON files, by default "inst/cohorts"
+    sql_folder : str | Path, optional
+        The folder for the SQL files, by default "inst/sql/sql_server"
+    cohort_file_name_format : str, optional
+        The format of the JSON and SQL file names, by default "%s"
+    cohort_file_name_value : list[str], optional
+        The columns whose values are formatted into the file names, by
+        default ["cohort_id"]
+    max_workers : int, optional
+        The number of threads writing files, by default chosen by Python
+
+    Returns
+    -------
+    int
+        The number of files that were (re)written
+    """
+    names = _file_names(cohort_definition_set, cohort_file_name_format,
+                        cohort_file_name_value)
+    folders = {"json": Path(json_folder), "sql": Path(sql_folder)}
+    files = [
+        (folders[column] / f"{name}{suffix}", content)
+        for column, suffix in _FILE_COLUMNS.items()
+        if column in cohort_definition_set
+        for name, content in zip(names, cohort_definition_set[column])
+        if isinstance(content, str)
+    ]
+
+    settings = cohort_definition_set.drop(
+        columns=[c for c in _FILE_COLUMNS if c in cohort_definition_set])
+    settings.columns = [to_snake_case(c) for c in settings.columns]
+    # like R, write doubles with integral values without decimals
+    settings = settings.astype({
+        c: "Int64" for c in settings.select_dtypes("float").columns
+        if (settings[c].dropna() % 1 == 0).all()
+    })
+    csv = io.StringIO()
+    settings.to_csv(csv, index=False)
+    files.append((Path(settings_file_name), csv.getvalue()))
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        return sum(pool.map(lambda f: _write_if_changed(*f), files))
+
+
+def read_cohort_definition_set(
+    settings_file_name: str | Path = "inst/cohorts.csv",
+    json_folder: str | Path = "inst/cohorts",
+    sql_folder: str | Path = "inst/sql/sql_server",
+    cohort_file_name_format: str = "%s",
+    cohort_file_name_value: list[str] = ["cohort_id"],
+    max_workers: int | None = None
+) -> pd.DataFrame:
+    """
+    Read a cohort definition set from the file system
+
+    Parameters
+    ----------
+    settings_file_name : str | Path, optional
+        The CSV file with the cohorts, by default "inst/cohorts.csv"
+    json_folder : str | Path, optional
+        The folder with the JSON files, by default "inst/cohorts"
+    sql_folder : str | Path, optional
+        The folder with the SQL files, by default "inst/sql/sql_server"
+    cohort_file_name_format : str, optional
+        The format of the JSON and SQL file names, by default "%s"
+    cohort_file_name_value : list[str], optional
+        The columns whose values are formatted into the file names, by
+        default ["cohort_id"]
+    max_workers : int, optional
+        The number of threads reading files, by default chosen by Python
+
+    Returns
+    -------
+    pd.DataFrame
+        The cohort definition set with camelCase columns. Missing JSON
+        files result in a missing value.
+    """
+    settings = pd.read_csv(settings_file_name)
+    settings.columns = [to_lower_camel_case(c) for c in settings.columns]
+    settings["cohortId"] = settings["cohortId"].astype("int64")
+    names = _file_names(settings, cohort_file_name_format,
+                        cohort_file_name_value)
+
+    def read(file: Path) -> str | None:
+        return file.read_text("utf-8") if file.exists() else None
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        for column, folder in (("json", json_folder), ("sql", sql_folder)):
+            settings[column] = list(pool.map(
+                read, (Path(folder) / f"{name}{_FILE_COLUMNS[column]}"
+                       for name in names)))
+
+    missing_sql = settings["sql"].isna()
+    if missing_sql.any():
+        raise FileNotFoundError(
+            "No SQL found for cohort(s) "
+            f"{settings.loc[missing_sql, 'cohortId'].tolist()} in {sql_folder}"
+        )
+    return settings
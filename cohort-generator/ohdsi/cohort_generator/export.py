@@ -0,0 +1,377 @@
+"""
+Incremental export of the cohort statistics tables
+
+CohortGenerator's ``exportCohortStatsTables`` fetches the complete statistics
+tables on every export. This exporter first computes a small checksum per
+cohort in the database (row count and sums of the columns), and fetches only
+the rows of the cohorts whose checksum changed since the previous export
+into the same folder. These rows are fetched in batches of cohorts and
+streamed to the CSV or Parquet files, replacing the earlier rows of these
+cohorts. The statistics tables are exported concurrently when a pool of
+workers, each with its own connection, is used.
+
+The checksums are cheap aggregates, not hashes of the rows: changes that
+keep the count and the sums of a cohort, such as values swapped between
+rows or a rule renamed to a name of the same length, go unnoticed. Use
+``full_refresh`` to fetch all rows again after such changes.
+"""
+from __future__ import annotations
+
+import os
+import csv
+import json
+import atexit
+
+from pathlib import Path
+from typing import IO, Iterator
+
+import pandas as pd
+
+from rpy2.robjects.methods import RS4
+from rpy2.robjects.vectors import ListVector
+
+from ohdsi import database_connector
+from ohdsi.common import (
+    convert_from_r,
+    r_process_pool,
+    to_lower_camel_case,
+    to_snake_case
+)
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+MANIFEST_FILE = "cohort_stats_checksums.json"
+
+# The export file name and the checksum expressions of each statistics table,
+# by its name in ``get_cohort_table_names``
+STATS_TABLES = {
+    "cohortInclusionTable": ("cohort_inclusion", [
+        "SUM(CAST(rule_sequence AS BIGINT))",
+        "SUM(CAST(LEN(name) AS BIGINT))",
+        "SUM(CAST(LEN(description) AS BIGINT))"]),
+    "cohortInclusionResultTable": ("cohort_inc_result", [
+        "SUM(CAST(inclusion_rule_mask AS BIGINT))",
+        "SUM(CAST(person_count AS BIGINT))", "SUM(CAST(mode_id AS BIGINT))"]),
+    "cohortInclusionStatsTable": ("cohort_inc_stats", [
+        "SUM(CAST(rule_sequence AS BIGINT))",
+        "SUM(CAST(person_count AS BIGINT))", "SUM(CAST(gain_count AS BIGINT))",
+        "SUM(CAST(person_total AS BIGINT))", "SUM(CAST(mode_id AS BIGINT))"]),
+    "cohortSummaryStatsTable": ("cohort_summary_stats", [
+        "SUM(CAST(base_count AS BIGINT))", "SUM(CAST(final_count AS BIGINT))",
+        "SUM(CAST(mode_id AS BIGINT))"]),
+    "cohortCensorStatsTable": ("cohort_censor_stats", [
+        "SUM(CAST(lost_count AS BIGINT))"]),
+}
+
+_CHECKSUM_SQL = """
+SELECT cohort_definition_id, COUNT(*) AS row_count, {expressions}
+FROM @cohort_database_schema.@table
+GROUP BY cohort_definition_id;
+"""
+
+_ROWS_SQL = """
+SELECT *
+FROM @cohort_database_schema.@table
+WHERE cohort_definition_id IN (@cohort_ids)
+ORDER BY cohort_definition_id;
+"""
+
+# the connection of a worker process, see _connect_worker
+_connection = None
+
+
+def _connect_worker(connection_details: ListVector) -> None:
+    global _connection
+    _connection = database_connector.connect(connection_details)
+    atexit.register(database_connector.disconnect, _connection)
+
+
+def _checksums(connection: RS4, cohort_database_schema: str, table: str,
+               expressions: list[str]) -> dict[str, str]:
+    checksums = convert_from_r(database_connector.render_translate_query_sql(
+        connection,
+        _CHECKSUM_SQL.format(expressions=", ".join(
+            f"{e} AS checksum_{i}" for i, e in enumerate(expressions))),
+        cohort_database_schema=cohort_database_schema, table=table
+    ))
+    return {
+        str(int(row[0])): ",".join(str(v) for v in row[1:])
+        for row in checksums.itertuples(index=False)
+    }
+
+
+def _cohort_column(snake_case_to_camel_case: bool) -> str:
+    return "cohortDefinitionId" if snake_case_to_camel_case \
+        else "cohort_definition_id"
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Exporting to Parquet requires the `pyarrow` "
+                          "package, install it with `pip install pyarrow`") \
+            from e
+    return pyarrow
+
+
+def _csv_records(f: IO[str]) -> Iterator[str]:
+    """ The records of a CSV file as they are, with quoted line breaks """
+    record = ""
+    for line in f:
+        record += line
+        # a quote in a value is escaped by doubling it
+        if record.count('"') % 2 == 0:
+            yield record
+            record = ""
+    if record:
+        yield record if record.endswith("\n") else f"{record}\n"
+
+
+def _copy_unchanged(file: Path, writer: _Writer, cohort_column: str,
+                    changed: set[int]) -> None:
+    """ Copy the rows of the unchanged cohorts of an earlier export """
+    if not file.exists():
+        return
+    if writer.results_format == "csv":
+        # the rows are copied verbatim: parsing and writing them again would
+        # change them, e.g. integers with NAs would become floats
+        with open(file, newline="", encoding="utf-8") as f:
+            records = _csv_records(f)
+            header = next(records, None)
+            if header is None:
+                return
+            index = next(csv.reader([header])).index(cohort_column)
+            writer.write_records(header, (
+                record for record in records
+                if int(float(next(csv.reader([record]))[index]))
+                not in changed
+            ))
+        return
+
+    pa = _import_pyarrow()
+    changed = pa.array(sorted(changed), type=pa.int64())
+    for batch in pa.parquet.ParquetFile(file).iter_batches():
+        column = batch.column(cohort_column).cast(pa.int64())
+        writer.write(pa.Table.from_batches([batch.filter(
+            pa.compute.invert(pa.compute.is_in(column, value_set=changed))
+        )]))
+
+
+class _Writer:
+    """ Writes batches of rows to a temporary file that replaces ``file`` """
+
+    def __init__(self, file: Path, results_format: str):
+        self.file = file
+        self.results_format = results_format
+        self.tmp_file = file.with_name(f"{file.name}.tmp")
+        self._parquet = None
+        self._header = True
+
+    def write(self, rows) -> None:
+        """ Write a pandas data frame, or an Arrow table (Parquet only) """
+        if self.results_format == "csv":
+            rows.to_csv(self.tmp_file, mode="w" if self._header else "a",
+                        header=self._header, index=False)
+            self._header = False
+            return
+
+        pa = _import_pyarrow()
+        if isinstance(rows, pd.DataFrame):
+            rows = pa.Table.from_pandas(rows, preserve_index=False)
+        if self._parquet is None:
+            self._parquet = pa.parquet.ParquetWriter(self.tmp_file,
+                                                     rows.schema)
+        self._parquet.write_table(rows.cast(self._parquet.schema))
+
+    def write_records(self, header: str, records: Iterator[str]) -> None:
+        """ Write the records of a CSV file as they are (CSV only) """
+        with open(self.tmp_file, "w" if self._header else "a", newline="",
+                  encoding="utf-8") as f:
+            if self._header:
+                f.write(header)
+            f.writelines(records)
+        self._header = False
+
+    def close(self, completed: bool = True) -> None:
+        """ Replace the file, or discard the rows when not completed """
+        if self._parquet is not None:
+            self._parquet.close()
+        if not self.tmp_file.exists():
+            return
+        if completed:
+            os.replace(self.tmp_file, self.file)
+        else:
+            self.tmp_file.unlink()
+
+
+def _export_table(cohort_database_schema: str, table: str, file: str,
+                  expressions: list[str], previous: dict[str, str] | None,
+                  results_format: str, snake_case_to_camel_case: bool,
+                  database_id: str | None, batch_size: int,
+                  connection: RS4 | None = None) -> tuple[dict, int]:
+    """ Export the changed cohorts of one statistics table
+
+    When ``previous`` is None, all rows are fetched and the rows of the
+    earlier export are discarded.
+    """
+    connection = connection if connection is not None else _connection
+    checksums = _checksums(connection, cohort_database_schema, table,
+                           expressions)
+    file = Path(file)
+    full_refresh = previous is None
+    if full_refresh or not file.exists():
+        previous = {}
+    changed = {int(c) for c in set(checksums) | set(previous)
+               if checksums.get(c) != previous.get(c)}
+    if not changed:
+        return checksums, 0
+
+    cohort_column = _cohort_column(snake_case_to_camel_case)
+    writer = _Writer(file, results_format)
+    fetched = 0
+    try:
+        if not full_refresh:
+            _copy_unchanged(file, writer, cohort_column, changed)
+        to_fetch = sorted(int(c) for c in checksums if int(c) in changed)
+        for start in range(0, len(to_fetch), batch_size):
+            rows = convert_from_r(
+                database_connector.render_translate_query_sql(
+                    connection, _ROWS_SQL, snake_case_to_camel_case=True,
+                    cohort_database_schema=cohort_database_schema,
+                    table=table, cohort_ids=",".join(
+                        str(c) for c in to_fetch[start:start + batch_size])
+                ))
+            if not snake_case_to_camel_case:
+                rows.columns = [to_snake_case(c) for c in rows.columns]
+            if database_id is not None:
+                rows.insert(0, "databaseId" if snake_case_to_camel_case
+                            else "database_id", database_id)
+            writer.write(rows)
+            fetched += len(rows)
+    except BaseException:
+        writer.close(completed=False)
+        raise
+    writer.close()
+    return checksums, fetched
+
+
+def export_cohort_stats_incremental(
+    cohort_database_schema: str,
+    cohort_statistics_folder: str | Path,
+    cohort_table_names: dict[str, str],
+    connection_details: ListVector | None = None,
+    connection: RS4 | None = None,
+    snake_case_to_camel_case: bool = True,
+    file_names_in_snake_case: bool = False,
+    database_id: str | None = None,
+    results_format: str = "csv",
+    max_workers: int = 1,
+    batch_size: int = 100,
+    full_refresh: bool = False
+) -> dict[str, int]:
+    """
+    Export the statistics of the cohorts that changed since the last export
+
+    Parameters
+    ----------
+    cohort_database_schema : str
+        The schema containing the cohort tables
+    cohort_statistics_folder : str | Path
+        The folder the statistics are exported to
+    cohort_table_names : dict[str, str]
+        The names of the cohort tables, as returned by
+        ``get_cohort_table_names``
+    connection_details : ListVector, optional
+        The connection details, required when ``max_workers`` > 1
+    connection : RS4, optional
+        The connection
+    snake_case_to_camel_case : bool, optional
+        Whether the column names are converted to camelCase, by default True
+    file_names_in_snake_case : bool, optional
+        Whether the file names are in snake_case, by default False
+    database_id : str, optional
+        When specified, the databaseId is added to the exported rows
+    results_format : str, optional
+        Either "csv" or "parquet", by default "csv"
+    max_workers : int, optional
+        The number of tables that are exported concurrently, each with its
+        own connection, by default 1
+    batch_size : int, optional
+        The number of cohorts whose rows are fetched per query, by default
+        100
+    full_refresh : bool, optional
+        Fetch the rows of all cohorts, ignoring the checksums of the previous
+        export, which do not detect all changes (see the module). By default
+        False.
+
+    Returns
+    -------
+    dict[str, int]
+        The number of rows fetched per exported file
+    """
+    if results_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown results format {results_format}, choose "
+                         f"from {EXPORT_FORMATS}")
+    if connection is None and connection_details is None:
+        raise ValueError("Provide a connection or connection_details")
+    if results_format == "parquet":
+        _import_pyarrow()
+    if max_workers > 1 and connection_details is None:
+        raise ValueError("Exporting tables concurrently requires "
+                         "connection_details, as every worker needs its own "
+                         "connection")
+
+    folder = Path(cohort_statistics_folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    options = {"format": results_format,
+               "camel_case": snake_case_to_camel_case,
+               "database_id": database_id}
+    manifest_file = folder / MANIFEST_FILE
+    manifest = json.loads(manifest_file.read_text()) \
+        if manifest_file.exists() else {}
+    # a changed layout invalidates all earlier exports
+    previous = manifest.get("tables", {}) \
+        if manifest.get("options") == options else {}
+
+    tasks = {}
+    for key, (file_name, expressions) in STATS_TABLES.items():
+        if not file_names_in_snake_case:
+            file_name = to_lower_camel_case(file_name)
+        file_name = f"{file_name}.{results_format}"
+        tasks[file_name] = (
+            cohort_database_schema, cohort_table_names[key],
+            str(folder / file_name), expressions,
+            None if full_refresh else previous.get(file_name, {}),
+            results_format,
+            snake_case_to_camel_case, database_id, batch_size
+        )
+
+    results = {}
+    if max_workers <= 1:
+        own_connection = connection is None
+        if own_connection:
+            connection = database_connector.connect(connection_details)
+        try:
+            for file_name, args in tasks.items():
+                results[file_name] = _export_table(*args, connection)
+        finally:
+            if own_connection:
+                database_connector.disconnect(connection)
+    else:
+        with r_process_pool(min(max_workers, len(tasks)), _connect_worker,
+                            (connection_details,)) as pool:
+            futures = {file_name: pool.submit(_export_table, *args)
+                       for file_name, args in tasks.items()}
+            results = {file_name: future.result()
+                       for file_name, future in futures.items()}
+
+    tmp_file = manifest_file.with_suffix(".json.tmp")
+    tmp_file.write_text(json.dumps({
+        "options": options,
+        "tables": {f: checksums for f, (checksums, _) in results.items()}
+    }, indent=2))
+    os.replace(tmp_file, manifest_file)
+    return {f: fetched for f, (_, fetched) in results.items()}
@@ -1,11 +1,21 @@
 from __future__ import annotations
 import os
 import re
+import json
+import hashlib
+import functools
+import threading
+import multiprocessing
+import numpy as np
 import pandas as pd
 import rpy2.robjects as ro
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from copy import deepcopy
-from typing import Any
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable
+from rpy2 import rinterface
 from rpy2.robjects import pandas2ri
 from rpy2.robjects.vectors import ListVector
 from rpy2.robjects import RS4
@@ -13,6 +23,8 @@ from rpy2.robjects.conversion import localconverter
 from rpy2.robjects.pandas2ri import rpy2py_dataframe
 from rpy2.robjects.packages import importr
 
+from ohdsi.common.profiling import profile_conversion
+
 pattern = re.compile(r'(?<!^)(?=[A-Z])')
 
 if os.environ.get('IGNORE_R_IMPORTS', False):
@@ -63,50 +75,95 @@ def convert_bool_from_r(bool_vector: ro.vectors.BoolVector) -> bool:
     return tuple(bool_vector)[0]
 
 
+def _dataframe_from_r(item: ro.vectors.DataFrame, date_cols: list[str]):
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        result = ro.conversion.rpy2py(item)
+    return convert_df_dates_from_r(result, date_cols), None, False
+
+
+def _list_from_r(item: ro.vectors.ListVector, date_cols: list[str]):
+    names = item.names
+    if names == ro.vectors.NULL:
+        children = list(item)
+        return [None] * len(children), \
+            [(i, child, '') for i, child in enumerate(children)], False
+
+    # duplicate names keep the last value, at the position of the first
+    children = dict(zip(names, item))
+    return dict.fromkeys(children), \
+        [(k, child, k) for k, child in children.items()], False
+
+
+# handlers return the (unfinished) result, the children to convert into it
+# as (key, item, name) and whether a single element result is unwrapped
+_FROM_R_HANDLERS: dict[type, Callable] = {
+    ro.environments.Environment: lambda item, _: (None, None, False),
+    ro.Formula: lambda item, _: (None, None, False),
+    ro.vectors.DataFrame: _dataframe_from_r,
+    ro.vectors.StrVector: lambda item, _: (tuple(item), None, True),
+    ro.vectors.FloatVector: lambda item, _: (tuple(item), None, True),
+    ro.vectors.BoolVector: lambda item, _: (tuple(item), None, True),
+    ro.vectors.IntVector: lambda item, _: (tuple(item), None, True),
+    ro.vectors.ListVector: _list_from_r,
+}
+
+
+@functools.cache
+def _from_r_handler(cls: type) -> Callable:
+    for base in cls.__mro__:
+        if base in _FROM_R_HANDLERS:
+            return _FROM_R_HANDLERS[base]
+    return lambda item, _: (item, None, True)
+
+
+@profile_conversion(to_r=False)
 def convert_from_r(item: Any, date_cols: 'list[str]' = None, name: str = '',
                    reserve_plots: bool = True) -> Any:
-    result = item
-    remove_list: bool = True
-    if item == ro.vectors.NULL:
-        return None
-    elif ('plot' in name
-          and isinstance(item, ro.vectors.ListVector)
-          and reserve_plots):
-        return item
-    elif isinstance(item, (ro.environments.Environment,
-                           ro.Formula)):
-        return None
-    elif isinstance(item, ro.vectors.DataFrame):
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            result = ro.conversion.rpy2py(item)
-        result = convert_df_dates_from_r(result, date_cols)
-        remove_list = False
-    elif isinstance(item, (ro.vectors.StrVector,
-                           ro.vectors.FloatVector,
-                           ro.vectors.BoolVector,
-                           ro.vectors.IntVector)):
-        result = tuple(item)
-    elif isinstance(item, ro.vectors.ListVector):
-        result = {}
-        remove_list = False
-
-        if item.names == ro.vectors.NULL:
-            if len(item) > 0:
-                result = [convert_from_r(i, date_cols) for i in item]
-            else:
-                result = []
-
-        elif len(item) > 0:
-            result = dict(zip(item.names, list(item)))
-            for k, v in result.items():
-                result[k] = convert_from_r(v, date_cols, name=k)
-
-    if '__len__' in result.__dir__() and len(result) == 1 and remove_list:
-        result = result[0]
+    """ Convert an R object, and everything nested in it, to Python
 
-    return result
+    Lists become lists (or dicts when named), data frames become pandas data
+    frames and atomic vectors become tuples. Single element vectors are
+    unwrapped. Named lists with "plot" in their name are kept as they are
+    when ``reserve_plots`` is set.
 
+    The conversion uses an explicit stack rather than recursion, so deeply
+    nested and very long lists are converted in linear time.
 
+    Args:
+        item (Any): The R object
+        date_cols (list[str], optional): Columns of the data frames that
+            contain dates. Defaults to None.
+        name (str, optional): The name of the item. Defaults to ''.
+        reserve_plots (bool, optional): Whether to keep plots (at the top
+            level) as R objects. Defaults to True.
+
+    Returns:
+        Any: The converted object
+    """
+    root = [None]
+    stack = [(item, name, reserve_plots, root, 0)]
+    while stack:
+        item, name, reserve_plots, parent, key = stack.pop()
+        if item == ro.vectors.NULL:
+            continue
+        if reserve_plots and 'plot' in name \
+                and isinstance(item, ro.vectors.ListVector):
+            parent[key] = item
+            continue
+
+        result, children, unwrap = _from_r_handler(type(item))(item,
+                                                               date_cols)
+        if children:
+            stack.extend((child, child_name, True, result, child_key)
+                         for child_key, child, child_name in children)
+        elif unwrap and hasattr(result, '__len__') and len(result) == 1:
+            result = result[0]
+        parent[key] = result
+
+    return root[0]
+
+
+@profile_conversion(to_r=True)
 def convert_to_r(item: Any) -> Any:
     result = item
     if isinstance(item, dict):
@@ -123,8 +180,7 @@ def convert_to_r(item: Any) -> Any:
             items.append(convert_to_r(i))
         result = ro.vectors.ListVector.from_iterable(items)
     elif isinstance(item, pd.DataFrame):
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            result = ro.conversion.py2rpy(item)
+        result = dataframe_to_r(item)
     elif isinstance(item, str):
         result = ro.vectors.StrVector([item])
     elif isinstance(item, float):
@@ -136,6 +192,356 @@ def convert_to_r(item: Any) -> Any:
     return result
 
 
+_INT32_MIN, _INT32_MAX = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+
+
+@functools.cache
+def _codes_to_character() -> ro.functions.Function:
+    return ro.r('function(codes, levels) levels[codes]')
+
+
+def _from_numpy(values: np.ndarray, vector_type: type) -> rinterface.Sexp:
+    # a single memcpy into memory allocated by R
+    return vector_type.from_memoryview(
+        memoryview(np.ascontiguousarray(values))
+    )
+
+
+def _r_codes(codes: np.ndarray) -> np.ndarray:
+    """ 0-based codes with -1 for missing to R's 1-based codes with NA """
+    return np.where(codes < 0, _INT32_MIN, codes + 1).astype(np.int32)
+
+
+def _series_to_r(series: pd.Series) -> rinterface.Sexp:
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        result = _from_numpy(_r_codes(series.cat.codes.to_numpy()),
+                             rinterface.IntSexpVector)
+        result.do_slot_assign('levels', rinterface.StrSexpVector(
+            [str(c) for c in dtype.categories]))
+        result.do_slot_assign('class', rinterface.StrSexpVector(['factor']))
+        return result
+
+    if pd.api.types.is_bool_dtype(dtype):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        return _from_numpy(
+            np.where(np.isnan(values), _INT32_MIN, values).astype(np.int32),
+            rinterface.BoolSexpVector
+        )
+
+    if pd.api.types.is_integer_dtype(dtype):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = values[~np.isnan(values)]
+        # R integers are 32 bit, with the smallest value reserved for NA
+        if len(valid) == 0 or (valid.min() > _INT32_MIN
+                               and valid.max() <= _INT32_MAX):
+            return _from_numpy(
+                np.where(np.isnan(values), _INT32_MIN, values)
+                .astype(np.int32),
+                rinterface.IntSexpVector
+            )
+        return _from_numpy(values, rinterface.FloatSexpVector)
+
+    if pd.api.types.is_float_dtype(dtype):
+        return _from_numpy(series.to_numpy(dtype=np.float64, na_value=np.nan),
+                           rinterface.FloatSexpVector)
+
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        tz = getattr(dtype, 'tz', None)
+        seconds = (series - pd.Timestamp(0, tz=tz)).dt.total_seconds()
+        result = _from_numpy(seconds.to_numpy(), rinterface.FloatSexpVector)
+        result.do_slot_assign('class',
+                              rinterface.StrSexpVector(['POSIXct', 'POSIXt']))
+        result.do_slot_assign('tzone',
+                              rinterface.StrSexpVector([str(tz or '')]))
+        return result
+
+    if pd.api.types.is_string_dtype(dtype) or pd.api.types.is_object_dtype(
+            dtype):
+        codes, uniques = pd.factorize(series, use_na_sentinel=True)
+        if all(isinstance(u, str) for u in uniques):
+            # every distinct string crosses the boundary only once, R expands
+            # the codes in a single vectorized indexing operation
+            return _codes_to_character()(
+                _from_numpy(_r_codes(codes), rinterface.IntSexpVector),
+                rinterface.StrSexpVector(list(uniques))
+            )
+
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        return ro.conversion.py2rpy(series)
+
+
+@profile_conversion(to_r=True)
+def dataframe_to_r(df: pd.DataFrame) -> ro.vectors.DataFrame:
+    """ Convert a pandas data frame to an R data.frame
+
+    Numeric, boolean and date columns are copied once, straight from their
+    numpy buffer into the R vector. String columns are deduplicated first so
+    that each distinct value is converted only once. Other columns fall back
+    to ``pandas2ri``.
+
+    Args:
+        df (pd.DataFrame): The pandas data frame
+
+    Returns:
+        ro.vectors.DataFrame: The R data.frame
+    """
+    columns = rinterface.ListSexpVector(
+        [_series_to_r(df[column]) for column in df.columns]
+    )
+    columns.do_slot_assign(
+        'names', rinterface.StrSexpVector([str(c) for c in df.columns])
+    )
+    if isinstance(df.index, pd.RangeIndex) and df.index.start == 0 \
+            and df.index.step == 1:
+        # R's compact representation of the row names 1..n
+        row_names = rinterface.IntSexpVector([_INT32_MIN, -len(df)])
+    else:
+        row_names = rinterface.StrSexpVector([str(i) for i in df.index])
+    columns.do_slot_assign('row.names', row_names)
+    columns.do_slot_assign('class', rinterface.StrSexpVector(['data.frame']))
+    return ro.vectors.DataFrame(columns)
+
+
+def _canonicalize(item: Any) -> Any:
+    """ Bring a (nested) Python or R object in a JSON serializable form
+
+    R objects are converted using ``convert_from_r``, and their attributes
+    (e.g. the ``class`` and ``fun`` of a ``covariateSettings`` object) are
+    kept as these determine how R treats the object. Sequences of length one
+    are unwrapped and empty sequences become ``None``, so that ``[1]`` and
+    ``c(1)`` result in the same canonical form.
+    """
+    if isinstance(item, ro.vectors.ListVector) \
+            and not isinstance(item, ro.vectors.DataFrame):
+        attributes = {
+            name: _canonicalize(convert_from_r(item.do_slot(name)))
+            for name in item.list_attrs() if name != 'names'
+        }
+        names = item.names
+        if names == ro.vectors.NULL:
+            value = [_canonicalize(i) for i in item]
+        else:
+            value = {str(k): _canonicalize(v) for k, v in zip(names, item)}
+        return {'__r_attributes__': attributes, '__r_value__': value}
+    elif isinstance(item, ro.vectors.DataFrame):
+        return _canonicalize(convert_from_r(item))
+    elif isinstance(item, pd.DataFrame):
+        hashed = pd.util.hash_pandas_object(item, index=True).values
+        return {
+            '__columns__': [str(c) for c in item.columns],
+            '__hash__': hashlib.sha256(hashed.tobytes()).hexdigest()
+        }
+    elif isinstance(item, ro.rinterface.Sexp):
+        return _canonicalize(convert_from_r(item))
+    elif isinstance(item, dict):
+        return {str(k): _canonicalize(v) for k, v in item.items()}
+    elif isinstance(item, (list, tuple, range, set, frozenset)):
+        values = [_canonicalize(i) for i in item]
+        if isinstance(item, (set, frozenset)):
+            values = sorted(values, key=repr)
+        if len(values) == 0:
+            return None
+        return values[0] if len(values) == 1 else values
+    elif isinstance(item, bool) or item is None:
+        return item
+    elif isinstance(item, float) and item.is_integer():
+        return int(item)
+    elif isinstance(item, (int, float, str)):
+        return item
+    elif isinstance(item, Path):
+        return str(item)
+    return repr(item)
+
+
+def fingerprint(item: Any) -> str:
+    """ Compute a deterministic hash of a Python or R object
+
+    The object is brought in a canonical form first (see ``_canonicalize``)
+    so that equal settings give equal hashes, regardless of the order of
+    dictionary keys or whether a value was wrapped in a list.
+
+    Args:
+        item (Any): Python object (e.g. keyword arguments) or R object
+            (e.g. a ``ListVector`` containing covariate settings)
+
+    Returns:
+        str: hexadecimal SHA-256 digest
+    """
+    canonical = json.dumps(_canonicalize(item), sort_keys=True,
+                           separators=(',', ':'), default=repr)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _init_r_worker(initializer: Callable | None, initargs: tuple) -> None:
+    # R needs to be running before R objects can be unpickled in the worker
+    import rpy2.robjects  # noqa: F401
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def r_process_pool(max_workers: int, initializer: Callable | None = None,
+                   initargs: tuple = ()) -> ProcessPoolExecutor:
+    """ Create a process pool in which each worker runs its own R session
+
+    The embedded R interpreter is single threaded, so concurrent R work needs
+    separate processes. Workers are spawned rather than forked, as a forked
+    R session is not safe to use. R objects passed to the workers are
+    serialized using R.
+
+    Args:
+        max_workers (int): The number of worker processes
+        initializer (Callable, optional): Called in each worker once R is
+            running, e.g. to open a database connection. Defaults to None.
+        initargs (tuple, optional): Arguments for the initializer
+
+    Returns:
+        ProcessPoolExecutor: The process pool
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_r_worker,
+        initargs=(initializer, initargs)
+    )
+
+
+class Checkpoint:
+    """
+    Keeps track of the completed tasks of a long running computation
+
+    Completed tasks are recorded in a ``manifest.json`` in the results
+    folder, together with an identifier of the computation. Running the same
+    computation again with the same folder allows skipping the tasks that
+    were completed before. The manifest is replaced atomically, so it is
+    never left half written when the process is killed.
+
+    Args:
+        folder (str | Path): The results folder, created if it does not
+            exist
+        run_id (str): Identifies the computation, e.g. a ``fingerprint`` of
+            its settings. A folder that contains the results of a different
+            computation is refused.
+    """
+    def __init__(self, folder: str | Path, run_id: str):
+        self.folder = Path(folder)
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        self._tasks = {}
+        if self.manifest_file.exists():
+            manifest = json.loads(self.manifest_file.read_text())
+            if manifest['run_id'] != run_id:
+                raise ValueError(f"Folder '{folder}' contains the results "
+                                 "of a different computation")
+            self._tasks = manifest['tasks']
+
+    @property
+    def manifest_file(self) -> Path:
+        return self.folder / 'manifest.json'
+
+    @property
+    def completed(self) -> set[str]:
+        return {task for task in self._tasks if self.is_completed(task)}
+
+    def path(self, task: str, suffix: str = '.zip') -> str:
+        """ Location at which the results of a task should be stored """
+        return str(self.folder / f'{task}{suffix}')
+
+    def is_completed(self, task: str) -> bool:
+        """ Whether the task is completed and its results still exist """
+        if task not in self._tasks:
+            return False
+        file = self._tasks[task].get('file')
+        return file is None or (self.folder / file).exists()
+
+    def complete(self, task: str, file: str | None = None, **info) -> None:
+        """ Record that a task is completed
+
+        Args:
+            task (str): The task identifier
+            file (str, optional): The file holding the results of the task.
+                The task is considered incomplete when it is removed.
+            **info: Additional JSON serializable information to record
+        """
+        with self._lock:
+            self._tasks[task] = {
+                'completed_at': datetime.now(timezone.utc).isoformat(),
+                'file': os.path.relpath(file, self.folder) if file else None,
+                **info
+            }
+            temp_file = self.manifest_file.with_suffix('.json.tmp')
+            temp_file.write_text(json.dumps(
+                {'run_id': self.run_id, 'tasks': self._tasks}, indent=2
+            ))
+            os.replace(temp_file, self.manifest_file)
+
+
+def run_tasks(tasks: dict[str, tuple[Callable, tuple]],
+              checkpoint: Checkpoint | None = None, max_workers: int = 1,
+              files: dict[str, str] | None = None) -> dict[str, Any]:
+    """ Run independent tasks, skipping the ones that completed before
+
+    With a single worker the tasks run in the current process, otherwise
+    they are distributed over an ``r_process_pool``. All tasks are attempted
+    before failures are reported, so that the completed tasks are recorded
+    in the checkpoint.
+
+    Args:
+        tasks (dict[str, tuple[Callable, tuple]]): Maps a task identifier to
+            the function and arguments that perform the task
+        checkpoint (Checkpoint, optional): Where completed tasks are
+            recorded. Defaults to None.
+        max_workers (int, optional): The number of worker processes.
+            Defaults to 1.
+        files (dict[str, str], optional): The result file of each task,
+            which is recorded in the checkpoint. Defaults to None.
+
+    Returns:
+        dict[str, Any]: The return values of the tasks that ran
+
+    Raises:
+        RuntimeError: When one or more of the tasks failed
+    """
+    files = files or {}
+    if checkpoint is not None:
+        tasks = {k: v for k, v in tasks.items()
+                 if not checkpoint.is_completed(k)}
+
+    results, failed = {}, {}
+
+    def _finish(task: str, result: Any) -> None:
+        results[task] = result
+        if checkpoint is not None:
+            checkpoint.complete(task, files.get(task))
+
+    if max_workers <= 1:
+        for task, (func, args) in tasks.items():
+            try:
+                _finish(task, func(*args))
+            except Exception as e:
+                failed[task] = e
+    elif tasks:
+        with r_process_pool(min(max_workers, len(tasks))) as pool:
+            futures = {pool.submit(func, *args): task
+                       for task, (func, args) in tasks.items()}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    failed[futures[future]] = future.exception()
+                else:
+                    _finish(futures[future], future.result())
+
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} task(s) failed: {sorted(failed)}. Completed "
+            "tasks are skipped when running again with the same checkpoint."
+        ) from next(iter(failed.values()))
+
+    return results
+
+
+@profile_conversion(to_r=False)
 def andromeda_to_df(andromeda_table: RS4) -> pd.DataFrame:
     r_df = base_r.data_frame(andromeda_table)
     return rpy2py_dataframe(r_df)
@@ -162,14 +568,12 @@ class RS4Extended(RS4):
         return base_r.__dict__["$"](self, property)
 
     def as_RS4(self) -> RS4:
-        self_copy = deepcopy(self)
-        self_copy.__class__ = RS4
-        return self_copy
+        # a new wrapper around the same R object, nothing is copied
+        return RS4(self)
 
     @classmethod
     def from_RS4(cls, rs4: RS4) -> RS4Extended:
-        rs4.__class__ = cls
-        return rs4
+        return cls(rs4)
 
     def __str__(self):
         return f"<RS4Extended of R class '{self.r_class}'>"
@@ -186,14 +590,14 @@ class CovariateData(RS4Extended):
 
     @classmethod
     def from_RS4(cls, rs4: RS4) -> CovariateData:
-        rs4.__class__ = cls
-        for prop in rs4.properties:
+        covariate_data = cls(rs4)
+        for prop in covariate_data.properties:
             setattr(
-                rs4,
+                covariate_data,
                 to_snake_case(prop),
-                andromeda_to_df(rs4.extract(prop))
+                andromeda_to_df(covariate_data.extract(prop))
             )
-        return rs4
+        return covariate_data
 
     def __str__(self):
         return f"<CovariateData of R class '{self.r_class}'>"
@@ -206,48 +610,86 @@ class ListVectorExtended(ListVector):
     - Pythonic setters and getters
     - as_dict() representation
     - __repr__ and _repr_html_ methods
+    - cheap copies: conversions from and to ``ListVector`` share the R
+      object, which is copied once when it is first modified through the
+      extended object (copy-on-write)
     """
     def __init__(self):
-        for name in self.names:
-            setattr(self, to_snake_case(name),
-                    convert_from_r(self.rx2(name)))
+        # the snake_case names are computed once, the values are converted
+        # on first access and cached until they are overwritten
+        names = self.names
+        snake_names = tuple(to_snake_case(n) for n in names) \
+            if names != ro.vectors.NULL else ()
+        dict.__setattr__(self, '_snake_names', snake_names)
+        dict.__setattr__(self, '_mapping', dict(zip(snake_names, names)))
+        dict.__setattr__(self, '_cache', {})
+        dict.__setattr__(self, '_shared', False)
         self.initialized = True
 
     @classmethod
     def from_list_vector(cls, list_vector: ListVector) -> ListVectorExtended:
-        new_list_vector = deepcopy(list_vector)
-        new_list_vector.__class__ = cls
+        new_list_vector = cls.__new__(cls)
+        ListVector.__init__(new_list_vector, list_vector)
         new_list_vector.__init__()
+        dict.__setattr__(new_list_vector, '_shared', True)
         return new_list_vector
 
+    def copy(self) -> ListVectorExtended:
+        """ A copy that shares the R object until either one is modified """
+        dict.__setattr__(self, '_shared', True)
+        return self.from_list_vector(self)
+
+    def _ensure_own(self) -> None:
+        # copy-on-write: duplicate the R object before the first modification
+        if self.__dict__.get('_shared', False):
+            self.__sexp__ = deepcopy(rinterface.ListSexpVector(self)).__sexp__
+            dict.__setattr__(self, '_shared', False)
+
     @property
     def keys(self) -> list[str]:
-        return [to_snake_case(n) for n in self.names]
+        return list(self._mapping)
 
     @property
     def mapping(self) -> dict:
-        return {to_snake_case(n): n for n in self.names}
+        """ The snake_case names mapped to the R names (do not modify) """
+        return self._mapping
 
     def as_dict(self) -> dict:
-        return {k: convert_from_r(self.__getattr__(k)) for k in self.keys}
+        cache = self._cache
+        for key, value in zip(self._snake_names, self):
+            # with duplicate names, the first one is used, like rx2 does
+            if key not in cache:
+                cache[key] = convert_from_r(value)
+        return {key: cache[key] for key in self._mapping}
 
     def as_list_vector(self) -> ListVector:
-        self_copy = deepcopy(self)
-        self_copy.__class__ = ListVector
-        return self_copy
+        dict.__setattr__(self, '_shared', True)
+        return ListVector(self)
+
+    def __setitem__(self, i: int, value: Any) -> None:
+        self._ensure_own()
+        super().__setitem__(i, value)
+        self._cache.clear()
 
     def __setattr__(self, __name: str, __value: Any) -> None:
-        if __name in self.keys and hasattr(self, 'initialized'):
+        mapping = self.__dict__.get('_mapping', {})
+        if __name in mapping and 'initialized' in self.__dict__:
+            self._ensure_own()
             try:
-                self.rx2[self.mapping[__name]] = convert_to_r(__value)
+                self.rx2[mapping[__name]] = convert_to_r(__value)
             except NotImplementedError:
                 pass
+            self._cache.pop(__name, None)
         else:
             dict.__setattr__(self, __name, __value)
 
     def __getattr__(self, __name: str) -> Any:
-        if __name in self.keys:
-            return convert_from_r(self.rx2[self.mapping[__name]])
+        mapping = self.__dict__.get('_mapping', {})
+        if __name in mapping:
+            cache = self.__dict__['_cache']
+            if __name not in cache:
+                cache[__name] = convert_from_r(self.rx2[mapping[__name]])
+            return cache[__name]
         else:
             return super().__getattr__(__name)
 
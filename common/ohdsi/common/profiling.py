@@ -0,0 +1,402 @@
+"""
+Instrumentation of the boundary between Python and R
+
+When profiling is enabled, every call of an R function records the time spent
+converting the arguments to R, evaluating the function in R and converting
+the result back to Python, together with an estimate of the number of bytes
+that moved in each direction. Each call is attributed to the ``ohdsi``
+wrapper function that made it, so ``query_sql`` shows up separately from the
+SQL that ``get_db_covariate_data`` runs. The Python side conversions of
+``ohdsi.common`` (``convert_from_r``, ``andromeda_to_df``, ...) are recorded
+as well.
+
+Measurements can be exported to ``logging``, to an in-process registry (see
+``get_profile_stats``) and as OpenTelemetry spans. rpy2 is only patched
+while profiling is enabled, so there is no overhead when it is disabled.
+Profiling can also be enabled by setting the ``OHDSI_PROFILING`` environment
+variable. Note that R workers (see ``r_process_pool``) are separate
+processes that are not profiled.
+
+Examples
+--------
+>>> from ohdsi.common import profiling
+>>> profiling.enable_profiling()
+>>> with profiling.profiled("characterization"):
+...     covariate_data = get_db_covariate_data(...)
+>>> profiling.get_profile_stats()
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+import logging
+import functools
+import threading
+
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+EXPORTERS = ("logging", "registry", "opentelemetry")
+
+_FIELDS = ("calls", "total_seconds", "args_seconds", "r_seconds",
+           "result_seconds", "bytes_to_r", "bytes_from_r")
+
+
+class _State:
+    enabled: bool = False
+    exporters: frozenset = frozenset()
+    log_level: int = logging.DEBUG
+    track_bytes: bool = True
+    tracer: Any = None
+    originals: dict = {}
+
+
+_state = _State()
+_local = threading.local()
+_registry: dict[tuple[str, str], dict[str, float]] = {}
+_registry_lock = threading.Lock()
+
+
+@dataclass
+class _Call:
+    """ A single R function call that is being measured """
+    function: str
+    wrapper: str
+    closure: Any
+    start_ns: int
+    started: float
+    r_started: float | None = None
+    r_ended: float | None = None
+    bytes_to_r: int = 0
+    bytes_from_r: int = 0
+
+
+def _calls() -> list[_Call]:
+    if not hasattr(_local, 'calls'):
+        _local.calls = []
+    return _local.calls
+
+
+def _labels() -> list[str]:
+    if not hasattr(_local, 'labels'):
+        _local.labels = []
+    return _local.labels
+
+
+def calling_wrapper(ignore: tuple[str, ...] = ()) -> str | None:
+    """ Find the ``ohdsi`` wrapper function that is being executed
+
+    Walks up the call stack to the nearest public function defined in one
+    of the ``ohdsi`` packages (other than ``ohdsi.common``). When there is
+    none, the nearest private one (or lambda) is used.
+
+    Args:
+        ignore (tuple[str, ...], optional): Other modules whose functions
+            are not wrappers, e.g. helper modules of a package
+
+    Returns:
+        str | None: The qualified name of the function, e.g.
+            ``ohdsi.database_connector.query_sql``, or None when the call
+            did not originate from a wrapper
+    """
+    frame = sys._getframe(1)
+    private = None
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('ohdsi.') \
+                and not module.startswith(('ohdsi.common', *ignore)):
+            name = f'{module}.{frame.f_code.co_name}'
+            if not frame.f_code.co_name.startswith(('_', '<')):
+                return name
+            private = private or name
+        frame = frame.f_back
+    return private
+
+
+def _attribution() -> str:
+    labels = _labels()
+    if labels:
+        return labels[-1]
+    return calling_wrapper() or '<direct>'
+
+
+def _r_nbytes(item: Any, depth: int = 0) -> int:
+    """ Estimate the size of the data in an R vector without calling R """
+    from rpy2.rinterface import RTYPES
+
+    item_sizes = {RTYPES.LGLSXP: 4, RTYPES.INTSXP: 4, RTYPES.REALSXP: 8,
+                  RTYPES.CPLXSXP: 16, RTYPES.STRSXP: 8, RTYPES.RAWSXP: 1}
+    typeof = getattr(item, 'typeof', None)
+    if typeof in item_sizes:
+        return len(item) * item_sizes[typeof]
+    elif typeof == RTYPES.VECSXP and depth < 3:
+        return sum(_r_nbytes(i, depth + 1) for i in item)
+    return 0
+
+
+def _py_nbytes(item: Any) -> int:
+    if isinstance(item, pd.DataFrame):
+        return int(item.memory_usage(index=True, deep=False).sum())
+    return 0
+
+
+def _export(wrapper: str, function: str, measurement: dict,
+            start_ns: int, span: bool = True) -> None:
+    if 'registry' in _state.exporters:
+        with _registry_lock:
+            stats = _registry.setdefault(
+                (wrapper, function), dict.fromkeys(_FIELDS, 0)
+            )
+            stats['calls'] += 1
+            for field, value in measurement.items():
+                stats[field] += value
+
+    if 'logging' in _state.exporters and logger.isEnabledFor(
+            _state.log_level):
+        logger.log(
+            _state.log_level,
+            "%s -> %s: %.4fs (args %.4fs, R %.4fs, result %.4fs), "
+            "%d bytes to R, %d bytes from R",
+            wrapper, function, measurement['total_seconds'],
+            measurement.get('args_seconds', 0),
+            measurement.get('r_seconds', 0),
+            measurement.get('result_seconds', 0),
+            measurement.get('bytes_to_r', 0),
+            measurement.get('bytes_from_r', 0)
+        )
+
+    if span and _state.tracer is not None:
+        otel_span = _state.tracer.start_span(
+            function, start_time=start_ns,
+            attributes={'ohdsi.wrapper': wrapper,
+                        **{f'ohdsi.{k}': v for k, v in measurement.items()}}
+        )
+        otel_span.end(
+            end_time=start_ns + int(measurement['total_seconds'] * 1e9)
+        )
+
+
+def _record(call: _Call, ended: float) -> None:
+    total = ended - call.started
+    if call.r_started is None:
+        # the evaluation could not be separated from the conversions
+        args_seconds, r_seconds, result_seconds = 0.0, total, 0.0
+    else:
+        args_seconds = call.r_started - call.started
+        r_seconds = call.r_ended - call.r_started
+        result_seconds = ended - call.r_ended
+
+    _export(call.wrapper, call.function, {
+        'total_seconds': total,
+        'args_seconds': args_seconds,
+        'r_seconds': r_seconds,
+        'result_seconds': result_seconds,
+        'bytes_to_r': call.bytes_to_r,
+        'bytes_from_r': call.bytes_from_r
+    }, call.start_ns)
+
+
+def _profile_function_call(original: Callable) -> Callable:
+    # rpy2's Function.__call__ converts the arguments, evaluates the closure
+    # and converts the result. The closure evaluation is timed separately.
+    @functools.wraps(original)
+    def __call__(self, *args, **kwargs):
+        call = _Call(
+            function=getattr(self, '__rname__', None) or '<anonymous>',
+            wrapper=_attribution(), closure=self,
+            start_ns=time.time_ns(), started=time.perf_counter()
+        )
+        calls = _calls()
+        calls.append(call)
+        try:
+            return original(self, *args, **kwargs)
+        finally:
+            ended = time.perf_counter()
+            calls.pop()
+            _record(call, ended)
+    return __call__
+
+
+def _profile_closure_call(original: Callable) -> Callable:
+    @functools.wraps(original)
+    def __call__(self, *args, **kwargs):
+        calls = _calls()
+        call = calls[-1] if calls else None
+        # R calls made by the converters are not the call being measured
+        if call is None or call.closure is not self \
+                or call.r_started is not None:
+            return original(self, *args, **kwargs)
+
+        if _state.track_bytes:
+            call.bytes_to_r = sum(_r_nbytes(a) for a in args) \
+                + sum(_r_nbytes(v) for v in kwargs.values())
+        call.r_started = time.perf_counter()
+        try:
+            result = original(self, *args, **kwargs)
+        finally:
+            call.r_ended = time.perf_counter()
+        if _state.track_bytes:
+            call.bytes_from_r = _r_nbytes(result)
+        return result
+    return __call__
+
+
+def profile_conversion(to_r: bool) -> Callable:
+    """ Record the time spent in a Python side conversion function
+
+    Only the outermost conversion is recorded, so recursive conversions are
+    not counted twice.
+
+    Args:
+        to_r (bool): Whether the function converts from Python to R (which
+            is recorded as argument conversion) or from R to Python (which is
+            recorded as result conversion)
+    """
+    def decorator(func: Callable) -> Callable:
+        name = f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled or getattr(_local, 'converting', False):
+                return func(*args, **kwargs)
+
+            _local.converting = True
+            start_ns, started = time.time_ns(), time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _local.converting = False
+            total = time.perf_counter() - started
+
+            nbytes = _py_nbytes(result if not to_r else args[0]) \
+                if _state.track_bytes else 0
+            _export(_attribution(), name, {
+                'total_seconds': total,
+                'args_seconds' if to_r else 'result_seconds': total,
+                'bytes_to_r' if to_r else 'bytes_from_r': nbytes
+            }, start_ns)
+            return result
+        return wrapper
+    return decorator
+
+
+def enable_profiling(exporters: tuple[str, ...] = ('logging', 'registry'),
+                     log_level: int = logging.DEBUG,
+                     track_bytes: bool = True) -> None:
+    """ Start recording the calls into R
+
+    Args:
+        exporters (tuple[str, ...], optional): Where to export the
+            measurements to: "logging", "registry" and/or "opentelemetry".
+            Defaults to ("logging", "registry").
+        log_level (int, optional): The level at which calls are logged to the
+            ``ohdsi.common.profiling`` logger. Defaults to logging.DEBUG.
+        track_bytes (bool, optional): Whether to estimate the number of bytes
+            moved between Python and R. Defaults to True.
+    """
+    from rpy2 import rinterface
+    from rpy2.robjects.functions import Function
+
+    unknown = set(exporters) - set(EXPORTERS)
+    if unknown:
+        raise ValueError(f"Unknown exporter(s) {sorted(unknown)}, choose "
+                         f"from {EXPORTERS}")
+
+    tracer = None
+    if 'opentelemetry' in exporters:
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError("Exporting to OpenTelemetry requires the "
+                              "`opentelemetry-api` package") from e
+        tracer = trace.get_tracer('ohdsi')
+
+    _state.exporters = frozenset(exporters)
+    _state.log_level = log_level
+    _state.track_bytes = track_bytes
+    _state.tracer = tracer
+
+    if not _state.enabled:
+        patches = {Function: _profile_function_call,
+                   rinterface.SexpClosure: _profile_closure_call}
+        for cls, profile in patches.items():
+            _state.originals[cls] = cls.__dict__.get('__call__')
+            cls.__call__ = profile(cls.__call__)
+        _state.enabled = True
+
+
+def disable_profiling() -> None:
+    """ Stop recording the calls into R, and restore rpy2 """
+    for cls, original in _state.originals.items():
+        if original is None:
+            del cls.__call__
+        else:
+            cls.__call__ = original
+    _state.originals = {}
+    _state.tracer = None
+    _state.enabled = False
+
+
+def profiling_enabled() -> bool:
+    return _state.enabled
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """ Attribute the R calls made within a block (or function) to ``name``
+
+    Can be used as context manager or as decorator. When exporting to
+    OpenTelemetry, the block becomes the parent span of the calls.
+
+    Args:
+        name (str): The name under which the calls are recorded
+    """
+    if not _state.enabled:
+        yield
+        return
+
+    labels = _labels()
+    labels.append(name)
+    span = _state.tracer.start_as_current_span(name) \
+        if _state.tracer is not None else nullcontext()
+    start_ns, started = time.time_ns(), time.perf_counter()
+    try:
+        with span:
+            yield
+    finally:
+        labels.pop()
+        _export(name, '<total>',
+                {'total_seconds': time.perf_counter() - started},
+                start_ns, span=False)
+
+
+def get_profile_stats() -> pd.DataFrame:
+    """ Aggregated measurements from the in-process registry
+
+    Returns:
+        pd.DataFrame: One row per combination of wrapper and (R or
+            conversion) function, sorted by total time. Conversion functions
+            are inclusive of the R calls they make.
+    """
+    with _registry_lock:
+        rows = [{'wrapper': wrapper, 'function': function, **stats}
+                for (wrapper, function), stats in _registry.items()]
+    stats = pd.DataFrame(rows, columns=['wrapper', 'function', *_FIELDS])
+    return stats.sort_values('total_seconds', ascending=False,
+                             ignore_index=True)
+
+
+def reset_profile_stats() -> None:
+    """ Clear the in-process registry """
+    with _registry_lock:
+        _registry.clear()
+
+
+if os.environ.get('OHDSI_PROFILING', False):
+    enable_profiling()
@@ -6,6 +6,16 @@ from rpy2.robjects.packages import importr
 from rpy2.robjects.vectors import ListVector
 from rpy2.robjects.methods import RS4
 
+import pandas as pd
+
+from ohdsi.database_connector.cache import QueryCache
+from ohdsi.database_connector import query_log
+from ohdsi.database_connector.pipeline import (
+    execute_sql_script, _render_translate
+)
+from ohdsi.database_connector.query_log import record_statement
+from ohdsi.database_connector.transfer import query_sql_to_arrow
+
 # When building documentation for the project, the following import will fail
 # as the package is not installed. In this case, we set the variable to None
 # so that the documentation can be built.
@@ -196,18 +206,63 @@ def disconnect(connection: RS4) -> None:
     database_connector_r.disconnect(connection)
 
 
+def _to_pandas(result: RS4) -> pd.DataFrame:
+    from ohdsi.common import convert_from_r
+    return convert_from_r(result)
+
+
+def _query(connection: RS4, sql: str, **args) -> RS4:
+    return record_statement(
+        connection, sql,
+        lambda: database_connector_r.querySql(connection, sql, **args),
+        rows=lambda result: result.nrow)
+
+
+def _execute(connection: RS4, sql: str, **args) -> None:
+    record_statement(
+        connection, sql,
+        lambda: database_connector_r.executeSql(connection, sql, **args),
+        explain=False)
+
+
+# the arguments of renderTranslateExecuteSql and renderTranslateQuerySql that
+# are passed on to executeSql and querySql, the others render the SQL
+_EXECUTE_ARGS = ("progressBar", "reportOverallTime", "errorReportFile",
+                 "profile", "runAsBatch")
+_QUERY_ARGS = ("snakeCaseToCamelCase", "errorReportFile", "integerAsNumeric",
+               "integer64AsNumeric")
+
+
+def _render_translate_like_r(connection: RS4, sql: str, args: dict,
+                             kwargs: dict, passed_on: tuple[str, ...]) \
+        -> tuple[str, dict]:
+    """ Render and translate the SQL as the renderTranslate* functions do
+
+    Returns the translated SQL, and the arguments for executeSql or querySql.
+    """
+    arguments = {**args, **kwargs}
+    sql = _render_translate(
+        database_connector_r.dbms(connection)[0], sql,
+        arguments.pop("tempEmulationSchema", None),
+        **{k: v for k, v in arguments.items() if k not in passed_on})
+    return sql, {k: v for k, v in arguments.items() if k in passed_on}
+
+
 # -----------------------------------------------------------------------------
 # wrapper: DatabaseConnector/R/Sql.R
 # functions:
 #    - querySql (query_sql)
 #    - executeSql (execute_sql)
 # -----------------------------------------------------------------------------
-def query_sql(connection: RS4, sql: str) -> RS4:
+def query_sql(connection: RS4, sql: str, cache: QueryCache | None = None,
+              tags: list[str] = ()) -> RS4 | pd.DataFrame:
     """
     Query a database
 
     Wraps the R ``DatabaseConnector::querySql`` function defined in
-    ``DatabaseConnector/R/Sql.R``.
+    ``DatabaseConnector/R/Sql.R``. Use ``query_sql_to_arrow`` to retrieve
+    large results, which avoids the R data frame of the full result and its
+    conversion by rpy2.
 
     Parameters
     ----------
@@ -215,18 +270,29 @@ def query_sql(connection: RS4, sql: str) -> RS4:
         The database connection.
     sql : str
         The SQL query.
+    cache : QueryCache, optional
+        When given, the result is taken from (or stored in) this cache, and
+        returned as a pandas data frame.
+    tags : list[str], optional
+        The tags of the cached result, e.g. the version of the CDM, see
+        ``QueryCache``.
 
     Returns
     -------
-    RS4
-        The query result.
+    RS4 | pd.DataFrame
+        The query result, a pandas data frame when cached.
 
     Examples
     --------
     >>> query_sql(connection, sql)
     >>> query_sql(connection, "SELECT COUNT(*) FROM person")
+    >>> query_sql(connection, "SELECT COUNT(*) FROM person",
+    ...           cache=QueryCache("query_cache"), tags=["cdm:v5.4"])
     """
-    return database_connector_r.querySql(connection, sql)
+    if cache is not None:
+        return cache.query(connection, sql, tags=tags,
+                           run=lambda: _to_pandas(_query(connection, sql)))
+    return _query(connection, sql)
 
 
 def execute_sql(connection: RS4, sql: str) -> None:
@@ -234,7 +300,8 @@ def execute_sql(connection: RS4, sql: str) -> None:
     Execute a SQL statement
 
     Wraps the R ``DatabaseConnector::executeSql`` function defined in
-    ``DatabaseConnector/R/Sql.R``.
+    ``DatabaseConnector/R/Sql.R``. Use ``execute_sql_script`` to time the
+    statements of a long script.
 
     Parameters
     ----------
@@ -251,4 +318,133 @@ def execute_sql(connection: RS4, sql: str) -> None:
     ...     conn, "CREATE TABLE x (k INT); CREATE TABLE y (k INT);"
     ... )
     """
-    database_connector_r.executeSql(connection, sql)
+    _execute(connection, sql)
+
+
+# -----------------------------------------------------------------------------
+# wrapper: DatabaseConnector/R/RenderTranslateSql.R
+# functions:
+#    - renderTranslateExecuteSql (render_translate_execute_sql)
+#    - renderTranslateQuerySql (render_translate_query_sql)
+# -----------------------------------------------------------------------------
+def render_translate_execute_sql(
+    connection: RS4, sql: str, progress_bar: bool = False,
+    report_overall_time: bool = False,
+    temp_emulation_schema: str | None = None, **kwargs
+) -> None:
+    """
+    Render, translate and execute SQL code
+
+    Renders the parameterized SQL, translates it to the dialect of the
+    connection and executes it.
+
+    Wraps the R ``DatabaseConnector::renderTranslateExecuteSql`` function
+    defined in ``DatabaseConnector/R/RenderTranslateSql.R``.
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection.
+    sql : str
+        The parameterized SQL, in OHDSI SQL.
+    progress_bar : bool, optional
+        When True, a progress bar is shown. By default False.
+    report_overall_time : bool, optional
+        When True, the total execution time is reported. By default False.
+    temp_emulation_schema : str | None, optional
+        A schema where temp tables can be emulated, for database platforms
+        that do not support temp tables.
+    **kwargs
+        The parameter values used to render the SQL.
+
+    Examples
+    --------
+    >>> render_translate_execute_sql(
+    ...     connection, "DELETE FROM @schema.cohort;", schema="results"
+    ... )
+    """
+    args = {
+        "progressBar": progress_bar,
+        "reportOverallTime": report_overall_time,
+        "tempEmulationSchema": temp_emulation_schema
+    }
+    # remove None values
+    args = {k: v for k, v in args.items() if v is not None}
+    if query_log.query_log_enabled():
+        # translated here, so that the log shows the translated SQL
+        sql, args = _render_translate_like_r(connection, sql, args, kwargs,
+                                             _EXECUTE_ARGS)
+        _execute(connection, sql, **args)
+        return
+    database_connector_r.renderTranslateExecuteSql(
+        connection, sql, **args, **kwargs
+    )
+
+
+def render_translate_query_sql(
+    connection: RS4, sql: str, snake_case_to_camel_case: bool = False,
+    temp_emulation_schema: str | None = None,
+    cache: QueryCache | None = None, tags: list[str] = (), **kwargs
+) -> RS4 | pd.DataFrame:
+    """
+    Render, translate and query SQL code
+
+    Renders the parameterized SQL, translates it to the dialect of the
+    connection and retrieves the results.
+
+    Wraps the R ``DatabaseConnector::renderTranslateQuerySql`` function
+    defined in ``DatabaseConnector/R/RenderTranslateSql.R``.
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection.
+    sql : str
+        The parameterized SQL, in OHDSI SQL.
+    snake_case_to_camel_case : bool, optional
+        When True, the column names of the result are converted from
+        snake_case to camelCase. By default False.
+    temp_emulation_schema : str | None, optional
+        A schema where temp tables can be emulated, for database platforms
+        that do not support temp tables.
+    cache : QueryCache, optional
+        When given, the result is taken from (or stored in) this cache, and
+        returned as a pandas data frame. It is keyed on the SQL and the
+        parameters, which determine the translated SQL.
+    tags : list[str], optional
+        The tags of the cached result, see ``QueryCache``.
+    **kwargs
+        The parameter values used to render the SQL.
+
+    Returns
+    -------
+    RS4 | pd.DataFrame
+        The query result, a pandas data frame when cached.
+
+    Examples
+    --------
+    >>> render_translate_query_sql(
+    ...     connection, "SELECT COUNT(*) FROM @schema.person;", schema="main"
+    ... )
+    """
+    args = {
+        "snakeCaseToCamelCase": snake_case_to_camel_case,
+        "tempEmulationSchema": temp_emulation_schema
+    }
+    # remove None values
+    args = {k: v for k, v in args.items() if v is not None}
+
+    def _run() -> RS4:
+        if query_log.query_log_enabled():
+            # translated here, so that the log shows the translated SQL
+            translated, query_args = _render_translate_like_r(
+                connection, sql, args, kwargs, _QUERY_ARGS)
+            return _query(connection, translated, **query_args)
+        return database_connector_r.renderTranslateQuerySql(
+            connection, sql, **args, **kwargs
+        )
+
+    if cache is not None:
+        return cache.query(connection, sql, tags=tags,
+                           run=lambda: _to_pandas(_run()), **args, **kwargs)
+    return _run()
@@ -0,0 +1,221 @@
+"""
+A local cache of query results
+
+Notebooks and services tend to issue the same queries over and over, e.g.
+concept lookups and counts. A ``QueryCache`` keeps the results of queries as
+Arrow files in a local folder, keyed on the normalized SQL, the database the
+connection points to and user supplied tags. Tags carry what the SQL itself
+does not tell, like the version of the CDM or the generation of a cohort
+table: a new tag value makes a new cache entry, and ``invalidate`` drops the
+entries of a tag. The least recently used results are evicted once the cache
+exceeds its size.
+
+Examples
+--------
+>>> cache = QueryCache("~/.cache/ohdsi/queries", max_bytes=2**30)
+>>> query_sql(connection, "SELECT COUNT(*) FROM cdm.person", cache=cache,
+...           tags=["cdm:v5.4-2024-01"])
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from rpy2 import robjects
+from rpy2.robjects.methods import RS4
+
+_INDEX_SQL = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, bytes INTEGER,
+                                    last_used REAL);
+CREATE TABLE IF NOT EXISTS entry_tags (key TEXT, tag TEXT);
+CREATE INDEX IF NOT EXISTS idx_entry_tags_tag ON entry_tags (tag);
+"""
+
+# identifies the database a connection points to
+_TARGET_R = """
+function(connection) {
+  url <- tryCatch({
+    if (methods::is(connection, "DatabaseConnectorJdbcConnection")) {
+      metaData <- rJava::.jcall(connection@jConnection,
+                                "Ljava/sql/DatabaseMetaData;", "getMetaData")
+      rJava::.jcall(metaData, "S", "getURL")
+    } else {
+      DBI::dbGetInfo(connection@dbiConnection)$dbname
+    }
+  }, error = function(e) "")
+  paste(DatabaseConnector::dbms(connection), url)
+}
+"""
+_target_r = None
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+    except ImportError as e:
+        raise ImportError("The query cache requires the `pyarrow` package, "
+                          "install it with `pip install pyarrow`") from e
+    return pyarrow
+
+
+def connection_target(connection: RS4) -> str:
+    """ The platform and URL (or file) of the database of a connection """
+    global _target_r
+    if _target_r is None:
+        _target_r = robjects.r(_TARGET_R)
+    return str(_target_r(connection)[0])
+
+
+# quoted literals and identifiers are matched first, so that what looks like
+# a comment or whitespace inside them is kept
+_SQL_TOKEN = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(?:--[^\n]*|/\*.*?\*/|\s)+",
+    flags=re.DOTALL
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """ SQL without comments and redundant whitespace outside of quotes """
+    sql = _SQL_TOKEN.sub(lambda m: m.group(1) or " ", sql)
+    return sql.strip().rstrip(";").strip()
+
+
+class QueryCache:
+    """
+    Query results cached as Arrow files, evicted least recently used first
+
+    The cache can be shared by threads and processes that use the same
+    folder.
+
+    Args:
+        folder (str | Path): The folder of the cached results
+        max_bytes (int, optional): The size the cache is kept under.
+            Defaults to 1 GiB.
+    """
+    def __init__(self, folder: str | Path, max_bytes: int = 2**30):
+        _import_pyarrow()
+        self.folder = Path(folder).expanduser()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.folder / "index.sqlite",
+                                   check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_INDEX_SQL)
+
+    def _file(self, key: str) -> Path:
+        return self.folder / f"{key}.arrow"
+
+    @staticmethod
+    def key(target: str, sql: str, tags: list[str] = (), **params) -> str:
+        """ The cache key of a query on a database """
+        return hashlib.sha256(json.dumps(
+            [target, normalize_sql(sql), sorted(tags), params],
+            sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> pd.DataFrame | None:
+        """ The cached result, or None """
+        pa = _import_pyarrow()
+        try:
+            table = pa.feather.read_table(self._file(key), memory_map=True)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?",
+                             (time.time(), key))
+        return table.to_pandas()
+
+    def put(self, key: str, result: pd.DataFrame, tags: list[str] = ()) \
+            -> None:
+        """ Cache a result, evicting others when the cache is full """
+        pa = _import_pyarrow()
+        file = self._file(key)
+        tmp_file = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+        pa.feather.write_feather(
+            pa.Table.from_pandas(result, preserve_index=False), tmp_file,
+            compression="uncompressed")
+        os.replace(tmp_file, file)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                             (key, file.stat().st_size, time.time()))
+            self._db.execute("DELETE FROM entry_tags WHERE key = ?", (key,))
+            self._db.executemany("INSERT INTO entry_tags VALUES (?, ?)",
+                                 ((key, tag) for tag in set(tags)))
+            self._evict()
+            self._db.execute("COMMIT")
+
+    def _evict(self) -> None:
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._db.execute(
+                "SELECT key, bytes FROM entries ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        self._remove(evicted)
+
+    def _remove(self, keys: list[str]) -> None:
+        for key in keys:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._db.execute("DELETE FROM entry_tags WHERE key = ?", (key,))
+            self._file(key).unlink(missing_ok=True)
+
+    def invalidate(self, *tags: str) -> int:
+        """ Drop the cached results of any of the tags """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            keys = [row[0] for row in self._db.execute(
+                "SELECT DISTINCT key FROM entry_tags WHERE tag IN "
+                f"({', '.join('?' * len(tags))})", tags)]
+            self._remove(keys)
+            self._db.execute("COMMIT")
+        return len(keys)
+
+    def clear(self) -> None:
+        """ Drop all cached results """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._remove([row[0] for row in
+                          self._db.execute("SELECT key FROM entries")])
+            self._db.execute("COMMIT")
+
+    def query(self, connection: RS4, sql: str,
+              run: Callable[[], pd.DataFrame], tags: list[str] = (),
+              **params) -> pd.DataFrame:
+        """
+        The cached result of a query, or the result of running it
+
+        Args:
+            connection (RS4): The connection the query runs on
+            sql (str): The SQL of the query
+            run (Callable[[], pd.DataFrame]): Runs the query
+            tags (list[str], optional): The tags of the result
+            **params: Whatever else determines the result, e.g. the
+                parameters the SQL is rendered with
+
+        Returns:
+            pd.DataFrame: The result
+        """
+        key = self.key(connection_target(connection), sql, tags, **params)
+        result = self.get(key)
+        if result is None:
+            result = run()
+            self.put(key, result, tags)
+        return result
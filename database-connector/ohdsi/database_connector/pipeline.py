@@ -0,0 +1,172 @@
+"""
+Execution of long SQL scripts, statement by statement
+
+``execute_sql`` hands a script to DatabaseConnector, which splits and runs it
+without reporting anything back. ``execute_sql_script`` renders, translates
+and splits the script itself, and executes it while timing every statement
+and recording the number of rows it affected. On platforms whose JDBC driver
+executes batches, consecutive statements that return no results (DDL and
+DML) are sent as a single JDBC batch, saving a round trip per statement on
+high-latency warehouses. The statements of a batch share its duration, and
+their row counts are unknown. The statements are recorded in the query log
+(see ``query_log``) when it is enabled.
+"""
+from __future__ import annotations
+
+import os
+import re
+import time
+import logging
+
+from typing import Any, Callable
+
+import pandas as pd
+
+from rpy2.robjects.methods import RS4
+from rpy2.robjects.packages import importr
+
+from ohdsi.database_connector.query_log import record_statement
+
+if os.environ.get('IGNORE_R_IMPORTS', False):
+    database_connector_r = None
+    sql_render_r = None
+else:
+    database_connector_r = importr('DatabaseConnector')
+    sql_render_r = importr('SqlRender')
+
+logger = logging.getLogger(__name__)
+
+# the platforms whose drivers execute a JDBC batch in a single round trip
+BATCH_DIALECTS = ("postgresql", "redshift", "sql server", "pdw", "synapse",
+                  "oracle")
+
+# statements that return no result set, and can be part of a batch
+_NO_RESULT = re.compile(
+    r"^\s*(CREATE|DROP|INSERT|UPDATE|DELETE|TRUNCATE|ALTER|MERGE)\b",
+    re.IGNORECASE)
+
+
+def _rows_affected(result) -> int | None:
+    """ The row count of ``lowLevelExecuteSql``, when the driver reports it """
+    try:
+        rows = int(result[0])
+    except (TypeError, IndexError, ValueError):
+        return None
+    return rows if rows >= 0 else None
+
+
+def _timed(func: Callable, *args, **kwargs) -> tuple[Any, float]:
+    """ The result of a function, and the seconds it took """
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def _units(statements: list[str], batch: bool) -> list[list[int]]:
+    """ Group consecutive statements without results into batches """
+    units = []
+    for i, statement in enumerate(statements):
+        if batch and units and _NO_RESULT.match(statement) \
+                and _NO_RESULT.match(statements[units[-1][-1]]):
+            units[-1].append(i)
+        else:
+            units.append([i])
+    return units
+
+
+def _render_translate(dbms: str, sql: str,
+                      temp_emulation_schema: str | None = None,
+                      **kwargs) -> str:
+    """ Render OHDSI SQL and translate it to the dialect of a platform """
+    # rendered without parameters too, which resolves the defaults and
+    # conditional blocks of the SQL
+    sql = sql_render_r.render(sql, **kwargs)[0]
+    args = {"tempEmulationSchema": temp_emulation_schema}
+    args = {k: v for k, v in args.items() if v is not None}
+    return sql_render_r.translate(sql, targetDialect=dbms, **args)[0]
+
+
+def execute_sql_script(
+    connection: RS4, sql: str, translate: bool = True, batch: bool = True,
+    temp_emulation_schema: str | None = None, **kwargs
+) -> pd.DataFrame:
+    """
+    Execute a SQL script statement by statement, timing every statement
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection.
+    sql : str
+        The SQL script, in OHDSI SQL when ``translate`` is True.
+    translate : bool, optional
+        Whether the SQL is rendered with ``kwargs`` and translated to the
+        dialect of the connection, by default True.
+    batch : bool, optional
+        Whether consecutive DDL and DML statements are executed as a single
+        JDBC batch, on platforms that support it (see ``BATCH_DIALECTS``).
+        By default True.
+    temp_emulation_schema : str | None, optional
+        A schema where temp tables can be emulated, for database platforms
+        that do not support temp tables.
+    **kwargs
+        The parameter values used to render the SQL.
+
+    Returns
+    -------
+    pd.DataFrame
+        A row per statement, with its (translated) ``sql``, the ``batch`` it
+        was executed in, the ``seconds`` the batch took and the number of
+        ``rows`` it affected, when known.
+
+    Raises
+    ------
+    RuntimeError
+        When a statement fails, the statements before it have been executed
+
+    Examples
+    --------
+    >>> timings = execute_sql_script(connection, cohort_sql,
+    ...                              cdm_database_schema="main")
+    >>> timings.sort_values("seconds", ascending=False).head()
+    """
+    dbms = database_connector_r.dbms(connection)[0]
+    if translate:
+        sql = _render_translate(dbms, sql, temp_emulation_schema, **kwargs)
+    statements = [s for s in sql_render_r.splitSql(sql) if s.strip()]
+    units = _units(statements, batch and dbms in BATCH_DIALECTS)
+
+    records = []
+    for number, unit in enumerate(units):
+        try:
+            if len(unit) == 1:
+                statement = statements[unit[0]]
+                result, seconds = record_statement(
+                    connection, statement,
+                    lambda: _timed(database_connector_r.lowLevelExecuteSql,
+                                   connection, statement),
+                    rows=lambda timed: _rows_affected(timed[0]))
+                rows = _rows_affected(result)
+            else:
+                script = ";\n".join(statements[i] for i in unit)
+                _, seconds = record_statement(
+                    connection, script,
+                    lambda: _timed(database_connector_r.executeSql,
+                                   connection, script, progressBar=False,
+                                   reportOverallTime=False, runAsBatch=True),
+                    explain=False)
+                rows = None
+        except Exception as e:
+            failed = f"Statement {unit[0] + 1}" if len(unit) == 1 else \
+                f"The batch of statements {unit[0] + 1} to {unit[-1] + 1}"
+            raise RuntimeError(
+                f"{failed} (of {len(statements)}) failed:\n"
+                f"{statements[unit[0]]}") from e
+        logger.debug("Executed statement(s) %s in %.3fs",
+                     [i + 1 for i in unit], seconds)
+        records += [(i + 1, number, statements[i], seconds, rows)
+                    for i in unit]
+
+    return pd.DataFrame.from_records(
+        records, columns=["statement", "batch", "sql", "seconds", "rows"]
+    ).astype({"rows": "Int64"})
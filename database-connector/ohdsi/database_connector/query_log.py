@@ -0,0 +1,225 @@
+"""
+A log of the SQL statements executed by the wrappers
+
+When the query log is enabled, the statements that ``query_sql``,
+``execute_sql``, ``render_translate_query_sql``,
+``render_translate_execute_sql`` and ``execute_sql_script`` send to the
+database are recorded with their translated SQL, their duration, the number
+of rows they returned or affected and, on request, their query plan.
+Statements that take longer than a threshold are appended to a slow-query
+log: a JSONL file with a statement per line, together with the ``ohdsi``
+wrapper function that executed it. The SQL that R packages (e.g.
+FeatureExtraction) execute themselves is not recorded; run the SQL they
+generate with ``execute_sql_script`` to find its slow statements.
+
+The log can also be enabled by setting the ``OHDSI_SLOW_QUERY_LOG``
+environment variable to the path of the slow-query log.
+
+Examples
+--------
+>>> from ohdsi.database_connector import query_log
+>>> query_log.enable_query_log("slow_queries.jsonl", threshold=10,
+...                            explain=True)
+>>> execute_sql_script(connection, cohort_sql, cdm_database_schema="main")
+>>> query_log.get_query_log().sort_values("seconds").tail()
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+import pandas as pd
+
+from rpy2.robjects.methods import RS4
+from rpy2.robjects.packages import importr
+
+if os.environ.get('IGNORE_R_IMPORTS', False):
+    database_connector_r = None
+else:
+    database_connector_r = importr('DatabaseConnector')
+
+logger = logging.getLogger(__name__)
+
+# what is prefixed to a statement to obtain its plan, without executing it
+EXPLAIN_PREFIXES = {
+    "postgresql": "EXPLAIN ",
+    "redshift": "EXPLAIN ",
+    "duckdb": "EXPLAIN ",
+    "spark": "EXPLAIN ",
+    "snowflake": "EXPLAIN USING TEXT ",
+    "sqlite": "EXPLAIN QUERY PLAN ",
+}
+
+# statements that have a query plan
+_EXPLAINABLE = re.compile(
+    r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE"
+    r"|CREATE\s+(TEMP\s+|TEMPORARY\s+)?TABLE\s+\S+\s+AS)\b",
+    re.IGNORECASE)
+
+_FIELDS = ("timestamp", "wrapper", "dbms", "sql", "seconds", "rows", "plan")
+
+
+class _State:
+    enabled: bool = False
+    path: Path | None = None
+    threshold: float = 1.0
+    explain: bool = False
+
+
+_state = _State()
+_records: deque[dict] = deque(maxlen=10_000)
+_lock = threading.Lock()
+
+
+def _explain(connection: RS4, dbms: str, sql: str) -> str | None:
+    prefix = EXPLAIN_PREFIXES.get(dbms)
+    if prefix is None or not _EXPLAINABLE.match(sql):
+        return None
+    try:
+        plan = database_connector_r.querySql(connection, prefix + sql)
+    except Exception as e:
+        # e.g. the statement refers to a table that does not exist yet
+        logger.debug("Could not explain the statement: %s", e)
+        return None
+    # the plan is in the last column, one line per row
+    return "\n".join(str(line) for line in plan[len(plan) - 1])
+
+
+def _write(record: dict) -> None:
+    with _lock:
+        _records.append(record)
+        if _state.path is not None and record["seconds"] >= _state.threshold:
+            with open(_state.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def record_statement(connection: RS4, sql: str, execute: Callable[[], Any],
+                     rows: Callable[[Any], int | None] | None = None,
+                     explain: bool = True) -> Any:
+    """
+    Execute a statement, recording it when the query log is enabled
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection.
+    sql : str
+        The (translated) SQL that is executed.
+    execute : Callable[[], Any]
+        Executes the SQL.
+    rows : Callable[[Any], int | None], optional
+        Obtains the number of rows returned or affected from the result of
+        ``execute``. When not given, the number of rows is unknown.
+    explain : bool, optional
+        Whether the plan of the statement can be obtained when the log
+        explains statements, which is not the case for scripts. By default
+        True.
+
+    Returns
+    -------
+    Any
+        The result of ``execute``.
+    """
+    if not _state.enabled:
+        return execute()
+
+    from ohdsi.common.profiling import calling_wrapper
+
+    dbms = database_connector_r.dbms(connection)[0]
+    plan = _explain(connection, dbms, sql) \
+        if _state.explain and explain else None
+    timestamp = datetime.now(timezone.utc).isoformat()
+    started = time.perf_counter()
+    result = execute()
+    seconds = time.perf_counter() - started
+
+    _write({
+        "timestamp": timestamp,
+        # the wrapper that was called, not the helpers of this package
+        "wrapper": calling_wrapper(
+            ignore=(__name__, "ohdsi.database_connector.cache")),
+        "dbms": dbms,
+        "sql": sql,
+        "seconds": seconds,
+        "rows": rows(result) if rows is not None else None,
+        "plan": plan,
+    })
+    return result
+
+
+def enable_query_log(path: str | Path | None = None, threshold: float = 1.0,
+                     explain: bool = False, max_records: int = 10_000) \
+        -> None:
+    """
+    Start recording the statements executed by the wrappers
+
+    Parameters
+    ----------
+    path : str | Path | None, optional
+        The JSONL file the slow statements are appended to. When None, the
+        statements are only kept in memory (see ``get_query_log``).
+    threshold : float, optional
+        The duration in seconds from which a statement is slow, by default
+        1.0.
+    explain : bool, optional
+        Whether the plan of each statement is obtained (on the platforms of
+        ``EXPLAIN_PREFIXES``). This costs a round trip per statement. By
+        default False.
+    max_records : int, optional
+        The number of (most recent) statements kept in memory, by default
+        10000.
+    """
+    global _records
+    with _lock:
+        if max_records != _records.maxlen:
+            _records = deque(_records, maxlen=max_records)
+        _state.path = Path(path).expanduser() if path is not None else None
+        _state.threshold = threshold
+        _state.explain = explain
+        _state.enabled = True
+
+
+def disable_query_log() -> None:
+    """ Stop recording the statements executed by the wrappers """
+    _state.enabled = False
+
+
+def query_log_enabled() -> bool:
+    return _state.enabled
+
+
+def get_query_log() -> pd.DataFrame:
+    """
+    The statements recorded in memory
+
+    Returns
+    -------
+    pd.DataFrame
+        A row per statement, in the order of execution, with the
+        ``wrapper`` that executed it, its translated ``sql``, the
+        ``seconds`` it took, the number of ``rows`` it returned or affected
+        (when known) and its ``plan`` (when explained).
+    """
+    with _lock:
+        records = list(_records)
+    return pd.DataFrame.from_records(records, columns=_FIELDS) \
+        .astype({"rows": "Int64"})
+
+
+def reset_query_log() -> None:
+    """ Clear the statements recorded in memory """
+    with _lock:
+        _records.clear()
+
+
+if os.environ.get('OHDSI_SLOW_QUERY_LOG', False):
+    enable_query_log(os.environ['OHDSI_SLOW_QUERY_LOG'])
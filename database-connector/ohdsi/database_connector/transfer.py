@@ -0,0 +1,123 @@
+"""
+Transfer of query results as Arrow tables
+
+``query_sql`` returns an R data frame of the full result, which has to be
+converted to pandas by rpy2 value by value, a conversion that dominates the
+time of large queries. ``query_sql_to_arrow`` uses
+``DatabaseConnector::querySqlToAndromeda`` instead, which still builds an R
+data frame of each batch it fetches from the database, but appends it to an
+Andromeda (DuckDB) database and drops it. DuckDB then writes the result to an
+(uncompressed) Parquet file, and pyarrow reads that file into an Arrow table
+with its columnar types intact. What is skipped is the data frame of the full
+result and the conversion by rpy2; the R memory is bounded by the batch size.
+Requires Andromeda 1.0 or later, which stores its data in DuckDB.
+"""
+from __future__ import annotations
+
+import os
+import tempfile
+
+from pathlib import Path
+
+from rpy2 import robjects
+from rpy2.robjects.methods import RS4
+from rpy2.robjects.packages import importr
+
+from ohdsi.database_connector.pipeline import _render_translate
+from ohdsi.database_connector.query_log import record_statement
+
+if os.environ.get('IGNORE_R_IMPORTS', False):
+    database_connector_r = None
+else:
+    database_connector_r = importr('DatabaseConnector')
+
+_TO_PARQUET_R = """
+function(connection, sql, file, snakeCaseToCamelCase) {
+  andromeda <- Andromeda::andromeda()
+  on.exit(Andromeda::close(andromeda))
+  if (!methods::is(andromeda, "duckdb_connection")) {
+    stop("Transferring results as Arrow requires Andromeda 1.0 or later")
+  }
+  DatabaseConnector::querySqlToAndromeda(
+    connection, sql, andromeda = andromeda, andromedaTableName = "result",
+    snakeCaseToCamelCase = snakeCaseToCamelCase
+  )
+  DBI::dbExecute(andromeda, sprintf(
+    "COPY result TO '%s' (FORMAT PARQUET, COMPRESSION 'uncompressed')", file
+  ))
+  invisible(NULL)
+}
+"""
+_to_parquet_r = None
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Transferring results as Arrow requires the "
+                          "`pyarrow` package, install it with `pip install "
+                          "pyarrow`") from e
+    return pyarrow
+
+
+def query_sql_to_arrow(
+    connection: RS4, sql: str, snake_case_to_camel_case: bool = False,
+    translate: bool = False, temp_emulation_schema: str | None = None,
+    **kwargs
+):
+    """
+    Query a database, and retrieve the result as an Arrow table
+
+    Parameters
+    ----------
+    connection : RS4
+        The database connection.
+    sql : str
+        The SQL query, in OHDSI SQL when ``translate`` is True.
+    snake_case_to_camel_case : bool, optional
+        When True, the column names of the result are converted from
+        snake_case to camelCase. By default False.
+    translate : bool, optional
+        Whether the SQL is rendered with ``kwargs`` and translated to the
+        dialect of the connection, by default False.
+    temp_emulation_schema : str | None, optional
+        A schema where temp tables can be emulated, for database platforms
+        that do not support temp tables.
+    **kwargs
+        The parameter values used to render the SQL.
+
+    Returns
+    -------
+    pyarrow.Table
+        The query result, use ``to_pandas()`` for a pandas data frame.
+
+    Examples
+    --------
+    >>> query_sql_to_arrow(connection, "SELECT * FROM main.measurement")
+    >>> query_sql_to_arrow(
+    ...     connection, "SELECT * FROM @schema.person;", translate=True,
+    ...     schema="main"
+    ... ).to_pandas()
+    """
+    global _to_parquet_r
+    pa = _import_pyarrow()
+    if _to_parquet_r is None:
+        _to_parquet_r = robjects.r(_TO_PARQUET_R)
+
+    if translate:
+        sql = _render_translate(database_connector_r.dbms(connection)[0],
+                                sql, temp_emulation_schema, **kwargs)
+
+    with tempfile.TemporaryDirectory() as folder:
+        file = Path(folder, "result.parquet")
+
+        def _transfer():
+            _to_parquet_r(connection, sql, file.as_posix(),
+                          snake_case_to_camel_case)
+            # read into memory, the file is removed with the folder
+            return pa.parquet.read_table(file, memory_map=False)
+
+        return record_statement(connection, sql, _transfer,
+                                rows=lambda table: table.num_rows)
@@ -1,17 +1,27 @@
 import os
+import sys
 import json
+import inspect
+import tempfile
+import functools
+import threading
 
-from typing import Any
+from typing import Any, Callable
 
 from rpy2 import robjects
 from rpy2.robjects.methods import RS4
-from rpy2.robjects.vectors import DataFrame, IntVector, ListVector
+from rpy2.robjects.vectors import DataFrame, IntVector, ListVector, StrVector
 from rpy2.robjects.packages import importr
 
+from ohdsi import database_connector
 from ohdsi.common import (
+    Checkpoint,
     ListVectorExtended,
     CovariateData,
-    convert_bool_from_r
+    convert_bool_from_r,
+    convert_to_r,
+    fingerprint,
+    run_tasks
 )
 
 
@@ -29,6 +39,181 @@ def _py_none_to_null(py_obj):
     return robjects.NULL
 
 
+#
+# R helpers
+#
+# Small R functions for manipulating settings and covariate data objects that
+# have no counterpart in FeatureExtraction. They are evaluated on first use.
+_R_HELPERS = {
+    "split_analyses": """
+        function(settings, groups) {
+            lapply(groups, function(indices) {
+                groupSettings <- settings
+                groupSettings$analyses <- settings$analyses[indices]
+                groupSettings
+            })
+        }
+    """,
+    "merge_covariate_data": """
+        function(files, sumPopulationSize = FALSE) {
+            datas <- lapply(files, FeatureExtraction::loadCovariateData)
+            on.exit(lapply(datas, Andromeda::close))
+            result <- Andromeda::andromeda()
+            for (data in datas) {
+                for (name in names(data)) {
+                    table <- data[[name]]
+                    if (name %in% names(result)) {
+                        Andromeda::appendToTable(result[[name]], table)
+                    } else {
+                        result[[name]] <- table
+                    }
+                }
+            }
+            refs <- c("covariateRef", "analysisRef", "timeRef")
+            for (name in intersect(names(result), refs)) {
+                result[[name]] <- dplyr::distinct(result[[name]])
+            }
+            metaData <- attr(datas[[1]], "metaData")
+            if (sumPopulationSize && !is.null(metaData$populationSize)) {
+                metaData$populationSize <- sum(sapply(datas, function(d) {
+                    attr(d, "metaData")$populationSize
+                }))
+            }
+            attr(result, "metaData") <- metaData
+            class(result) <- "CovariateData"
+            attr(class(result), "package") <- "FeatureExtraction"
+            result
+        }
+    """
+}
+
+
+@functools.cache
+def _r_helper(name: str) -> robjects.functions.Function:
+    return robjects.r(_R_HELPERS[name])
+
+
+#
+# Settings cache
+#
+# Building a settings object passes over a hundred arguments to R. As settings
+# objects are immutable from the R perspective, identical settings only need
+# to be built once per process.
+_settings_cache: dict[str, ListVector] = {}
+_settings_cache_lock = threading.Lock()
+
+
+def _cached_settings(func: Callable) -> Callable:
+    """
+    Cache the settings object created by ``func`` on its arguments
+
+    Every call returns a new ``ListVectorExtended``, so that modifying the
+    returned settings does not affect the cached object.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) -> ListVectorExtended:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = fingerprint({
+            "function": func.__name__,
+            "arguments": bound.arguments
+        })
+        with _settings_cache_lock:
+            settings = _settings_cache.get(key)
+        if settings is None:
+            settings = func(*args, **kwargs)
+            with _settings_cache_lock:
+                settings = _settings_cache.setdefault(key, settings)
+        return ListVectorExtended.from_list_vector(settings)
+
+    return wrapper
+
+
+def clear_settings_cache() -> None:
+    """
+    Remove all cached settings objects
+
+    Examples
+    --------
+    >>> clear_settings_cache()
+    """
+    with _settings_cache_lock:
+        _settings_cache.clear()
+
+
+def settings_fingerprint(
+        covariate_settings: ListVector | ListVectorExtended | list | dict
+        ) -> str:
+    """
+    Compute a deterministic hash of covariate settings
+
+    The settings can either be an R settings object (or a list of these), or
+    the Python keyword arguments used to create them. Settings objects that
+    are equal in R result in the same hash.
+
+    Parameters
+    ----------
+    covariate_settings : ListVector | ListVectorExtended | list | dict
+        An object of type ``covariateSettings``, a list of such objects or
+        the keyword arguments of one of the ``create_*_settings`` functions.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-256 digest of the settings.
+
+    Examples
+    --------
+    >>> settings = create_covariate_settings(use_demographics_gender=True)
+    >>> settings_fingerprint(settings)
+    '5b0c...'
+    """
+    return fingerprint(covariate_settings)
+
+
+def extraction_fingerprint(
+        covariate_settings: ListVector | ListVectorExtended | list | dict,
+        **extraction_arguments
+        ) -> str:
+    """
+    Compute a cache key for the results of a covariate extraction
+
+    Combines the fingerprint of the covariate settings with the arguments
+    that determine which data is extracted (e.g. the CDM schema, cohort table
+    and cohort ID). Connection objects should not be passed, as they do not
+    influence the result.
+
+    Parameters
+    ----------
+    covariate_settings : ListVector | ListVectorExtended | list | dict
+        The covariate settings used for the extraction.
+    **extraction_arguments
+        The remaining arguments of ``get_db_covariate_data``, e.g.
+        ``cdm_database_schema``, ``cohort_table`` and ``aggregated``.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-256 digest that identifies the extraction.
+
+    Examples
+    --------
+    >>> key = extraction_fingerprint(
+    ...     settings,
+    ...     cdm_database_schema="main",
+    ...     cohort_table="cohort",
+    ...     cohort_id=1,
+    ...     aggregated=True
+    ... )
+    """
+    return fingerprint({
+        "settings": settings_fingerprint(covariate_settings),
+        "arguments": extraction_arguments
+    })
+
+
 # -----------------------------------------------------------------------------
 # wrapper: FeatureExtraction/R/Aggregation.R
 # functions:
@@ -308,6 +493,7 @@ def create_empty_covariate_data(cohort_id: int = 1, aggregated: bool = False,
 # functions:
 #    - createCovariateSettings (create_covariate_settings)
 # -----------------------------------------------------------------------------
+@_cached_settings
 def create_covariate_settings(
     use_demographics_gender: bool = False,
     use_demographics_age: bool = False,
@@ -930,6 +1116,7 @@ def create_covariate_settings(
 # functions:
 #    - createTemporalCovariateSettings (create_temporal_covariate_settings)
 # -----------------------------------------------------------------------------
+@_cached_settings
 def create_temporal_covariate_settings(
     use_demographics_gender: bool = False,
     use_demographics_age: bool = False,
@@ -1422,6 +1609,7 @@ def create_temporal_sequence_covariate_settings(
 #    - createDetailedTemporalCovariateSettings
 #      (create_detailed_temporal_covariate_settings)
 # -----------------------------------------------------------------------------
+@_cached_settings
 def create_default_covariate_settings(
         included_covariate_concept_ids: list[int] = [],
         add_descendants_to_include: bool = False,
@@ -1478,6 +1666,7 @@ def create_default_covariate_settings(
     )
 
 
+@_cached_settings
 def convert_prespec_settings_to_detailed_settings(
         covariate_settings: ListVector | ListVectorExtended
         ) -> ListVectorExtended:
@@ -1768,6 +1957,62 @@ def create_detailed_temporal_covariate_settings(
     )
 
 
+def split_covariate_settings(
+        covariate_settings: ListVector | ListVectorExtended,
+        n_groups: int
+        ) -> list[ListVectorExtended]:
+    """
+    Split covariate settings into groups of analyses
+
+    Every FeatureExtraction analysis is an independent query, so the
+    analyses of a settings object can be extracted separately and merged
+    afterwards. Pre-specified settings are first converted to detailed
+    settings. The analyses are distributed round-robin over the groups.
+
+    Parameters
+    ----------
+    covariate_settings : ListVector | ListVectorExtended
+        An object of type ``covariateSettings``.
+    n_groups : int
+        The number of groups to split the analyses into. When there are
+        fewer analyses than groups, every analysis gets its own group.
+
+    Returns
+    -------
+    list[ListVectorExtended]
+        Detailed covariate settings, one for each group of analyses.
+
+    Examples
+    --------
+    >>> settings = create_covariate_settings(
+    ...     use_demographics_gender=True,
+    ...     use_demographics_age_group=True,
+    ...     use_condition_occurrence_any_time_prior=True
+    ... )
+    >>> groups = split_covariate_settings(settings, n_groups=2)
+    """
+    if covariate_settings.names == robjects.NULL:
+        raise ValueError("Only a single covariate settings object can be "
+                         "split, not a list of settings objects")
+
+    if "analyses" not in list(covariate_settings.names):
+        covariate_settings = convert_prespec_settings_to_detailed_settings(
+            covariate_settings
+        )
+
+    n_analyses = len(covariate_settings.rx2("analyses"))
+    n_groups = max(1, min(n_groups, n_analyses))
+    groups = [IntVector(range(i + 1, n_analyses + 1, n_groups))
+              for i in range(n_groups)]
+
+    return [
+        ListVectorExtended.from_list_vector(settings)
+        for settings in _r_helper("split_analyses")(
+            covariate_settings, convert_to_r(groups)
+        )
+    ]
+
+
 # -----------------------------------------------------------------------------
 # wrapper: FeatureExtraction/R/GetCovariates.R
 # functions:
@@ -1785,7 +2030,11 @@ def get_db_covariate_data(
     cohort_table_is_temp: bool = False,
     cohort_id: int = -1,
     row_id_field: str = "subject_id",
-    aggregated: bool = False
+    aggregated: bool = False,
+    max_workers: int = 1,
+    n_shards: int = 1,
+    shard_by: str = "subject_id",
+    checkpoint_folder: str | None = None
 ) -> CovariateData:
     """
     Get covariate information from the database
@@ -1846,6 +2095,32 @@ def get_db_covariate_data(
     aggregated
         Should aggregate statistics be computed instead of covariates per
         cohort entry?
+    max_workers
+        When larger than 1, the analyses in the covariate settings are split
+        into (at most) this number of groups, see
+        ``split_covariate_settings``. Each group is extracted in a separate
+        R process on its own connection, after which the results are merged.
+        Requires ``connection_details`` and a cohort table that is not a
+        temp table.
+    n_shards
+        When larger than 1, the cohort table is split into this number of
+        shards on ``shard_by``. Every shard is copied to its own temp cohort
+        table and extracted on a separate connection, running ``max_workers``
+        shards at the same time. The results are concatenated afterwards. Requires
+        ``connection_details`` and a cohort table that is not a temp table.
+    shard_by
+        Either "subject_id" or "cohort_definition_id". Rows are assigned to
+        shard ``value % n_shards``. Aggregated statistics cannot be combined
+        over subjects, so with ``aggregated = True`` the shards need to be
+        made by "cohort_definition_id". The row IDs are kept, so they are
+        the same as without sharding.
+    checkpoint_folder
+        Folder in which the results of completed analyses (or shards, when
+        ``n_shards > 1``) are kept, together with a manifest. When an
+        extraction fails halfway, running it again with the same folder only
+        extracts the missing parts. Without ``max_workers`` or ``n_shards``
+        the analyses are extracted one by one on the given connection. By
+        default no checkpoints are kept.
 
     Returns
     -------
@@ -1888,9 +2163,170 @@ def get_db_covariate_data(
     # remove None values
     args = {k: v for k, v in args.items() if v is not None}
 
+    if n_shards > 1:
+        return _get_db_covariate_data_by_shard(
+            args, n_shards, shard_by, max_workers, checkpoint_folder
+        )
+
+    if max_workers > 1 or checkpoint_folder is not None:
+        return _get_db_covariate_data_by_analysis(
+            args, max_workers, checkpoint_folder
+        )
+
     return CovariateData.from_RS4(extractor_r.getDbCovariateData(**args))
 
 
+def _get_db_covariate_data_worker(args: dict, file: str) -> str:
+    covariate_data = extractor_r.getDbCovariateData(**args)
+    extractor_r.saveCovariateData(covariate_data, file)
+    return file
+
+
+def _as_list_vector(settings: ListVector | ListVectorExtended) \
+        -> ListVector:
+    # R objects are sent to the workers by R serialization, which should
+    # not include the Python side state of a ListVectorExtended
+    if isinstance(settings, ListVectorExtended):
+        return settings.as_list_vector()
+    return settings
+
+
+def _check_worker_args(args: dict) -> None:
+    # every worker needs to open its own connection, which also means that
+    # the other connections cannot see a temp cohort table
+    if "connectionDetails" not in args:
+        raise ValueError("Extracting covariates in separate workers requires "
+                         "`connection_details`")
+    if args["cohortTableIsTemp"]:
+        raise ValueError("Extracting covariates in separate workers is not "
+                         "possible for a temp cohort table")
+
+
+def _extraction_run_id(args: dict, **kwargs) -> str:
+    return extraction_fingerprint(
+        args["covariateSettings"],
+        **{k: v for k, v in args.items()
+           if k not in ("connection", "connectionDetails",
+                        "covariateSettings")},
+        **kwargs
+    )
+
+
+def _get_db_covariate_data_by_analysis(args: dict, max_workers: int,
+                                       checkpoint_folder: str | None) \
+        -> CovariateData:
+    if max_workers > 1:
+        _check_worker_args(args)
+        args = {k: v for k, v in args.items() if k != "connection"}
+
+    # checkpoints are kept per analysis, otherwise each worker gets a group
+    n_groups = max_workers if checkpoint_folder is None else sys.maxsize
+    groups = {
+        f"analyses_{settings_fingerprint(group)[:16]}": group
+        for group in split_covariate_settings(
+            args["covariateSettings"], n_groups
+        )
+    }
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        checkpoint = Checkpoint(checkpoint_folder or temp_folder,
+                                _extraction_run_id(args))
+        files = {task: checkpoint.path(task) for task in groups}
+        tasks = {
+            task: (
+                _get_db_covariate_data_worker,
+                ({**args, "covariateSettings": _as_list_vector(group)},
+                 files[task])
+            )
+            for task, group in groups.items()
+        }
+        run_tasks(tasks, checkpoint, max_workers, files)
+        covariate_data = _r_helper("merge_covariate_data")(
+            StrVector(list(files.values()))
+        )
+
+    return CovariateData.from_RS4(covariate_data)
+
+
+_SHARD_SQL = """
+SELECT *
+INTO #cohort_shard
+FROM {@cohort_database_schema != ''} ? {@cohort_database_schema.}@cohort_table
+WHERE @shard_by % @n_shards = @shard;
+"""
+
+
+def _get_db_covariate_data_shard_worker(args: dict, shard: int,
+                                        n_shards: int, shard_by: str,
+                                        file: str) -> str:
+    connection = database_connector.connect(args["connectionDetails"])
+    try:
+        database_connector.render_translate_execute_sql(
+            connection, _SHARD_SQL,
+            temp_emulation_schema=args.get("oracleTempSchema"),
+            cohort_database_schema=args.get("cohortDatabaseSchema", ""),
+            cohort_table=args["cohortTable"],
+            shard_by=shard_by,
+            n_shards=n_shards,
+            shard=shard
+        )
+        shard_args = {
+            k: v for k, v in args.items()
+            if k not in ("connectionDetails", "cohortDatabaseSchema")
+        }
+        shard_args.update({
+            "connection": connection,
+            "cohortTable": "#cohort_shard",
+            "cohortTableIsTemp": True
+        })
+        covariate_data = extractor_r.getDbCovariateData(**shard_args)
+        extractor_r.saveCovariateData(covariate_data, file)
+    finally:
+        database_connector.disconnect(connection)
+    return file
+
+
+def _get_db_covariate_data_by_shard(args: dict, n_shards: int,
+                                    shard_by: str, max_workers: int,
+                                    checkpoint_folder: str | None) \
+        -> CovariateData:
+    _check_worker_args(args)
+    if shard_by not in ("subject_id", "cohort_definition_id"):
+        raise ValueError("`shard_by` should be either 'subject_id' or "
+                         "'cohort_definition_id'")
+    if args["aggregated"] and shard_by == "subject_id":
+        raise ValueError("Aggregated statistics cannot be combined over "
+                         "subject shards, shard by 'cohort_definition_id'")
+
+    worker_args = {k: v for k, v in args.items() if k != "connection"}
+    worker_args["covariateSettings"] = _as_list_vector(
+        args["covariateSettings"]
+    )
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        checkpoint = Checkpoint(
+            checkpoint_folder or temp_folder,
+            _extraction_run_id(args, n_shards=n_shards, shard_by=shard_by)
+        )
+        files = {f"shard_{i}_of_{n_shards}":
+                 checkpoint.path(f"shard_{i}_of_{n_shards}")
+                 for i in range(n_shards)}
+        tasks = {
+            task: (_get_db_covariate_data_shard_worker,
+                   (worker_args, shard, n_shards, shard_by, file))
+            for shard, (task, file) in enumerate(files.items())
+        }
+        run_tasks(tasks, checkpoint, max_workers, files)
+        covariate_data = _r_helper("merge_covariate_data")(
+            StrVector(list(files.values())),
+            # the shards hold disjoint cohort entries, but aggregated
+            # statistics already describe the population of their cohorts
+            sumPopulationSize=not args["aggregated"]
+        )
+
+    return CovariateData.from_RS4(covariate_data)
+
+
 # -----------------------------------------------------------------------------
 # wrapper: FeatureExtraction/R/GetDefaultCovariates.R
 # functions: